@@ -0,0 +1,335 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, connection
+from django.db.models import Min, Q
+from .models import Amenity, AmenityExtract, AmenityCache, Event
+from .geodesy import EARTH_RADIUS, grid_cells, grid_cells_in_box, distances_to
+from xml.etree import ElementTree
+import numpy as np
+import datetime, pytz, json, math, overpy, bz2, gzip, os, concurrent.futures
+
+AMENITY_KEYS = ['amenity', 'leisure'] # Each key is looked up in turn, in the same order as the original Overpass queries
+AMENITY_BATCH_SIZE = 1000
+AMENITY_CACHE_PRECISION = 4 # Decimal places kept when caching Overpass answers, about 10 metres
+AMENITY_ENRICH_BATCH = 200 # The most events enrich_pending_events looks at in one go
+AMENITY_GROUP_SIZE = 0.01 # Events within the same square of this many degrees share an Overpass query
+AMENITY_WORKERS = 4 # The most Overpass queries made at once
+AMENITY_RETRY_DELAY = 60 # Seconds to wait after a failed Overpass query, doubled after each further failure
+AMENITY_MAX_ATTEMPTS = 8
+
+def overpass_api():
+    """ Returns an Overpass API client, for the server in the LOCMAN_OVERPASS_URL setting or overpy's default if it isn't set. """
+    url = getattr(settings, 'LOCMAN_OVERPASS_URL', None)
+    if url is None:
+        return overpy.Overpass()
+    return overpy.Overpass(url=url)
+
+def query_overpass(lat, lon, dist=100):
+    """
+    Query OpenStreetMap, via Overpass, to get the nearest amenities to the point specified.
+
+    :param lat: The latitude of the query point.
+    :param lon: The longitude of the query point.
+    :param dist: The distance from the query point to search.
+    :return: A list of dictionaries, each representing an amenity listed in OpenStreetMap.
+    :rtype: list
+    """
+    ret = []
+    api = overpass_api()
+    for key in AMENITY_KEYS:
+        query = "[out:json]; nwr[" + key + "](around:" + str(dist) + "," + str(lat) + "," + str(lon) + "); out center;"
+        result = api.query(query)
+        for node in result.nodes:
+            item = dict(node.tags)
+            if 'name' in item:
+                item['lat'] = float(node.lat)
+                item['lon'] = float(node.lon)
+                ret.append(item)
+        for way in result.ways:
+            item = dict(way.tags)
+            if 'name' in item:
+                item['lat'] = float(way.center_lat)
+                item['lon'] = float(way.center_lon)
+                ret.append(item)
+    return ret
+
+def extract_bounds():
+    """ Returns a list of [minlat, minlon, maxlat, maxlon] for every loaded OpenStreetMap extract. """
+    ret = cache.get('amenity_extracts')
+    if ret is None:
+        ret = [list(bounds) for bounds in AmenityExtract.objects.values_list('minlat', 'minlon', 'maxlat', 'maxlon')]
+        cache.set('amenity_extracts', ret, 86400)
+    return ret
+
+def _nearby(items, lat, lon, dist):
+    """ Picks the amenities within `dist` metres of a point from a list of [lat, lon, tags], in the form returned by query_overpass. """
+    ret = []
+    if len(items) == 0:
+        return ret
+    near = distances_to([item[0] for item in items], [item[1] for item in items], lat, lon) <= dist
+    for key in AMENITY_KEYS:
+        for i, item in enumerate(items):
+            if ((near[i]) and (key in item[2])):
+                amenity = dict(item[2])
+                amenity['lat'] = item[0]
+                amenity['lon'] = item[1]
+                ret.append(amenity)
+    return ret
+
+def _box(lat, lon, dist):
+    """ Returns the bounding box, as [minlat, minlon, maxlat, maxlon], of everything within `dist` metres of a point. """
+    dlat = math.degrees(dist / EARTH_RADIUS)
+    dlon = dlat / max(math.cos(math.radians(lat)), 0.01)
+    return [lat - dlat, lon - dlon, lat + dlat, lon + dlon]
+
+def local_amenities(lat, lon, dist=100):
+    """
+    Finds the amenities near a point in the Amenity table, in the same form as query_overpass. Ways are represented
+    by their centre, so a large way whose centre is further than `dist` away is not included.
+
+    :param lat: The latitude of the query point.
+    :param lon: The longitude of the query point.
+    :param dist: The distance from the query point to search.
+    :return: A list of dictionaries, each representing an amenity listed in OpenStreetMap.
+    :rtype: list
+    """
+    minlat, minlon, maxlat, maxlon = _box(lat, lon, dist)
+    rows = Amenity.objects.filter(cell__in=grid_cells_in_box(minlat, minlon, maxlat, maxlon), lat__gte=minlat, lat__lte=maxlat, lon__gte=minlon, lon__lte=maxlon).order_by('osm_type', 'osm_id').values_list('lat', 'lon', 'tags_data')
+    return _nearby([[row[0], row[1], json.loads(row[2])] for row in rows], lat, lon, dist)
+
+def _cache_key(lat, lon, dist):
+    return round(lat, AMENITY_CACHE_PRECISION), round(lon, AMENITY_CACHE_PRECISION), int(dist)
+
+def known_amenities(lat, lon, dist=100):
+    """
+    Get the nearest amenities to the point specified, if they can be found without querying Overpass: either the
+    point is within a loaded OpenStreetMap extract, or a previous answer for it is in the AmenityCache table.
+
+    :param lat: The latitude of the query point.
+    :param lon: The longitude of the query point.
+    :param dist: The distance from the query point to search.
+    :return: A list of dictionaries, each representing an amenity listed in OpenStreetMap, or None if Overpass needs to be queried.
+    :rtype: list
+    """
+    if ((lat is None) or (lon is None)):
+        return []
+    for bounds in extract_bounds():
+        if ((lat >= bounds[0]) & (lon >= bounds[1]) & (lat <= bounds[2]) & (lon <= bounds[3])):
+            return local_amenities(lat, lon, dist)
+    rounded_lat, rounded_lon, dist = _cache_key(lat, lon, dist)
+    cached = AmenityCache.objects.filter(lat=rounded_lat, lon=rounded_lon, dist=dist).values_list('amenities_data', flat=True).first()
+    if cached is None:
+        return None
+    return json.loads(cached)
+
+def nearest_amenities(lat, lon, dist=100):
+    """
+    Get the nearest amenities to the point specified. Points within a loaded OpenStreetMap extract are looked up in
+    the Amenity table; anywhere else Overpass is queried, and the answer kept in the AmenityCache table so nearby
+    points never need to query it again.
+
+    :param lat: The latitude of the query point.
+    :param lon: The longitude of the query point.
+    :param dist: The distance from the query point to search.
+    :return: A list of dictionaries, each representing an amenity listed in OpenStreetMap.
+    :rtype: list
+    """
+    ret = known_amenities(lat, lon, dist)
+    if not(ret is None):
+        return ret
+    rounded_lat, rounded_lon, dist = _cache_key(lat, lon, dist)
+    ret = query_overpass(rounded_lat, rounded_lon, dist)
+    AmenityCache.objects.update_or_create(lat=rounded_lat, lon=rounded_lon, dist=dist, defaults={'amenities_data': json.dumps(ret)})
+    return ret
+
+def query_overpass_box(minlat, minlon, maxlat, maxlon):
+    """
+    Query Overpass for every named amenity and leisure facility within a bounding box, in a single request.
+
+    :return: A list of [lat, lon, tags], nodes before ways and each in order of their OpenStreetMap ID, as used by _nearby.
+    :rtype: list
+    """
+    ret = []
+    box = str(minlat) + "," + str(minlon) + "," + str(maxlat) + "," + str(maxlon)
+    query = "[out:json]; (" + " ".join(["nwr[" + key + "](" + box + ");" for key in AMENITY_KEYS]) + "); out center;"
+    result = overpass_api().query(query)
+    for node in sorted(result.nodes, key=lambda n: n.id):
+        if 'name' in node.tags:
+            ret.append([float(node.lat), float(node.lon), dict(node.tags)])
+    for way in sorted(result.ways, key=lambda w: w.id):
+        if 'name' in way.tags:
+            ret.append([float(way.center_lat), float(way.center_lon), dict(way.tags)])
+    return ret
+
+def _enrich_group(events, dist):
+    """ Looks up the amenities near a group of events with one Overpass query, returning a list with one answer per event, or the exception raised. """
+    minlat, minlon, maxlat, maxlon = _box(events[0].lat, events[0].lon, dist)
+    for e in events[1:]:
+        box = _box(e.lat, e.lon, dist)
+        minlat = min(minlat, box[0])
+        minlon = min(minlon, box[1])
+        maxlat = max(maxlat, box[2])
+        maxlon = max(maxlon, box[3])
+    try:
+        items = query_overpass_box(minlat, minlon, maxlat, maxlon)
+    except Exception as error:
+        return error
+    ret = []
+    for e in events:
+        rounded_lat, rounded_lon, rounded_dist = _cache_key(e.lat, e.lon, dist)
+        ret.append(_nearby(items, rounded_lat, rounded_lon, rounded_dist)) # The same answer nearest_amenities would cache
+    return ret
+
+def enrich_pending_events(user, limit=AMENITY_ENRICH_BATCH, dist=100):
+    """
+    Looks up the amenities near a user's events that are waiting for them. Events whose amenities are already known
+    locally are done straight away. The rest are grouped with those nearby, so each group needs only one Overpass
+    query, and up to AMENITY_WORKERS groups are queried at once. If a query fails, its events are tried again later,
+    waiting twice as long after each failure, and given up on after AMENITY_MAX_ATTEMPTS.
+
+    :param limit: The maximum number of events to look at.
+    :param dist: The distance from each event to search, in metres.
+    :return: The number of seconds until there are more events ready to look up, or None if there are none waiting.
+    :rtype: float
+    """
+    now = datetime.datetime.now(tz=pytz.utc)
+    waiting = Event.objects.filter(user=user.profile, amenities_status='pending')
+    events = list(waiting.filter(Q(amenities_retry__isnull=True) | Q(amenities_retry__lte=now)).order_by('timestart')[0:limit])
+    done = []
+    groups = {}
+    for e in events:
+        ret = known_amenities(e.lat, e.lon, dist)
+        if ret is None:
+            key = (math.floor(e.lat / AMENITY_GROUP_SIZE), math.floor(e.lon / AMENITY_GROUP_SIZE))
+            groups.setdefault(key, []).append(e)
+            continue
+        e.amenities_data = json.dumps(ret)
+        e.amenities_status = 'done'
+        done.append(e)
+
+    groups = list(groups.values())
+    with concurrent.futures.ThreadPoolExecutor(max_workers=AMENITY_WORKERS) as executor:
+        answers = list(executor.map(lambda group: _enrich_group(group, dist), groups))
+    for group, answer in zip(groups, answers):
+        for i, e in enumerate(group):
+            if isinstance(answer, Exception):
+                e.amenities_attempts = e.amenities_attempts + 1
+                e.amenities_retry = now + datetime.timedelta(seconds=min(AMENITY_RETRY_DELAY * (2 ** (e.amenities_attempts - 1)), 86400))
+                if e.amenities_attempts >= AMENITY_MAX_ATTEMPTS:
+                    e.amenities_status = 'failed'
+            else:
+                rounded_lat, rounded_lon, rounded_dist = _cache_key(e.lat, e.lon, dist)
+                AmenityCache.objects.update_or_create(lat=rounded_lat, lon=rounded_lon, dist=rounded_dist, defaults={'amenities_data': json.dumps(answer[i])})
+                e.amenities_data = json.dumps(answer[i])
+                e.amenities_status = 'done'
+            done.append(e)
+    Event.objects.bulk_update(done, ['amenities_data', 'amenities_status', 'amenities_attempts', 'amenities_retry'])
+
+    if waiting.filter(Q(amenities_retry__isnull=True) | Q(amenities_retry__lte=now)).exists():
+        return 0
+    retry = waiting.aggregate(Min('amenities_retry'))['amenities_retry__min']
+    if retry is None:
+        return None
+    return max((retry - now).total_seconds(), 0)
+
+def _open_extract(path):
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def _elements(path):
+    """ Streams the top level elements of an OpenStreetMap XML file, discarding each one once it has been read. """
+    with _open_extract(path) as fp:
+        root = None
+        depth = 0
+        for event, elem in ElementTree.iterparse(fp, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = elem
+                depth = depth + 1
+                continue
+            depth = depth - 1
+            if depth == 1:
+                yield elem
+                root.clear()
+
+def _wanted_tags(elem):
+    """ Returns the tags of a node or way as a dictionary, if it is a named amenity or leisure facility, or None otherwise. """
+    tags = {}
+    for tag in elem.iter('tag'):
+        tags[tag.get('k')] = tag.get('v')
+    if not('name' in tags):
+        return None
+    for key in AMENITY_KEYS:
+        if key in tags:
+            return tags
+    return None
+
+def import_extract(path):
+    """
+    Loads the named amenities and leisure facilities from an OpenStreetMap XML extract (optionally compressed with
+    bzip2 or gzip) into the Amenity table, replacing those already loaded within the extract's bounds. The file is
+    read twice, so that only the nodes needed to find the centre of each way are ever held in memory.
+
+    :param path: The path of the extract.
+    :return: The number of amenities loaded.
+    :rtype: int
+    """
+    bounds = None
+    found = {} # (osm_type, osm_id) -> [lat, lon, tags]
+    way_nodes = {} # way id -> list of node ids
+    needed = set()
+    for elem in _elements(path):
+        if elem.tag == 'bounds':
+            bounds = [float(elem.get('minlat')), float(elem.get('minlon')), float(elem.get('maxlat')), float(elem.get('maxlon'))]
+        elif elem.tag == 'way':
+            tags = _wanted_tags(elem)
+            if not(tags is None):
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                found[('way', int(elem.get('id')))] = [None, None, tags]
+                way_nodes[int(elem.get('id'))] = refs
+                needed.update(refs)
+
+    coords = {}
+    node_bounds = [90.0, 180.0, -90.0, -180.0]
+    for elem in _elements(path):
+        if elem.tag != 'node':
+            continue
+        node_id = int(elem.get('id'))
+        node_lat = float(elem.get('lat'))
+        node_lon = float(elem.get('lon'))
+        node_bounds = [min(node_bounds[0], node_lat), min(node_bounds[1], node_lon), max(node_bounds[2], node_lat), max(node_bounds[3], node_lon)]
+        if node_id in needed:
+            coords[node_id] = (node_lat, node_lon)
+        tags = _wanted_tags(elem)
+        if not(tags is None):
+            found[('node', node_id)] = [node_lat, node_lon, tags]
+    if bounds is None:
+        bounds = node_bounds
+    for way_id, refs in way_nodes.items():
+        points = [coords[ref] for ref in refs if ref in coords]
+        if len(points) == 0:
+            del found[('way', way_id)] # None of its nodes are in the extract
+            continue
+        lats = [p[0] for p in points]
+        lons = [p[1] for p in points]
+        found[('way', way_id)][0] = (min(lats) + max(lats)) / 2 # The centre of the bounding box, as Overpass does for 'out center'
+        found[('way', way_id)][1] = (min(lons) + max(lons)) / 2
+
+    keys = list(found.keys())
+    cells = grid_cells([found[k][0] for k in keys], [found[k][1] for k in keys])
+    amenities = []
+    for i, k in enumerate(keys):
+        item = found[k]
+        amenities.append(Amenity(osm_type=k[0], osm_id=k[1], name=item[2]['name'][0:255], lat=item[0], lon=item[1], cell=int(cells[i]), tags_data=json.dumps(item[2])))
+    unique_fields = None
+    if connection.features.supports_update_conflicts_with_target:
+        unique_fields = ['osm_type', 'osm_id'] # Otherwise (as on MySQL) the unique constraint on them is used
+    with transaction.atomic():
+        Amenity.objects.filter(lat__gte=bounds[0], lon__gte=bounds[1], lat__lte=bounds[2], lon__lte=bounds[3]).delete()
+        Amenity.objects.bulk_create(amenities, batch_size=AMENITY_BATCH_SIZE, update_conflicts=True, unique_fields=unique_fields, update_fields=['name', 'lat', 'lon', 'cell', 'tags_data'])
+        AmenityExtract.objects.update_or_create(filename=os.path.basename(path), defaults={'minlat': bounds[0], 'minlon': bounds[1], 'maxlat': bounds[2], 'maxlon': bounds[3], 'amenities': len(amenities)})
+    cache.delete('amenity_extracts')
+    return len(amenities)
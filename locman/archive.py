@@ -0,0 +1,226 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Min
+from .models import Position
+from .geodesy import grid_cells
+import numpy as np
+import datetime, pytz, os
+
+ARCHIVE_BATCH_SIZE = 10000
+
+def archive_root(user):
+    """ Returns the directory in which a user's archived positions are stored. """
+    return os.path.join(settings.MEDIA_ROOT, 'archive', str(user.pk))
+
+def archive_path(user, date):
+    """ Returns the path of the file holding a user's archived positions for a particular day (UTC). """
+    return os.path.join(archive_root(user), date.strftime('%Y'), date.strftime('%Y-%m-%d') + '.npz')
+
+def archive_age():
+    """ Returns the age, as a timedelta, after which positions may be archived, or None if archiving is switched off. """
+    days = getattr(settings, 'LOCMAN_ARCHIVE_DAYS', None)
+    if days is None:
+        return None
+    return datetime.timedelta(days=int(days))
+
+def archived_dates(user):
+    """ Returns a sorted list of the dates for which a user has archived positions. """
+    ret = []
+    root = archive_root(user)
+    if not(os.path.isdir(root)):
+        return ret
+    for year in os.listdir(root):
+        for filename in os.listdir(os.path.join(root, year)):
+            if filename.endswith('.npz'):
+                ret.append(datetime.datetime.strptime(filename[0:10], '%Y-%m-%d').date())
+    return sorted(ret)
+
+def write_day(user, date, columns):
+    """
+    Writes a day of positions to the archive, replacing anything already archived for that day. Times are stored as
+    int64 microseconds and co-ordinates as int32 microdegrees, all delta encoded so that they compress well.
+
+    :param date: The date (UTC) of the positions.
+    :param columns: A dictionary of numpy arrays in time order, as returned by read_day.
+    """
+    path = archive_path(user, date)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    times = np.round(columns['time'] * 1000000).astype(np.int64)
+    lats = np.round(columns['lat'] * 1000000).astype(np.int32)
+    lons = np.round(columns['lon'] * 1000000).astype(np.int32)
+    sources, source_codes = np.unique(np.array(columns['source'], dtype=str), return_inverse=True)
+    temp_path = path + '.tmp.npz'
+    np.savez_compressed(temp_path,
+        time=np.diff(times, prepend=np.int64(0)),
+        lat=np.diff(lats, prepend=np.int32(0)),
+        lon=np.diff(lons, prepend=np.int32(0)),
+        speed=np.nan_to_num(columns['speed'], nan=-1.0).astype(np.int32),
+        elevation=columns['elevation'].astype(np.float32),
+        explicit=columns['explicit'],
+        sources=sources,
+        source=source_codes.astype(np.int16))
+    os.replace(temp_path, path) # Readers never see a half-written file
+
+def read_day(user, date):
+    """
+    Reads a day of positions from the archive.
+
+    :param date: The date (UTC) to read.
+    :return: A dictionary of numpy arrays, as returned by load_positions, plus 'source', or None if nothing is archived for the day.
+    :rtype: dict
+    """
+    path = archive_path(user, date)
+    if not(os.path.exists(path)):
+        return None
+    ret = {}
+    with np.load(path) as data:
+        ret['time'] = np.cumsum(data['time']) / 1000000
+        ret['lat'] = np.cumsum(data['lat'], dtype=np.int32) / 1000000
+        ret['lon'] = np.cumsum(data['lon'], dtype=np.int32) / 1000000
+        ret['speed'] = data['speed'].astype(np.float64)
+        ret['speed'][data['speed'] < 0] = np.nan
+        ret['elevation'] = data['elevation'].astype(np.float64)
+        ret['explicit'] = data['explicit']
+        ret['source'] = data['sources'][data['source']]
+    return ret
+
+def load_archive(user, dts, dte, explicit=None, source=False):
+    """
+    Reads a user's archived positions between dts and dte into numpy arrays, in time order.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param explicit: Optional, True or False to restrict the positions to explicit or calculated positions only.
+    :param source: Optional, if True the source ID of each position is also returned, as 'source'.
+    :return: A dictionary of numpy arrays, as returned by load_positions.
+    :rtype: dict
+    """
+    columns = {'time': [], 'lat': [], 'lon': [], 'speed': [], 'elevation': [], 'explicit': []}
+    if source:
+        columns['source'] = []
+    if os.path.isdir(archive_root(user)):
+        start = dts.timestamp()
+        end = dte.timestamp()
+        day = dts.astimezone(pytz.utc).date()
+        last_day = dte.astimezone(pytz.utc).date()
+        while day <= last_day:
+            data = read_day(user, day)
+            day = day + datetime.timedelta(days=1)
+            if data is None:
+                continue
+            wanted = (data['time'] >= start) & (data['time'] <= end)
+            if not(explicit is None):
+                wanted = wanted & (data['explicit'] == explicit)
+            for k in columns.keys():
+                columns[k].append(data[k][wanted])
+    ret = {}
+    for k in columns.keys():
+        if len(columns[k]) == 0:
+            ret[k] = np.zeros(0, dtype={'explicit': bool, 'source': str}.get(k, np.float64))
+        else:
+            ret[k] = np.concatenate(columns[k])
+    return ret
+
+def archive_positions(user, before):
+    """
+    Moves a user's positions into the archive, a whole day (UTC) at a time, for every day that ends before `before`.
+    Positions already archived for a day are merged with those in the database, with the database taking precedence.
+
+    :param before: A datetime. Only days ending before this time are archived.
+    :return: The number of positions moved out of the database.
+    :rtype: int
+    """
+    count = 0
+    first = Position.objects.filter(user=user.profile, time__lt=before).aggregate(Min('time'))['time__min']
+    if first is None:
+        return count
+    day = first.astimezone(pytz.utc).date()
+    while datetime.datetime(day.year, day.month, day.day, tzinfo=pytz.utc) + datetime.timedelta(days=1) <= before:
+        dts = datetime.datetime(day.year, day.month, day.day, tzinfo=pytz.utc)
+        dte = dts + datetime.timedelta(days=1)
+        rows = list(Position.objects.filter(user=user.profile, time__gte=dts, time__lt=dte).order_by('time').values_list('time', 'lat', 'lon', 'speed', 'elevation', 'explicit', 'source'))
+        if len(rows) > 0:
+            columns = {}
+            columns['time'] = np.array([row[0].timestamp() for row in rows], dtype=np.float64)
+            columns['lat'] = np.array([row[1] for row in rows], dtype=np.float64)
+            columns['lon'] = np.array([row[2] for row in rows], dtype=np.float64)
+            columns['speed'] = np.array([row[3] for row in rows], dtype=np.float64)
+            columns['elevation'] = np.array([row[4] for row in rows], dtype=np.float64)
+            columns['explicit'] = np.array([row[5] for row in rows], dtype=bool)
+            columns['source'] = np.array([row[6] for row in rows], dtype=str)
+            existing = read_day(user, day)
+            if not(existing is None):
+                old = ~np.isin(existing['time'], columns['time'])
+                order = np.argsort(np.concatenate((existing['time'][old], columns['time'])), kind='stable')
+                for k in columns.keys():
+                    columns[k] = np.concatenate((existing[k][old], columns[k]))[order]
+            write_day(user, day, columns)
+            Position.objects.filter(user=user.profile, time__gte=dts, time__lt=dte).delete()
+            count = count + len(rows)
+        day = day + datetime.timedelta(days=1)
+    return count
+
+def archived_neighbour(user, dt, after=False, dates=None):
+    """
+    Returns the time of the last archived explicit position before dt, or the first one after it, reading the archive
+    a day at a time outwards from the day containing dt.
+
+    :param dt: A datetime.
+    :param after: If True, find the first explicit position after dt rather than the last one before it.
+    :param dates: Optional, the list returned by archived_dates, if the caller already has it.
+    :return: A datetime, or None if there is no such position in the archive.
+    :rtype: datetime.datetime
+    """
+    if dates is None:
+        dates = archived_dates(user)
+    t = dt.timestamp()
+    day = dt.astimezone(pytz.utc).date()
+    if after:
+        dates = [date for date in dates if date >= day]
+    else:
+        dates = [date for date in reversed(dates) if date <= day]
+    for date in dates:
+        data = read_day(user, date)
+        if data is None:
+            continue
+        if after:
+            times = data['time'][data['explicit'] & (data['time'] > t)]
+        else:
+            times = data['time'][data['explicit'] & (data['time'] < t)]
+        if len(times) > 0:
+            return datetime.datetime.fromtimestamp((times[0] if after else times[-1]), tz=pytz.utc)
+    return None
+
+def restore_positions(user, dts, dte=None):
+    """
+    Moves a user's archived positions back into the database, for every day (UTC) from dts to dte. Should be called
+    before positions within the archived timespan are changed, as the archive is never modified in place. The archive
+    files are only removed once the current transaction commits.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: Optional, a datetime representing the end of the timespan. If None, every day from dts onwards is restored.
+    :return: The number of positions restored.
+    :rtype: int
+    """
+    count = 0
+    first_day = dts.astimezone(pytz.utc).date()
+    last_day = None
+    if not(dte is None):
+        last_day = dte.astimezone(pytz.utc).date()
+    for day in archived_dates(user):
+        if ((day < first_day) or ((not(last_day is None)) and (day > last_day))):
+            continue
+        data = read_day(user, day)
+        cells = grid_cells(data['lat'], data['lon'])
+        positions = []
+        for i in range(0, len(data['time'])):
+            positions.append(Position(user=user.profile, time=datetime.datetime.fromtimestamp(data['time'][i], tz=pytz.utc),
+                lat=float(data['lat'][i]), lon=float(data['lon'][i]),
+                speed=(None if np.isnan(data['speed'][i]) else int(data['speed'][i])),
+                elevation=(None if np.isnan(data['elevation'][i]) else float(data['elevation'][i])),
+                explicit=bool(data['explicit'][i]), source=str(data['source'][i]), cell=int(cells[i])))
+        with transaction.atomic():
+            Position.objects.bulk_create(positions, batch_size=ARCHIVE_BATCH_SIZE, ignore_conflicts=True)
+            transaction.on_commit(lambda path=archive_path(user, day): os.remove(path))
+        count = count + len(positions)
+    return count
@@ -0,0 +1,177 @@
+from django.contrib.auth.models import User
+from django.db import transaction
+from .models import Position, Event, BackfillPartition
+from .functions import INVALIDATE_EVENT_MARGIN, IMPORT_BATCH_SIZE, SPEED_CHUNK_SIZE, _chunks, invalidate_positions
+from .summaries import update_day_summaries
+from .stats import advance_stats
+from .stops import detect_stops
+from .geodesy import distances, grid_cells
+import numpy as np
+import datetime, pytz, math
+
+BACKFILL_PARTITION_SIZES = {'day': datetime.timedelta(days=1), 'week': datetime.timedelta(days=7)}
+BACKFILL_MARGIN = INVALIDATE_EVENT_MARGIN # How far either side of a partition positions are read at first, so that stops crossing its edges are found
+BACKFILL_MAX_MARGIN = datetime.timedelta(days=64) # The furthest either side of a partition positions are read, however long a stop crossing its edge is
+BACKFILL_INTERVAL = 60
+
+def backfill_partitions(dts, dte, size='week'):
+    """
+    Splits a timespan into partitions for the backfill command, starting at midnight UTC.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param size: One of BACKFILL_PARTITION_SIZES.
+    :return: A list of (start, end) tuples of datetimes. Each partition includes its start but not its end.
+    :rtype: list
+    """
+    ret = []
+    step = BACKFILL_PARTITION_SIZES[size]
+    start = dts.astimezone(pytz.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    while start <= dte:
+        ret.append((start, start + step))
+        start = start + step
+    return ret
+
+def _load_window(user, dts, dte):
+    """ Reads a user's positions from dts up to dte into numpy arrays, as position_context does, but with their primary keys and stored speeds. """
+    query = Position.objects.filter(user=user.profile, time__gte=dts, time__lt=dte).order_by('time').values_list('pk', 'time', 'lat', 'lon', 'speed', 'explicit')
+    rows = []
+    for chunk in _chunks(query.iterator(chunk_size=SPEED_CHUNK_SIZE), SPEED_CHUNK_SIZE):
+        rows.extend(chunk)
+    explicit = [row for row in rows if row[5]]
+    if ((len(explicit) == 0) or (explicit[0][1] > dts)):
+        edge = Position.objects.filter(user=user.profile, explicit=True, time__lt=dts).order_by('-time').values_list('pk', 'time', 'lat', 'lon', 'speed', 'explicit').first()
+        if not(edge is None):
+            rows.insert(0, edge)
+    if ((len(explicit) == 0) or (explicit[-1][1] < dte)):
+        edge = Position.objects.filter(user=user.profile, explicit=True, time__gte=dte).order_by('time').values_list('pk', 'time', 'lat', 'lon', 'speed', 'explicit').first()
+        if not(edge is None):
+            rows.append(edge)
+    return {
+        'pk': np.array([row[0] for row in rows], dtype=np.int64),
+        'time': np.array([row[1].timestamp() for row in rows], dtype=np.float64),
+        'lat': np.array([row[2] for row in rows], dtype=np.float64),
+        'lon': np.array([row[3] for row in rows], dtype=np.float64),
+        'speed': np.array([(-1 if row[4] is None else row[4]) for row in rows], dtype=np.int64),
+        'explicit': np.array([row[5] for row in rows], dtype=bool)
+    }
+
+def _fill_window(points, dts, dte, interval=BACKFILL_INTERVAL):
+    """
+    Fills in the gaps in positions read by _load_window, and works out the speed at every position, exactly as fill_gaps
+    followed by calculate_speeds would but without writing anything. Slots are on whole multiples of `interval` seconds.
+
+    :return: A dictionary of numpy arrays, in time order: those returned by _load_window, with 'speed' recalculated and the stored speed in 'old_speed', plus 'new', True for positions that need creating.
+    :rtype: dict
+    """
+    times = points['time']
+    explicit = points['explicit']
+    ex_times = times[explicit]
+    slots = np.arange(math.ceil(dts.timestamp() / interval) * interval, dte.timestamp(), interval, dtype=np.float64)
+    if len(ex_times) < 2:
+        slots = np.zeros(0, dtype=np.float64)
+    else:
+        slots = slots[(~np.isin(slots, times)) & (slots > ex_times[0]) & (slots < ex_times[-1])]
+    slot_lats = np.interp(slots, ex_times, points['lat'][explicit]) if len(slots) > 0 else np.zeros(0, dtype=np.float64)
+    slot_lons = np.interp(slots, ex_times, points['lon'][explicit]) if len(slots) > 0 else np.zeros(0, dtype=np.float64)
+    added = {'pk': np.zeros(len(slots), dtype=np.int64), 'time': slots, 'lat': slot_lats, 'lon': slot_lons, 'speed': np.full(len(slots), -1, dtype=np.int64), 'explicit': np.zeros(len(slots), dtype=bool)}
+    ret = {}
+    for k in added.keys():
+        ret[k] = np.concatenate((points[k], added[k]))
+    ret['new'] = np.concatenate((np.zeros(len(times), dtype=bool), np.ones(len(slots), dtype=bool)))
+    order = np.argsort(ret['time'], kind='stable')
+    for k in ret.keys():
+        ret[k] = ret[k][order]
+    ret['old_speed'] = ret['speed']
+    ret['speed'] = np.zeros(len(ret['time']), dtype=np.int64)
+    if len(ret['time']) > 1:
+        elapsed = np.diff(ret['time'])
+        ret['speed'][1:] = (np.divide(distances(ret['lat'], ret['lon']), elapsed, out=np.zeros(len(elapsed)), where=elapsed > 0) * 2.237).astype(np.int64) # miles per hour
+    return ret
+
+def _partition_stops(user, dts, dte, extent, method, max_speed, min_length):
+    """
+    Fills in a partition in memory and finds the stops that start within it. Positions either side of the partition
+    are filled in and searched too, and the margin either side is doubled until the stops found stop changing and
+    none of them could still be going on at the end of it, so that the result is the same as if the user's whole
+    history had been searched at once.
+
+    :param extent: A tuple of the times of the user's first and last positions.
+    :return: A tuple of the window of positions, as returned by _fill_window, and a list of (start, end, lat, lon) tuples, one for each stop.
+    :rtype: tuple
+    """
+    margin = BACKFILL_MARGIN
+    window = None
+    last = None
+    while True:
+        ws = dts - margin
+        we = dte + margin
+        points = _fill_window(_load_window(user, ws, we), ws, we)
+        if window is None:
+            window = points
+        found = detect_stops({'time': points['time'], 'lat': points['lat'], 'lon': points['lon'], 'speed': points['speed'].astype(np.float64)}, method, max_speed=max_speed, min_length=min_length)
+        owned = np.flatnonzero((found['start'] >= dts.timestamp()) & (found['start'] < dte.timestamp()))
+        stops = [(float(found['start'][i]), float(found['end'][i]), float(found['lat'][i]), float(found['lon'][i])) for i in owned]
+        # Could a stop starting within the partition still be going on at the end of the window?
+        if method == 'speed_gap':
+            moving = points['time'][points['speed'] > max_speed]
+            open_end = ((len(moving) == 0) or (moving[-1] < dte.timestamp() + min_length))
+        else:
+            open_end = ((not(found['resume'] is None)) and (found['resume'] < dte.timestamp()))
+        # Or could the window have started part way through a stop that carries on into the partition?
+        open_start = ((len(found['start']) > 0) and (len(points['time']) > 0) and (found['start'][0] - points['time'][0] < min_length) and (found['end'][0] >= dts.timestamp() - min_length))
+        if ((ws <= extent[0]) and (we >= extent[1])):
+            break # There's nothing more to read
+        if ((stops == last) and ((not(open_end)) or (we >= extent[1])) and ((not(open_start)) or (ws <= extent[0]))):
+            break
+        if margin >= BACKFILL_MAX_MARGIN:
+            break
+        last = stops
+        margin = margin * 2
+    return window, stops
+
+def backfill_partition(user_id, start_time, end_time, first_time, last_time, method=None, max_speed=2, min_length=300):
+    """
+    Fills in the gaps in one partition of a user's history, calculates the speeds and finds the stops within it, all in
+    memory, then bulk writes the results and records the partition as done. Runs in a worker process of the backfill
+    command; partitions can be processed in any order, and processing one again gives the same result.
+
+    :param start_time: The start of the partition, in seconds since the epoch.
+    :param end_time: The end of the partition, in seconds since the epoch.
+    :param first_time: The time of the user's first position, in seconds since the epoch.
+    :param last_time: The time of the user's last position, in seconds since the epoch.
+    :param method: Optional, the stop detector to use, one of stops.STOP_DETECTORS. Defaults to the one chosen in the user's profile.
+    :return: A dictionary containing the 'start' of the partition, and the number of 'positions' and 'events' created.
+    :rtype: dict
+    """
+    user = User.objects.get(pk=user_id)
+    if method is None:
+        method = user.profile.stop_detector
+    dts = datetime.datetime.fromtimestamp(start_time, tz=pytz.utc)
+    dte = datetime.datetime.fromtimestamp(end_time, tz=pytz.utc)
+    extent = (datetime.datetime.fromtimestamp(first_time, tz=pytz.utc), datetime.datetime.fromtimestamp(last_time, tz=pytz.utc))
+    window, stops = _partition_stops(user, dts, dte, extent, method, max_speed, min_length)
+
+    inside = (window['time'] >= start_time) & (window['time'] < end_time)
+    new = np.flatnonzero(inside & window['new'])
+    changed = np.flatnonzero(inside & (~window['new']) & (window['pk'] > 0) & (window['speed'] != window['old_speed']))
+    cells = grid_cells(window['lat'][new], window['lon'][new])
+    positions = []
+    for j in range(0, len(new)):
+        i = new[j]
+        positions.append(Position(user=user.profile, time=datetime.datetime.fromtimestamp(window['time'][i], tz=pytz.utc), lat=float(window['lat'][i]), lon=float(window['lon'][i]), speed=int(window['speed'][i]), explicit=False, source='cron', cell=int(cells[j])))
+    events = []
+    for stop in stops:
+        events.append(Event(timestart=datetime.datetime.fromtimestamp(stop[0], tz=pytz.utc), timeend=datetime.datetime.fromtimestamp(stop[1], tz=pytz.utc), lat=stop[2], lon=stop[3], user=user.profile, amenities_status='pending'))
+
+    with transaction.atomic():
+        Position.objects.bulk_create(positions, batch_size=IMPORT_BATCH_SIZE, ignore_conflicts=True)
+        Position.objects.bulk_update([Position(pk=int(window['pk'][i]), speed=int(window['speed'][i])) for i in changed], ['speed'], batch_size=IMPORT_BATCH_SIZE)
+        Event.objects.filter(user=user.profile, timestart__gte=dts, timestart__lt=dte).delete()
+        Event.objects.bulk_create(events, batch_size=IMPORT_BATCH_SIZE)
+        advance_stats(user, last_calculated=(positions[-1].time if len(positions) > 0 else None), last_event=(events[-1].timestart if len(events) > 0 else None))
+    if ((len(positions) > 0) or (len(changed) > 0)):
+        invalidate_positions(user, dts, dte)
+        update_day_summaries(user, dts, dte - datetime.timedelta(microseconds=1))
+    BackfillPartition.objects.update_or_create(user=user.profile, start=dts, defaults={'end': dte, 'positions': len(positions), 'events': len(events)})
+    return {'start': dts, 'positions': len(positions), 'events': len(events)}
@@ -1,95 +1,181 @@
-from django.db.models import Max, Min, Avg
+from django.db.models import Max, Min, Avg, Count, F
+from django.db import transaction, connection
 from django.db.utils import OperationalError
 from django.core.cache import cache
-from xml.dom import minidom
+from xml.etree import ElementTree
 from fitparse import FitFile
-import datetime, math, csv, dateutil.parser, pytz, urllib.request, json, overpy
-from tzlocal import get_localzone
-from .models import Position, Event
+import datetime, math, csv, dateutil.parser, pytz, urllib.request, json, itertools, time, collections, hashlib
+import numpy as np
+from .models import Position, Event, Watermark, ImportSegment, PositionSource, DaySummary
+from .geodesy import distance, distances, distances_to, haversine, grid_cell, grid_cells, grid_cells_in_box
+from .archive import load_archive, archived_dates, archived_neighbour, restore_positions
+from .stops import detect_stops
+from .stats import advance_stats, refresh_stats, user_stats
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_METHODS = ['bulk', 'upsert', 'row']
+IMPORT_SEGMENT_SIZE = datetime.timedelta(hours=1) # The span of time covered by each fingerprint used to spot unchanged data when importing
+INVALIDATE_EVENT_MARGIN = datetime.timedelta(hours=12) # How far either side of changed positions events are thrown away and generated again
+FILL_WINDOW = datetime.timedelta(days=7)
+SEMICIRCLES_TO_DEGREES = 180.0 / (2 ** 31)
+SPEED_CHUNK_SIZE = 10000
+POSITION_BATCH_GAP = datetime.timedelta(hours=6) # Requested times further apart than this are read from the database separately
+POSITION_BATCH_PADDING = datetime.timedelta(hours=1) # How far either side of the requested times to read positions
+POSITION_CACHE_BUCKET = datetime.timedelta(minutes=10) # The span of time covered by each cached set of positions used by get_position
+POSITION_CACHE_TIMEOUT = 3600
+POSITION_CACHE_MAX_INVALIDATE = datetime.timedelta(days=31) # Invalidating more than this discards the user's whole position cache
+
+def _chunks(iterable, size):
+    """ Splits a list or generator into lists of at most `size` items, only ever reading one list's worth at a time. """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
 
 def get_process_stats(user):
     """
-    Deals with the caching of statistics called by the Imouto Viewer. Some versions of MariaDB
-    take a long time to get the highest value in a date column on a big table, so we do some
-    crafty caching.
+    Returns the statistics called by the Imouto Viewer: the times of the user's last calculated position and last
+    generated event (or the current time, if there are none), and of their last explicit position. These are read
+    from the user's UserStats, kept up to date as positions and events are written, rather than from the position
+    and event tables.
     """
     now = pytz.utc.localize(datetime.datetime.utcnow())
+    stats = user_stats(user)
     ret = {}
+    ret['last_calculated_position'] = int((now if stats.last_calculated is None else stats.last_calculated).timestamp())
+    ret['last_generated_event'] = int((now if stats.last_event is None else stats.last_event).timestamp())
+    ret['last_explicit_position'] = int((now if stats.last_explicit is None else stats.last_explicit).timestamp())
+    return ret
 
-    if cache.has_key('last_calculated_position'):
-        ret['last_calculated_position'] = int(cache.get('last_calculated_position'))
-    else:
-        try:
-            ret['last_calculated_position'] = int(Position.objects.filter(user=user.profile, explicit=False, source='cron').order_by('-time')[0].time.timestamp())
-            cache.set('last_calculated_position', ret['last_calculated_position'], 86400)
-        except IndexError:
-            ret['last_calculated_position'] = int(now.timestamp())
+def _detect_stops(times, state, min_length=300):
+    """
+    Finds stops in a stream of the times at which the user was moving. A stop is a gap of at least `min_length`
+    seconds between two moving positions, with moving positions less than a minute either side of it, and stops less
+    than `min_length` seconds apart are merged. Everything needed to carry on from where the stream ends is kept in
+    `state`, so a later call can pick up exactly where this one left off.
 
-    if cache.has_key('last_generated_event'):
-        ret['last_generated_event'] = int(cache.get('last_generated_event'))
-    else:
-        try:
-            ret['last_generated_event'] = int(Event.objects.order_by('-timestart')[0].timestart.timestamp())
-            cache.set('last_generated_event', ret['last_generated_event'], 86400)
-        except IndexError:
-            ret['last_generated_event'] = int(now.timestamp())
+    :param times: An iterable of datetimes, in time order.
+    :param state: A dictionary, updated in place, with 'window' (the last few times seen) and 'pending' (a stop that might still be merged with the next one). Pass an empty dictionary to start from scratch.
+    :param min_length: The minimum length of a stop, in seconds.
+    :return: A generator of [start, end] lists, one for each stop that can no longer change.
+    """
+    window = collections.deque(state.get('window', []), maxlen=4)
+    pending = state.get('pending', None)
+    for t in times:
+        window.append(t)
+        if len(window) < 4:
+            continue
+        buffer_before = (window[1] - window[0]).total_seconds()
+        event_length = (window[2] - window[1]).total_seconds()
+        buffer_after = (window[3] - window[2]).total_seconds()
+        if ((event_length >= min_length) & (buffer_before < 60) & (buffer_after < 60)):
+            if pending is None:
+                pending = [window[1], window[2]]
+            elif (window[1] - pending[1]).total_seconds() < min_length:
+                pending[1] = window[2]
+            else:
+                yield pending
+                pending = [window[1], window[2]]
+        if ((not(pending is None)) and ((window[2] - pending[1]).total_seconds() >= min_length)):
+            yield pending # No later stop can start close enough to this one to be merged with it
+            pending = None
+    state['window'] = list(window)
+    state['pending'] = pending
 
-    return ret
+def _stop_state_to_json(state):
+    """ Converts the state kept by _detect_stops into a string for storing in a Watermark. """
+    data = {'window': [t.isoformat() for t in state.get('window', [])], 'pending': None}
+    if not(state.get('pending', None) is None):
+        data['pending'] = [t.isoformat() for t in state['pending']]
+    return json.dumps(data)
+
+def _stop_state_from_json(data):
+    """ Reverses _stop_state_to_json. """
+    data = json.loads(data)
+    state = {'window': [dateutil.parser.parse(t) for t in data.get('window', [])], 'pending': None}
+    if not(data.get('pending', None) is None):
+        state['pending'] = [dateutil.parser.parse(t) for t in data['pending']]
+    return state
 
-def generate_events(user, max_speed=2, min_length=300, for_date=None):
+def create_stop_event(user, dts, dte, lat, lon):
+    """ Saves a stop as an Event and returns it. The amenities nearby are left pending, to be looked up by the enrich_event_amenities task. """
+    e = Event(timestart=dts, timeend=dte, lat=lat, lon=lon, user=user.profile, amenities_status='pending')
+    e.save()
+    advance_stats(user, last_event=e.timestart)
+    return e
+
+def generate_events(user, max_speed=2, min_length=300, for_date=None, method=None, **kwargs):
     """
-    Generates 'stop' events on the specified date. If no date is specified, generate events in
-    the time between the last generated event and the last location data.
+    Generates 'stop' events on the specified date. If no date is specified, generate events from the new location
+    data since the last run. How far the last run got, and any stop it found that might still be extended, is kept in
+    a Watermark, so each run reads only the positions it hasn't seen before. The speed gap detector reads them in a
+    single streamed query; the other detectors in stops.py read them into arrays with load_positions.
 
     :param max_speed: The speed in miles per hour that the user needs to be moving before we consider it not part of a 'stop'.
     :param min_length: The minimum length of a stop, in seconds. Stops shorter than this value will be ignored.
+    :param method: Optional, the stop detector to use, one of stops.STOP_DETECTORS. Defaults to the one chosen in the user's profile.
     :return: A list of new Event objects that have been created by this function call.
     :rtype: list
     """
     ret = []
-    try:
-        dt = Event.objects.order_by('-timeend').first().timeend
-    except:
-        dt = None
+    if method is None:
+        method = user.profile.stop_detector
     dte = pytz.utc.localize(datetime.datetime.utcnow())
+    state = {}
+    watermark = None
     if not(for_date is None):
         dt = pytz.utc.localize(datetime.datetime(for_date.year, for_date.month, for_date.day, 0, 0, 0))
         dte = dt + datetime.timedelta(days=1) - datetime.timedelta(seconds=1)
-    if dt is None:
-        dt = pytz.utc.localize(datetime.datetime.utcnow())
-        ev = Event(timestart=dt, timeend=dt)
-        ev.save()
-        ret.append(ev)
+    else:
+        watermark = Watermark.objects.filter(user=user.profile, name='events').first()
+        if watermark is None:
+            dt = Event.objects.filter(user=user.profile).order_by('-timeend').values_list('timeend', flat=True).first()
+            if dt is None:
+                dt = pytz.utc.localize(datetime.datetime.utcnow())
+                ev = Event(timestart=dt, timeend=dt, user=user.profile)
+                ev.save()
+                advance_stats(user, last_event=dt)
+                ret.append(ev)
+                return ret
+            watermark = Watermark(user=user.profile, name='events', time=dt)
+        else:
+            dt = watermark.time
+            state = _stop_state_from_json(watermark.state)
+
+    if method != 'speed_gap':
+        if not(state.get('pending', None) is None):
+            dt = state['pending'][0] # Switched from the speed gap detector part way through a stop
+        found = detect_stops(load_positions(user, dt, dte), method, max_speed=max_speed, min_length=min_length, **kwargs)
+        if for_date is None:
+            if not(found['resume'] is None):
+                watermark.time = datetime.datetime.fromtimestamp(found['resume'], tz=pytz.utc)
+            watermark.state = json.dumps({})
+            watermark.save()
+        for i in range(0, len(found['start'])):
+            ret.append(create_stop_event(user, datetime.datetime.fromtimestamp(found['start'][i], tz=pytz.utc), datetime.datetime.fromtimestamp(found['end'][i], tz=pytz.utc), float(found['lat'][i]), float(found['lon'][i])))
         return ret
-    pp = Position.objects.filter(user=user.profile, time__gte=dt, time__lte=dte, speed__gt=max_speed).order_by('time').all()
-    stops = []
-    stops_refined = []
-    for i in range(0, len(pp) - 4):
-        buffer_before = (pp[i + 1].time - pp[i].time).total_seconds()
-        event_length = (pp[i + 2].time - pp[i + 1].time).total_seconds()
-        buffer_after = (pp[i + 3].time - pp[i + 2].time).total_seconds()
-        if event_length >= min_length:
-            if ((buffer_before < 60) & (buffer_after < 60)):
-                ev = [pp[i + 1].time, pp[i + 2].time]
-                stops.append(ev)
+
+    query = Position.objects.filter(user=user.profile, speed__gt=max_speed, time__lte=dte)
+    if len(state.get('window', [])) > 0:
+        query = query.filter(time__gt=dt)
+    else:
+        query = query.filter(time__gte=dt)
+    times = query.order_by('time').values_list('time', flat=True).iterator(chunk_size=SPEED_CHUNK_SIZE)
+    stops = list(_detect_stops(times, state, min_length))
+    if for_date is None:
+        if len(state['window']) > 0:
+            watermark.time = state['window'][-1]
+        watermark.state = _stop_state_to_json(state)
+        watermark.save()
+    else:
+        if not(state['pending'] is None):
+            stops.append(state['pending'])
+
     for n in stops:
-        i = len(stops_refined) - 1
-        if i < 0:
-            stops_refined.append(n)
-            continue
-        dur = (n[0] - stops_refined[i][1]).total_seconds()
-        if dur < min_length:
-            stops_refined[i][1] = n[1]
-        else:
-            stops_refined.append(n)
-    for n in stops_refined:
         ll = Position.objects.filter(user=user.profile, time__gte=n[0], time__lte=n[1]).aggregate(Avg('lat'), Avg('lon'))
-        e = Event(timestart=n[0], timeend=n[1], lat=ll['lat__avg'], lon=ll['lon__avg'], user=user.profile)
-        e.amenities_data = json.dumps(nearest_amenities(e.lat, e.lon))
-        e.save()
-        ret.append(e)
-        if for_date is None:
-            cache.set('last_generated_event', int(e.timestart.timestamp()), 86400)
+        ret.append(create_stop_event(user, n[0], n[1], ll['lat__avg'], ll['lon__avg']))
 
     return ret
 
@@ -115,19 +201,31 @@ def get_location_events(user, dts, dte, lat, lon, dist=0.05):
 
     starttime = dts
     lasttime = dts
-    for position in Position.objects.filter(user=user.profile, time__gte=dts - datetime.timedelta(hours=12), time__lte=dte + datetime.timedelta(hours=24), lat__gt=minlat, lat__lt=maxlat, lon__gt=minlon, lon__lt=maxlon).order_by('time'):
+    cells = grid_cells_in_box(minlat, minlon, maxlat, maxlon)
+    positions = list(Position.objects.filter(user=user.profile, cell__in=cells, time__gte=dts - datetime.timedelta(hours=12), time__lte=dte + datetime.timedelta(hours=24), lat__gt=minlat, lat__lt=maxlat, lon__gt=minlon, lon__lt=maxlon).order_by('time').values_list('time', 'lat', 'lon'))
+    archived = load_archive(user, dts - datetime.timedelta(hours=12), dte + datetime.timedelta(hours=24))
+    wanted = (archived['lat'] > minlat) & (archived['lat'] < maxlat) & (archived['lon'] > minlon) & (archived['lon'] < maxlon)
+    if wanted.any():
+        times = set([p[0] for p in positions])
+        for t, archived_lat, archived_lon in zip(archived['time'][wanted], archived['lat'][wanted], archived['lon'][wanted]):
+            archived_dt = datetime.datetime.fromtimestamp(t, tz=pytz.utc)
+            if not(archived_dt in times):
+                positions.append((archived_dt, float(archived_lat), float(archived_lon)))
+        positions.sort(key=lambda p: p[0])
+    near = distances_to([p[1] for p in positions], [p[2] for p in positions], lat, lon) <= 100
+    for i in range(0, len(positions)):
+        position_time = positions[i][0]
         if starttime == dts:
-            starttime = position.time
-            lasttime = position.time
-        dist = distance(float(lat), float(lon), position.lat, position.lon)
-        if dist > 100:
+            starttime = position_time
+            lasttime = position_time
+        if not(near[i]):
             continue
-        if (position.time - lasttime).total_seconds() > 300:
+        if (position_time - lasttime).total_seconds() > 300:
             if ((starttime >= dts) & (starttime <= dte) & (starttime != lasttime)):
                 item = {'timestart': starttime, 'timeend': lasttime}
                 ret.append(item)
-            starttime = position.time
-        lasttime = position.time
+            starttime = position_time
+        lasttime = position_time
     if starttime > dts:
         if ((starttime >= dts) & (starttime <= dte) & (starttime != lasttime)):
             item = {'timestart': starttime, 'timeend': lasttime}
@@ -135,85 +233,141 @@ def get_location_events(user, dts, dte, lat, lon, dist=0.05):
 
     return ret
 
+def load_positions(user, dts, dte, explicit=None, source=False):
+    """
+    Reads a user's positions between dts and dte into numpy arrays, in time order. The rows are streamed from the
+    database with values_list and iterator(), so no Position objects are created, and are converted into arrays a chunk
+    at a time. Any archived positions in the timespan are merged in, with the database taking precedence.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param explicit: Optional, True or False to restrict the positions to explicit or calculated positions only.
+    :param source: Optional, if True the source ID of each position is also returned, as 'source'.
+    :return: A dictionary of numpy arrays, all the same length: 'time' (seconds since the epoch), 'lat', 'lon', 'speed' and 'elevation' (NaN where unknown), and 'explicit'.
+    :rtype: dict
+    """
+    query = Position.objects.filter(user=user.profile, time__gte=dts, time__lte=dte)
+    if not(explicit is None):
+        query = query.filter(explicit=explicit)
+    fields = ['time', 'lat', 'lon', 'speed', 'elevation', 'explicit']
+    if source:
+        fields.append('source')
+    query = query.order_by('time').values_list(*fields)
+    columns = {}
+    for k in fields:
+        columns[k] = []
+    for chunk in _chunks(query.iterator(chunk_size=SPEED_CHUNK_SIZE), SPEED_CHUNK_SIZE):
+        columns['time'].append(np.array([row[0].timestamp() for row in chunk], dtype=np.float64))
+        columns['lat'].append(np.array([row[1] for row in chunk], dtype=np.float64))
+        columns['lon'].append(np.array([row[2] for row in chunk], dtype=np.float64))
+        columns['speed'].append(np.array([row[3] for row in chunk], dtype=np.float64))
+        columns['elevation'].append(np.array([row[4] for row in chunk], dtype=np.float64))
+        columns['explicit'].append(np.array([row[5] for row in chunk], dtype=bool))
+        if source:
+            columns['source'].append(np.array([row[6] for row in chunk], dtype=str))
+    ret = {}
+    for k in columns.keys():
+        if len(columns[k]) == 0:
+            ret[k] = np.zeros(0, dtype={'explicit': bool, 'source': str}.get(k, np.float64))
+        else:
+            ret[k] = np.concatenate(columns[k])
+    archived = load_archive(user, dts, dte, explicit, source)
+    if len(archived['time']) > 0:
+        wanted = ~np.isin(archived['time'], ret['time'])
+        order = np.argsort(np.concatenate((archived['time'][wanted], ret['time'])), kind='stable')
+        for k in ret.keys():
+            ret[k] = np.concatenate((archived[k][wanted], ret[k]))[order]
+    return ret
+
 def get_last_position(user, source=''):
     """ Returns a datetime referencing the last position in the user's data. Optionally, specify a data source ID to restrict the search to that source. """
-    if source == '':
-        try:
-            latest = Position.objects.filter(user=user.profile).order_by('-time')[0].time
-        except:
-            latest = None
-    else:
-        try:
-            latest = Position.objects.filter(user=user.profile, source=source).order_by('-time')[0].time
-        except:
-            latest = None
-    return latest
+    query = Position.objects.filter(user=user.profile)
+    if source != '':
+        query = query.filter(source=source)
+    return query.order_by('-time').values_list('time', flat=True).first()
 
 def get_last_event(user):
     """ Returns the start time of the last generated event. Or, if no events have been generated, the time of the last available data. """
-    try:
-        latest = Event.objects.filter(user=user.profile).order_by('-timeend')[0].timestart
-    except:
-        latest = get_last_position() # TODO change this to first?
+    latest = Event.objects.filter(user=user.profile).order_by('-timeend').values_list('timestart', flat=True).first()
+    if latest is None:
+        latest = get_last_position(user) # TODO change this to first?
     return latest
 
 def parse_file_fit(filename, source='unknown'):
-    """ Parses an ANT-FIT file. The source is just a string to uniquely identify a particular data source, such as 'my_smartwatch' or 'my_bike_tracker'. """
-    data = []
+    """
+    Parses an ANT-FIT file. The source is just a string to uniquely identify a particular data source, such as 'my_smartwatch' or 'my_bike_tracker'.
+    This is a generator, yielding a (timestamp, lat, lon, alt) tuple for each record containing a position. Fields other than
+    these four are ignored without being decoded into dictionaries.
+    """
     try:
         fit = FitFile(filename)
     except:
-        return []
-    tz = get_localzone() # TODO investigate this
-    tz = pytz.utc
+        return
     for record in fit.get_messages('record'):
-        item = {}
-        for recitem in record:
-            k = recitem.name
-            if ((k != 'position_lat') & (k != 'position_long') & (k != 'timestamp') & (k != 'enhanced_altitude')):
-                continue
-            v = {}
-            v['value'] = recitem.value
-            v['units'] = recitem.units
-            if ((v['units'] == 'semicircles') & (not(v['value'] is None))):
-                v['value'] = float(v['value']) * ( 180 / math.pow(2, 31) )
-                v['units'] = 'degrees'
-            item[k] = v
-        if not('position_lat' in item):
-            continue
-        if not('position_long' in item):
-            continue
-        if not('timestamp' in item):
-            continue
-        if item['position_lat']['value'] is None:
-            continue
-        if item['position_long']['value'] is None:
+        dt = None
+        lat = None
+        lon = None
+        alt = None
+        for field in record.fields:
+            name = field.name
+            if name == 'position_lat':
+                lat = field.value
+                if ((not(lat is None)) & (field.units == 'semicircles')):
+                    lat = lat * SEMICIRCLES_TO_DEGREES
+            elif name == 'position_long':
+                lon = field.value
+                if ((not(lon is None)) & (field.units == 'semicircles')):
+                    lon = lon * SEMICIRCLES_TO_DEGREES
+            elif name == 'timestamp':
+                dt = field.value
+            elif name == 'enhanced_altitude':
+                alt = field.value
+        if ((lat is None) or (lon is None) or (dt is None)):
             continue
-        if item['timestamp']['value'].tzinfo is None or item['timestamp']['value'].utcoffset(item['timestamp']['value']) is None:
-            item['timestamp']['value'] = tz.localize(item['timestamp']['value']).astimezone(pytz.utc)
-        newitem = {}
-        newitem['lat'] = item['position_lat']['value']
-        newitem['lon'] = item['position_long']['value']
-        if 'enhanced_altitude' in item:
-            newitem['alt'] = float(item['enhanced_altitude']['value'])
-        newitem['date'] = item['timestamp']['value']
-        data.append(newitem)
-    return data
+        if dt.tzinfo is None or dt.utcoffset() is None:
+            dt = dt.replace(tzinfo=pytz.utc)
+        yield (dt, lat, lon, alt)
+
+def _parse_gpx_time(value):
+    """ Parses a GPX timestamp. Almost all of these are of the form 2023-01-01T12:00:00Z, which can be dealt with far more quickly than by dateutil. """
+    value = value.strip()
+    if value.endswith('Z'):
+        try:
+            return datetime.datetime.fromisoformat(value[:-1]).replace(tzinfo=pytz.utc)
+        except ValueError:
+            pass
+    dt = dateutil.parser.parse(value)
+    if dt.tzinfo is None:
+        dt = pytz.utc.localize(dt)
+    return dt
 
 def parse_file_gpx(filename, source='unknown'):
-    """ Parses a GPX file. The source is just a string to uniquely identify a particular data source, such as 'phone' or 'fitness_tracker'. """
-    data = []
-    xml = minidom.parse(filename)
-    for point in xml.getElementsByTagName('trkpt'):
+    """
+    Parses a GPX file. The source is just a string to uniquely identify a particular data source, such as 'phone' or 'fitness_tracker'.
+    This is a generator; the file is read incrementally and each track point is discarded once it has been yielded, so files
+    of any size can be parsed in constant memory.
+    """
+    parents = []
+    for event, element in ElementTree.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag.rsplit('}', 1)[-1] != 'trkpt':
+            continue
         item = {}
-        item['lat'] = point.attributes['lat'].value
-        item['lon'] = point.attributes['lon'].value
-        for timeval in point.getElementsByTagName('time'):
-            item['date'] = dateutil.parser.parse(timeval.childNodes[0].nodeValue)
-        for altval in point.getElementsByTagName('ele'):
-            item['alt'] = float(altval.childNodes[0].nodeValue)
-        data.append(item)
-    return data
+        item['lat'] = float(element.get('lat'))
+        item['lon'] = float(element.get('lon'))
+        for child in element:
+            tag = child.tag.rsplit('}', 1)[-1]
+            if ((tag == 'time') & (not(child.text is None))):
+                item['date'] = _parse_gpx_time(child.text)
+            if ((tag == 'ele') & (not(child.text is None))):
+                item['alt'] = float(child.text)
+        if len(parents) > 0:
+            parents[-1].remove(element)
+        if 'date' in item:
+            yield item
 
 def parse_file_csv(filename, source='unknown', delimiter='\t'):
     """ Parses a CSV file. The columns must be in the format ISO8601 date, latitude, longitude, but the delimiter can be specified. """
@@ -228,36 +382,368 @@ def parse_file_csv(filename, source='unknown', delimiter='\t'):
             data.append(item)
     return data
 
-def import_data(user, data, source='unknown'):
-    """ Takes a parsed dataset from parse_file_* and imports the data into the database. The source is just a string to uniquely identify a particular data source, such as 'phone' or 'fitness_tracker'. """
-    dt = pytz.utc.localize(datetime.datetime.utcnow())
-    for row in data:
-        if row['date'] < dt:
-            dt = row['date']
-    dt = dt - datetime.timedelta(hours=12)
-    Position.objects.filter(user=user.profile, time__gte=dt, explicit=False).delete()
-    Event.objects.filter(user=user.profile, timeend__gte=dt).delete()
-    for row in data:
+def _import_rows_single(user, rows, source):
+    """ Imports rows (a dictionary of time -> (lat, lon, alt) tuples) one at a time, the way import_data always used to. Slow, but kept for debugging imports. """
+    ret = {'inserted': 0, 'updated': 0, 'skipped': 0, 'changed_start': min(rows), 'changed_end': max(rows), 'sources': collections.Counter()}
+    for dt, (lat, lon, alt) in rows.items():
         try:
-            pos = Position.objects.get(user=user.profile, time=row['date'])
-            pos.lat = row['lat']
-            pos.lon = row['lon']
+            pos = Position.objects.get(user=user.profile, time=dt)
+            if pos.explicit:
+                ret['sources'][pos.source] = ret['sources'][pos.source] - 1
+            pos.lat = lat
+            pos.lon = lon
             pos.explicit = True
             pos.source = source
-        except:
-            pos = Position(user=user.profile, time=row['date'], lat=row['lat'], lon=row['lon'], explicit=True, source=source)
-        if ((pos.elevation is None) & ('alt' in row)):
-            pos.elevation = float(row['alt'])
-        if 'alt' in row:
-            pos.elevation = float(row['alt'])
+            ret['updated'] = ret['updated'] + 1
+        except Position.DoesNotExist:
+            pos = Position(user=user.profile, time=dt, lat=lat, lon=lon, explicit=True, source=source)
+            ret['inserted'] = ret['inserted'] + 1
+        ret['sources'][source] = ret['sources'][source] + 1
+        if not(alt is None):
+            pos.elevation = alt
         pos.save()
-    Position.objects.filter(user=user.profile, time__gte=dt, explicit=False).delete()
-    Event.objects.filter(user=user.profile, timeend__gte=dt).delete()
-    if cache.has_key('last_calculated_position'):
-        cached_dt = cache.get('last_calculated_position')
-        dt_i = int(dt.timestamp())
-        if dt_i < cached_dt:
-            cache.set('last_calculated_position', dt_i, 86400)
+    return ret
+
+def _import_rows_bulk(user, rows, source, upsert=False):
+    """
+    Imports rows (a dictionary of time -> (lat, lon, alt) tuples) in batches. The positions already stored for the
+    time window covered by the rows are fetched in a single query and used to split the rows into inserts and
+    updates. Rows identical to what is already stored are skipped, and the times of the first and last rows that
+    weren't are returned as 'changed_start' and 'changed_end'. The change in the number of explicit positions from
+    each source is returned in 'sources'.
+    """
+    ret = {'inserted': 0, 'updated': 0, 'skipped': 0, 'changed_start': None, 'changed_end': None, 'sources': collections.Counter()}
+    existing = {}
+    for pk, dt, lat, lon, elevation, explicit, pos_source in Position.objects.filter(user=user.profile, time__gte=min(rows), time__lte=max(rows)).values_list('pk', 'time', 'lat', 'lon', 'elevation', 'explicit', 'source'):
+        existing[dt] = (pk, lat, lon, elevation, explicit, pos_source)
+    inserts = []
+    updates = []
+    for dt, (lat, lon, alt) in rows.items():
+        if not(dt in existing):
+            inserts.append(Position(user=user.profile, time=dt, lat=lat, lon=lon, elevation=alt, explicit=True, source=source, cell=grid_cell(lat, lon)))
+            continue
+        pk, old_lat, old_lon, old_elevation, old_explicit, old_source = existing[dt]
+        if alt is None:
+            alt = old_elevation
+        if ((old_lat == lat) & (old_lon == lon) & (old_elevation == alt) & (old_explicit) & (old_source == source)):
+            ret['skipped'] = ret['skipped'] + 1
+            continue
+        updates.append(Position(pk=pk, user=user.profile, time=dt, lat=lat, lon=lon, elevation=alt, explicit=True, source=source, cell=grid_cell(lat, lon)))
+        if ((old_explicit) & (old_source != source)):
+            ret['sources'][old_source] = ret['sources'][old_source] - 1
+            ret['sources'][source] = ret['sources'][source] + 1
+        elif not(old_explicit):
+            ret['sources'][source] = ret['sources'][source] + 1
+    ret['sources'][source] = ret['sources'][source] + len(inserts)
+    ret['inserted'] = len(inserts)
+    ret['updated'] = len(updates)
+    if len(inserts) + len(updates) > 0:
+        ret['changed_start'] = min([pos.time for pos in inserts + updates])
+        ret['changed_end'] = max([pos.time for pos in inserts + updates])
+    if ((upsert) & (connection.features.supports_update_conflicts)):
+        unique_fields = None
+        if connection.features.supports_update_conflicts_with_target:
+            unique_fields = ['user', 'time']
+        for pos in updates:
+            pos.pk = None
+        Position.objects.bulk_create(inserts + updates, batch_size=IMPORT_BATCH_SIZE, update_conflicts=True, update_fields=['lat', 'lon', 'elevation', 'explicit', 'source', 'cell'], unique_fields=unique_fields)
+    else:
+        Position.objects.bulk_create(inserts, batch_size=IMPORT_BATCH_SIZE)
+        Position.objects.bulk_update(updates, ['lat', 'lon', 'elevation', 'explicit', 'source', 'cell'], batch_size=IMPORT_BATCH_SIZE)
+    return ret
+
+def _segment_start(dt):
+    """ Returns the start of the IMPORT_SEGMENT_SIZE period containing dt. """
+    size = IMPORT_SEGMENT_SIZE.total_seconds()
+    return datetime.datetime.fromtimestamp(math.floor(dt.timestamp() / size) * size, tz=pytz.utc)
+
+def _segment_fingerprint(rows):
+    """ Returns a SHA-256 hash of a dictionary of time -> (lat, lon, alt) tuples, which doesn't depend on the order of the rows. """
+    h = hashlib.sha256()
+    for dt in sorted(rows):
+        lat, lon, alt = rows[dt]
+        h.update((repr(dt.timestamp()) + "," + repr(lat) + "," + repr(lon) + "," + repr(alt) + "\n").encode('ascii'))
+    return h.hexdigest()
+
+def _restore_span(user, dts, dte, archived):
+    """
+    Works out which archived positions need restoring before positions between dts and dte are imported. That is
+    everything that invalidate_span may throw away and calculate again: the positions within INVALIDATE_EVENT_MARGIN,
+    and the calculated positions back to the explicit position before dts and on to the explicit position after dte,
+    either of which may be in the database or the archive.
+
+    :param archived: The list returned by archived_dates.
+    :return: A tuple of two datetimes, the start and end of the timespan to restore. The end is None if there is no explicit position after dte, as everything from dts onwards will then be calculated again.
+    :rtype: tuple
+    """
+    before = Position.objects.filter(user=user.profile, explicit=True, time__lt=dts).order_by('-time').values_list('time', flat=True).first()
+    after = Position.objects.filter(user=user.profile, explicit=True, time__gt=dte).order_by('time').values_list('time', flat=True).first()
+    if ((before is None) or (before.astimezone(pytz.utc).date() <= archived[-1])):
+        found = archived_neighbour(user, dts, dates=archived)
+        if ((before is None) or ((not(found is None)) and (found > before))):
+            before = found
+    if dte.astimezone(pytz.utc).date() <= archived[-1]:
+        found = archived_neighbour(user, dte, after=True, dates=archived)
+        if ((after is None) or ((not(found is None)) and (found < after))):
+            after = found
+    start = dts - INVALIDATE_EVENT_MARGIN
+    if not(before is None):
+        start = min(start, before)
+    if after is None:
+        return (start, None)
+    return (start, max(dte + INVALIDATE_EVENT_MARGIN, after))
+
+def _import_segments(user, segments, source, method, force, archived, ret):
+    """
+    Imports rows grouped into segments (a dictionary of segment start -> dictionary of time -> (lat, lon, alt)
+    tuples). Segments whose fingerprint matches the one stored when they were last imported from the same source are
+    skipped without reading or writing any positions. The statistics in `ret` are updated in place.
+
+    :return: The archived dates still remaining in the archive.
+    :rtype: list
+    """
+    stored = {}
+    if not(force):
+        stored = dict(ImportSegment.objects.filter(user=user.profile, source=source, time__in=list(segments.keys())).values_list('time', 'fingerprint'))
+    rows = {}
+    fingerprints = []
+    for segment in sorted(segments):
+        fingerprint = _segment_fingerprint(segments[segment])
+        if stored.get(segment, None) == fingerprint:
+            ret['skipped'] = ret['skipped'] + len(segments[segment])
+            continue
+        rows.update(segments[segment])
+        fingerprints.append(ImportSegment(user=user.profile, source=source, time=segment, fingerprint=fingerprint, points=len(segments[segment])))
+    if len(rows) == 0:
+        return archived
+    if len(archived) > 0:
+        # Importing into archived history; bring back the days that are about to be recalculated
+        dts, dte = _restore_span(user, min(rows), max(rows), archived)
+        if ((dts.astimezone(pytz.utc).date() <= archived[-1]) and ((dte is None) or (dte.astimezone(pytz.utc).date() >= archived[0]))):
+            restore_positions(user, dts, dte)
+            archived = [day for day in archived if ((day < dts.astimezone(pytz.utc).date()) or ((not(dte is None)) and (day > dte.astimezone(pytz.utc).date())))]
+    Position.objects.filter(user=user.profile, time__gte=min(rows), time__lte=max(rows), explicit=False).delete()
+    if method == 'row':
+        stats = _import_rows_single(user, rows, source)
+    else:
+        stats = _import_rows_bulk(user, rows, source, upsert=(method == 'upsert'))
+    for k in ['inserted', 'updated', 'skipped']:
+        ret[k] = ret[k] + stats[k]
+    ret['sources'].update(stats['sources'])
+    if not(stats['changed_start'] is None):
+        ret['changed'].append([stats['changed_start'], stats['changed_end']])
+    ImportSegment.objects.filter(user=user.profile, source=source, time__in=[f.time for f in fingerprints]).delete()
+    ImportSegment.objects.bulk_create(fingerprints, batch_size=IMPORT_BATCH_SIZE)
+    return archived
+
+def record_source(user, source, dts, dte, points=0):
+    """
+    Widens the span of time recorded in a user's PositionSource for a source, if necessary, to include dts to dte,
+    and adds to the number of positions from it. Should be called within the same transaction as the positions are
+    written.
+
+    :param source: The source ID of the positions.
+    :param dts: A datetime, the time of the first position written.
+    :param dte: A datetime, the time of the last position written.
+    :param points: The number of explicit positions from the source that have been added.
+    """
+    PositionSource.objects.bulk_create([PositionSource(user=user.profile, source=source, first=dts, last=dte)], ignore_conflicts=True)
+    item = PositionSource.objects.select_for_update().get(user=user.profile, source=source)
+    if ((item.first <= dts) and (item.last >= dte) and (points == 0)):
+        return
+    item.first = min(item.first, dts)
+    item.last = max(item.last, dte)
+    item.points = item.points + points
+    item.save()
+
+def rebuild_sources(user):
+    """
+    Works out every PositionSource for a user from scratch, from their explicit positions in the database (archived
+    positions aren't read). This reads the whole of the position table for the user, so is only needed once, for data
+    imported before sources were recorded.
+
+    :return: The number of sources found.
+    :rtype: int
+    """
+    found = Position.objects.filter(user=user.profile, explicit=True).values('source').annotate(Min('time'), Max('time'), Count('pk'))
+    with transaction.atomic():
+        PositionSource.objects.filter(user=user.profile).delete()
+        PositionSource.objects.bulk_create([PositionSource(user=user.profile, source=item['source'], first=item['time__min'], last=item['time__max'], points=item['pk__count']) for item in found])
+        refresh_stats(user)
+    return len(found)
+
+def import_data(user, data, source='unknown', method='bulk', force=False):
+    """
+    Takes a parsed dataset from parse_file_* and imports the data into the database. The source is just a string to uniquely identify a particular data source, such as 'phone' or 'fitness_tracker'.
+    The dataset may be a list or a generator, and is read and written about IMPORT_BATCH_SIZE rows at a time, so memory use doesn't depend on the size of the file.
+    Each row is either a dictionary with 'date', 'lat', 'lon' and optionally 'alt' keys, or a (date, lat, lon, alt) tuple.
+    Rows are grouped into IMPORT_SEGMENT_SIZE segments, and a segment identical to the one last imported from the same source is skipped, so
+    only the data that has actually changed is written. Only the calculated positions and events around the spans of changed data are thrown
+    away (see invalidate_span); the spans that then need filling in and generating events for again are returned.
+
+    :param method: How to write the data. 'bulk' (the default) uses batched inserts and updates, 'upsert' uses the database's native INSERT ... ON DUPLICATE KEY UPDATE where available, and 'row' saves each position individually.
+    :param force: If True, import every segment, even those that haven't changed since they were last imported.
+    :return: A dictionary containing the number of rows 'inserted', 'updated' and 'skipped', the 'start' and 'end' times of the imported data, the 'changed_start' and 'changed_end' times of the data that changed (None if nothing did), 'changed', a list of [start, end] spans of changed data, 'invalidated', a list of the dictionaries returned by invalidate_span for each of them, and 'sources', a Counter of the change in the number of explicit positions from each source.
+    :rtype: dict
+    """
+    if not(method in IMPORT_METHODS):
+        raise ValueError("Unknown import method: '" + str(method) + "'")
+    ret = {'inserted': 0, 'updated': 0, 'skipped': 0, 'start': None, 'end': None, 'changed_start': None, 'changed_end': None, 'changed': [], 'invalidated': [], 'sources': collections.Counter()}
+    archived = archived_dates(user)
+    segments = {}
+    buffered = 0
+    with transaction.atomic():
+        for row in data:
+            if isinstance(row, dict):
+                row = (row.get('date'), row.get('lat'), row.get('lon'), row.get('alt'))
+            row_dt, lat, lon, alt = row
+            try:
+                lat = float(lat)
+                lon = float(lon)
+                if not(alt is None):
+                    alt = float(alt)
+            except (TypeError, ValueError):
+                ret['skipped'] = ret['skipped'] + 1
+                continue
+            if row_dt is None:
+                ret['skipped'] = ret['skipped'] + 1
+                continue
+            if ((ret['start'] is None) or (row_dt < ret['start'])):
+                ret['start'] = row_dt
+            if ((ret['end'] is None) or (row_dt > ret['end'])):
+                ret['end'] = row_dt
+            segment = _segment_start(row_dt)
+            if not(segment in segments):
+                segments[segment] = {}
+            if row_dt in segments[segment]:
+                ret['skipped'] = ret['skipped'] + 1 # Duplicate timestamps within a file; the last one wins, as it always has
+            segments[segment][row_dt] = (lat, lon, alt)
+            buffered = buffered + 1
+            if ((buffered >= IMPORT_BATCH_SIZE) and (len(segments) > 1)):
+                # Import every segment but the one still being read. Files are almost always in time order; if a
+                # segment turns up again later, the rest of it is imported separately, as if it had changed.
+                current = segments.pop(segment)
+                archived = _import_segments(user, segments, source, method, force, archived, ret)
+                segments = {segment: current}
+                buffered = len(current)
+        if len(segments) > 0:
+            archived = _import_segments(user, segments, source, method, force, archived, ret)
+        if not(ret['start'] is None):
+            record_source(user, source, ret['start'], ret['end'], ret['sources'][source])
+            for other, points in ret['sources'].items():
+                if ((other != source) and (points != 0)):
+                    PositionSource.objects.filter(user=user.profile, source=other).update(points=F('points') + points) # Positions taken over from another source
+            advance_stats(user, last_explicit=ret['end'])
+        if len(ret['changed']) == 0:
+            return ret
+        ret['changed'] = _merge_spans(ret['changed'], INVALIDATE_EVENT_MARGIN * 2)
+        ret['changed_start'] = ret['changed'][0][0]
+        ret['changed_end'] = ret['changed'][-1][1]
+        for span in ret['changed']:
+            ret['invalidated'].append(invalidate_span(user, span[0], span[1]))
+    return ret
+
+def _merge_spans(spans, gap):
+    """ Sorts a list of [start, end] spans, merging any that overlap or are less than `gap` apart. """
+    ret = []
+    for span in sorted(spans):
+        if ((len(ret) > 0) and (span[0] - ret[-1][1] < gap)):
+            ret[-1][1] = max(ret[-1][1], span[1])
+        else:
+            ret.append([span[0], span[1]])
+    return ret
+
+def invalidate_span(user, dts, dte):
+    """
+    Throws away everything calculated from a user's explicit positions that depends on those between dts and dte, after
+    they have changed. This is the calculated positions between the explicit positions either side of the span (or all
+    of them after it, if it is at the end of the data), and the events within INVALIDATE_EVENT_MARGIN of it. Cached
+    position lookups are discarded once the current transaction commits. If the span is after every remaining event
+    and event generation hasn't yet got past it, its watermark is moved back so that the next run generates them
+    again; otherwise they need to be generated again separately, with regenerate_events.
+
+    :param dts: A datetime representing the start of the span.
+    :param dte: A datetime representing the end of the span.
+    :return: A dictionary containing the 'fill_start' and 'fill_end' of the timespan that needs filling in again, and the 'events_start' and 'events_end' of the timespan that needs its events generating again (both None if event generation will catch up by itself).
+    :rtype: dict
+    """
+    ret = {'fill_start': dts, 'fill_end': dte, 'events_start': None, 'events_end': None}
+    before = Position.objects.filter(user=user.profile, explicit=True, time__lt=dts).order_by('-time').values_list('time', flat=True).first()
+    after = Position.objects.filter(user=user.profile, explicit=True, time__gt=dte).order_by('time').values_list('time', flat=True).first()
+    query = Position.objects.filter(user=user.profile, explicit=False)
+    if not(before is None):
+        ret['fill_start'] = before
+        query = query.filter(time__gt=before)
+    if not(after is None):
+        ret['fill_end'] = after
+        query = query.filter(time__lt=after)
+    query.delete()
+    invalidate_end = ret['fill_end']
+    if after is None:
+        invalidate_end = max(invalidate_end, pytz.utc.localize(datetime.datetime.utcnow()))
+    transaction.on_commit(lambda: invalidate_positions(user, ret['fill_start'], invalidate_end))
+
+    events_start = dts - INVALIDATE_EVENT_MARGIN
+    events_end = dte + INVALIDATE_EVENT_MARGIN
+    events = Event.objects.filter(user=user.profile, timeend__gte=events_start, timestart__lte=events_end)
+    extent = events.aggregate(Min('timestart'), Max('timeend'))
+    if not(extent['timestart__min'] is None):
+        events_start = min(events_start, extent['timestart__min']) # Stops that overlap the margin are regenerated in full
+        events_end = max(events_end, extent['timeend__max'])
+    events.delete()
+    watermark = Watermark.objects.filter(user=user.profile, name='events').first()
+    later = Event.objects.filter(user=user.profile, timestart__gt=events_end).exists()
+    if ((not(watermark is None)) and (watermark.time < events_start)):
+        pass # Event generation hasn't reached the span yet, so will generate its events anyway
+    elif ((later) or ((not(watermark is None)) and (watermark.time > events_end))):
+        # Event generation never goes back over a span with events after it, so they must be generated again separately
+        ret['events_start'] = events_start
+        ret['events_end'] = events_end
+        if ((not(watermark is None)) and (watermark.time <= events_end)):
+            watermark.time = events_end # Carry on after the span, rather than finding its stops a second time
+            watermark.state = json.dumps({})
+            watermark.save()
+    else:
+        # Event generation hasn't got past the span, so moving it back to the last remaining event before it is enough
+        restart = Event.objects.filter(user=user.profile).order_by('-timeend').values_list('timeend', flat=True).first()
+        if restart is None:
+            restart = events_start - INVALIDATE_EVENT_MARGIN # Without a watermark, generate_events would start again from now
+        if not(watermark is None):
+            pending = _stop_state_from_json(watermark.state)['pending']
+            if not(pending is None):
+                restart = min(restart, pending[0])
+        Watermark.objects.update_or_create(user=user.profile, name='events', defaults={'time': restart, 'state': json.dumps({})})
+    refresh_stats(user, ['last_calculated', 'last_event']) # Either may have been thrown away
+    return ret
+
+def regenerate_events(user, dts, dte, method=None, max_speed=2, min_length=300):
+    """
+    Generates 'stop' events between dts and dte again, after invalidate_span has thrown the old ones away. Unlike
+    generate_events, this doesn't touch the watermark, so it can be used on any span of history. Positions for
+    INVALIDATE_EVENT_MARGIN either side are read too, so that stops at the very edges are found, but only stops
+    entirely within the span are saved; anything overlapping its edges is an event that was never thrown away.
+
+    :param method: Optional, the stop detector to use, one of stops.STOP_DETECTORS. Defaults to the one chosen in the user's profile.
+    :return: A list of new Event objects that have been created by this function call.
+    :rtype: list
+    """
+    ret = []
+    if method is None:
+        method = user.profile.stop_detector
+    found = detect_stops(load_positions(user, dts - INVALIDATE_EVENT_MARGIN, dte + INVALIDATE_EVENT_MARGIN), method, max_speed=max_speed, min_length=min_length)
+    for i in range(0, len(found['start'])):
+        if ((found['start'][i] < dts.timestamp()) or (found['end'][i] > dte.timestamp())):
+            continue
+        ret.append(create_stop_event(user, datetime.datetime.fromtimestamp(found['start'][i], tz=pytz.utc), datetime.datetime.fromtimestamp(found['end'][i], tz=pytz.utc), float(found['lat'][i]), float(found['lon'][i])))
+    return ret
+
+def file_digest(filename):
+    """ Returns the SHA-256 hash of a file's contents, as a hex string. """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(1048576), b''):
+            h.update(block)
+    return h.hexdigest()
 
 def extrapolate_position(user, dt, source='realtime'):
     """ Returns an approximate position for a specified time for which no explicit location data exists. """
@@ -279,17 +765,246 @@ def extrapolate_position(user, dt, source='realtime'):
 
     return(pos)
 
-def distance(lat1, lon1, lat2, lon2):
-    """ Returns the distance, in metres, between lat1,lon1 and lat2,lon2. """
-    radius = 6371000 # metres
+def position_context(user, dts, dte, padding=POSITION_BATCH_PADDING):
+    """
+    Reads everything needed to calculate a user's position at any time between dts and dte: the positions from
+    `padding` before dts to `padding` after dte, plus the nearest explicit positions outside that if the padding isn't
+    enough to reach one on either side.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param padding: A timedelta, how far either side of the timespan to read positions.
+    :return: A dictionary of numpy arrays, as returned by load_positions with source=True.
+    :rtype: dict
+    """
+    points = load_positions(user, dts - padding, dte + padding, source=True)
+    explicit = points['explicit']
+    edges = []
+    if ((not(explicit.any())) or (points['time'][explicit][0] > dts.timestamp())):
+        edges.append(Position.objects.filter(user=user.profile, explicit=True, time__lt=dts - padding).order_by('-time').values_list('time', 'lat', 'lon', 'speed', 'elevation', 'explicit', 'source').first())
+    if ((not(explicit.any())) or (points['time'][explicit][-1] < dte.timestamp())):
+        edges.append(Position.objects.filter(user=user.profile, explicit=True, time__gt=dte + padding).order_by('time').values_list('time', 'lat', 'lon', 'speed', 'elevation', 'explicit', 'source').first())
+    points['source'] = points['source'].astype(object)
+    for edge in edges:
+        if edge is None:
+            continue
+        i = np.searchsorted(points['time'], edge[0].timestamp())
+        points['time'] = np.insert(points['time'], i, edge[0].timestamp())
+        for k, v in [('lat', edge[1]), ('lon', edge[2]), ('speed', edge[3]), ('elevation', edge[4]), ('explicit', edge[5]), ('source', edge[6])]:
+            points[k] = np.insert(points[k], i, (np.nan if v is None else v))
+    return points
+
+def interpolate_points(user, points, times, source='realtime'):
+    """
+    Calculates the user's position at each of a list of times, from positions already read by position_context. Where
+    a position exists at exactly that time it is returned as it is; otherwise one is interpolated between the explicit
+    positions either side, and its speed calculated from the position before it, as extrapolate_position and
+    calculate_speed would. Nothing is read from or written to the database.
+
+    :param points: A dictionary of numpy arrays, as returned by position_context.
+    :param times: A list of datetimes, in time order, that lie within the timespan passed to position_context.
+    :param source: The source ID given to interpolated positions.
+    :return: A list of unsaved Position objects, one for each of `times`, or None where there is no data either side of a time.
+    :rtype: list
+    """
+    n = len(points['time'])
+    if n == 0:
+        return [None for dt in times]
+    explicit = points['explicit']
+    ex_times = points['time'][explicit]
+
+    t = np.array([dt.timestamp() for dt in times], dtype=np.float64)
+    i = np.searchsorted(points['time'], t, side='left')
+    at = np.minimum(i, n - 1)
+    exact = points['time'][at] == t
+    j = np.searchsorted(ex_times, t, side='right')
+    covered = exact | ((j > 0) & (j < len(ex_times)))
+    lats = points['lat'][at]
+    lons = points['lon'][at]
+    if len(ex_times) > 0:
+        lats = np.where(exact, lats, np.interp(t, ex_times, points['lat'][explicit]))
+        lons = np.where(exact, lons, np.interp(t, ex_times, points['lon'][explicit]))
+
+    # Speed is taken from the stored value if there is one, otherwise from the position before.
+    prev = np.maximum(i - 1, 0)
+    elapsed = t - points['time'][prev]
+    dist = haversine(points['lat'][prev], points['lon'][prev], lats, lons)
+    speeds = np.where(i > 0, np.divide(dist, elapsed, out=np.zeros(len(t)), where=elapsed > 0) * 2.237, np.nan)
+    speeds = np.where(exact & ~np.isnan(points['speed'][at]), points['speed'][at], speeds)
+
+    cells = grid_cells(lats, lons)
+    ret = []
+    for k in range(0, len(times)):
+        if not(covered[k]):
+            ret.append(None)
+            continue
+        speed = None if np.isnan(speeds[k]) else int(speeds[k])
+        if exact[k]:
+            pos = Position(user=user.profile, time=times[k], lat=float(lats[k]), lon=float(lons[k]), speed=speed, explicit=bool(explicit[at[k]]), source=str(points['source'][at[k]]), cell=int(cells[k]))
+            elevation = points['elevation'][at[k]]
+            pos.elevation = None if np.isnan(elevation) else float(elevation)
+        else:
+            pos = Position(user=user.profile, time=times[k], lat=float(lats[k]), lon=float(lons[k]), speed=speed, explicit=False, source=source, cell=int(cells[k]))
+        ret.append(pos)
+    return ret
+
+def interpolate_positions(user, times, save=False, source='realtime'):
+    """
+    Returns the user's position at each of a list of times, calculated by interpolate_points. Times close together
+    are grouped, and the positions around each group read with a single range query, so the number of queries depends
+    on how spread out the times are rather than on how many there are.
+
+    :param times: A list of datetimes.
+    :param save: Optional, if True the interpolated positions are also saved to the database.
+    :param source: The source ID given to interpolated positions.
+    :return: A list of Position objects, one for each of `times` in the same order. Where there is no data either side of a time, its entry is None.
+    :rtype: list
+    """
+    found = {}
+    wanted = sorted(set(times))
+    groups = []
+    for dt in wanted:
+        if ((len(groups) == 0) or (dt - groups[-1][-1] > POSITION_BATCH_GAP)):
+            groups.append([])
+        groups[-1].append(dt)
+
+    new_positions = []
+    for group in groups:
+        points = position_context(user, group[0], group[-1])
+        for dt, pos in zip(group, interpolate_points(user, points, group, source)):
+            found[dt] = pos
+            if ((not(pos is None)) and (pos.source == source) and (not(pos.explicit))):
+                new_positions.append(pos)
+
+    if ((save) and (len(new_positions) > 0)):
+        Position.objects.bulk_create(new_positions, batch_size=IMPORT_BATCH_SIZE, ignore_conflicts=True)
+    return [found[dt] for dt in times]
+
+def _position_cache_version(user, dts, dte):
+    """ Returns the part of a position cache key that changes whenever invalidate_positions is called for any of the days (UTC) between dts and dte. """
+    keys = ['position_version_' + str(user.pk)]
+    day = dts.astimezone(pytz.utc).date()
+    while day <= dte.astimezone(pytz.utc).date():
+        keys.append('position_version_' + str(user.pk) + '_' + day.strftime('%Y%m%d'))
+        day = day + datetime.timedelta(days=1)
+    versions = cache.get_many(keys)
+    return '_'.join([str(versions.get(key, 0)) for key in keys])
+
+def invalidate_positions(user, dts, dte):
+    """
+    Discards any cached position lookups for the days (UTC) between dts and dte. Must be called whenever positions in
+    the timespan are added, changed or removed. Long timespans discard everything cached for the user. The days'
+    summaries are discarded too, so that they are read from the raw positions until update_day_summaries has built
+    them again.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    """
+    DaySummary.objects.filter(user=user.profile, date__gte=dts.astimezone(pytz.utc).date(), date__lte=dte.astimezone(pytz.utc).date()).delete()
+    version = time.time_ns()
+    if dte - dts > POSITION_CACHE_MAX_INVALIDATE:
+        cache.set('position_version_' + str(user.pk), version, None)
+        return
+    day = dts.astimezone(pytz.utc).date()
+    versions = {}
+    while day <= dte.astimezone(pytz.utc).date():
+        versions['position_version_' + str(user.pk) + '_' + day.strftime('%Y%m%d')] = version
+        day = day + datetime.timedelta(days=1)
+    cache.set_many(versions, None)
+
+def get_position(user, dt):
+    """
+    Returns the user's position at a particular time, without writing anything to the database. The positions
+    needed to calculate it are cached for each POSITION_CACHE_BUCKET of time, so nearby lookups don't need to go to
+    the database at all.
+
+    :param dt: A datetime.
+    :return: An unsaved Position object, or None if no position can be calculated for the time.
+    :rtype: Position
+    """
+    bucket = int(dt.timestamp() // POSITION_CACHE_BUCKET.total_seconds()) * int(POSITION_CACHE_BUCKET.total_seconds())
+    dts = datetime.datetime.fromtimestamp(bucket, tz=pytz.utc)
+    # The padding either side of the bucket may cross midnight, so the positions depend on every day it touches
+    key = 'position_context_' + str(user.pk) + '_' + str(bucket) + '_' + _position_cache_version(user, dts - POSITION_CACHE_BUCKET, dts + (POSITION_CACHE_BUCKET * 2))
+    points = cache.get(key)
+    if points is None:
+        points = position_context(user, dts, dts + POSITION_CACHE_BUCKET, POSITION_CACHE_BUCKET)
+        cache.set(key, points, POSITION_CACHE_TIMEOUT)
+    return interpolate_points(user, points, [dt])[0]
+
+def fill_gaps(user, dts, dte, source='cron', interval=60):
+    """
+    Ensures there is a Position for every `interval` seconds between dts and dte, calculating any that are missing
+    by interpolating between the explicit positions either side. All the positions in the window are loaded once,
+    the missing slots and their speeds are worked out in a single pass and the new positions are bulk inserted.
+
+    :param dts: A datetime representing the first slot to be filled.
+    :param dte: A datetime representing the end of the timespan. No slot is created at or after this time.
+    :param source: The source ID given to the calculated positions.
+    :param interval: The gap, in seconds, between each slot.
+    :return: The number of new Position objects created.
+    :rtype: int
+    """
+    slots = np.arange(dts.timestamp(), dte.timestamp(), interval, dtype=np.float64)
+    if len(slots) == 0:
+        return 0
+
+    rows = list(Position.objects.filter(user=user.profile, time__gte=dts, time__lt=dte).order_by('time').values_list('time', 'lat', 'lon', 'explicit'))
+    before = Position.objects.filter(user=user.profile, time__lt=dts).order_by('-time').values_list('time', 'lat', 'lon', 'explicit').first()
+    after = Position.objects.filter(user=user.profile, time__gte=dte, explicit=True).order_by('time').values_list('time', 'lat', 'lon', 'explicit').first()
+    if not(before is None):
+        rows.insert(0, before)
+        if not(before[3]):
+            before = Position.objects.filter(user=user.profile, time__lt=dts, explicit=True).order_by('-time').values_list('time', 'lat', 'lon', 'explicit').first()
+            if not(before is None):
+                rows.insert(0, before)
+    if not(after is None):
+        rows.append(after)
+    if len(rows) == 0:
+        return 0
+    times = np.array([row[0].timestamp() for row in rows], dtype=np.float64)
+    lats = np.array([row[1] for row in rows], dtype=np.float64)
+    lons = np.array([row[2] for row in rows], dtype=np.float64)
+    explicit = np.array([row[3] for row in rows], dtype=bool)
+
+    # A slot needs filling if no position exists at exactly that time, and it falls between two explicit positions.
+    i = np.searchsorted(times, slots)
+    found = np.zeros(len(slots), dtype=bool)
+    found[i < len(times)] = times[i[i < len(times)]] == slots[i < len(times)]
+    ex_times = times[explicit]
+    if len(ex_times) < 2:
+        return 0
+    slots = slots[(~found) & (slots > ex_times[0]) & (slots < ex_times[-1])]
+    if len(slots) == 0:
+        return 0
+    slot_lats = np.interp(slots, ex_times, lats[explicit])
+    slot_lons = np.interp(slots, ex_times, lons[explicit])
 
-    dlat = math.radians(lat2-lat1)
-    dlon = math.radians(lon2-lon1)
-    a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    d = radius * c
+    # Speed is calculated from the position immediately before each new one, which may be another new one.
+    all_times = np.concatenate((times, slots))
+    all_lats = np.concatenate((lats, slot_lats))
+    all_lons = np.concatenate((lons, slot_lons))
+    order = np.argsort(all_times, kind='stable')
+    new_index = np.flatnonzero(order >= len(times))
+    new_index = new_index[new_index > 0]
+    prev = order[new_index - 1]
+    cur = order[new_index]
+    elapsed = all_times[cur] - all_times[prev]
+    dist = haversine(all_lats[prev], all_lons[prev], all_lats[cur], all_lons[cur])
+    speeds = np.zeros(len(all_times), dtype=np.float64)
+    speeds[cur] = np.divide(dist, elapsed, out=np.zeros(len(cur)), where=elapsed > 0) * 2.237 # miles per hour
 
-    return(d)
+    slot_cells = grid_cells(slot_lats, slot_lons)
+    new_positions = []
+    for j in range(0, len(slots)):
+        dt = datetime.datetime.fromtimestamp(slots[j], tz=pytz.utc)
+        new_positions.append(Position(user=user.profile, time=dt, lat=slot_lats[j], lon=slot_lons[j], speed=int(speeds[len(times) + j]), explicit=False, source=source, cell=int(slot_cells[j])))
+    Position.objects.bulk_create(new_positions, batch_size=IMPORT_BATCH_SIZE, ignore_conflicts=True)
+    if source == 'cron':
+        advance_stats(user, last_calculated=new_positions[-1].time)
+    invalidate_positions(user, dts, dte)
+
+    return len(new_positions)
 
 def calculate_speed(pos):
     """ Calculates the speed being travelled by the user for a particular Position (which presumably has no existing speed data). """
@@ -304,6 +1019,48 @@ def calculate_speed(pos):
     
     return((dist / time) * 2.237) # Return in miles per hour
 
+def calculate_speeds(user, dts, dte, overwrite=False):
+    """
+    Calculates the speed being travelled by the user for every Position between dts and dte. Unlike calculate_speed,
+    the positions are read once in time order and the speeds for all of them worked out between neighbours in a
+    single pass, then written back with bulk_update.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param overwrite: If True, recalculate every speed in the timespan. Otherwise only positions with no speed are updated.
+    :return: The number of Position objects updated.
+    :rtype: int
+    """
+    prev = Position.objects.filter(user=user.profile, time__lt=dts).order_by('-time').values_list('time', 'lat', 'lon').first()
+    query = Position.objects.filter(user=user.profile, time__gte=dts, time__lte=dte).order_by('time').values_list('pk', 'time', 'lat', 'lon', 'speed')
+    pks = []
+    speeds = []
+    for chunk in _chunks(query.iterator(chunk_size=SPEED_CHUNK_SIZE), SPEED_CHUNK_SIZE):
+        if prev is None:
+            prev = chunk[0][1:4]
+        times = np.array([prev[0].timestamp()] + [row[1].timestamp() for row in chunk], dtype=np.float64)
+        lats = np.array([prev[1]] + [row[2] for row in chunk], dtype=np.float64)
+        lons = np.array([prev[2]] + [row[3] for row in chunk], dtype=np.float64)
+        elapsed = np.diff(times)
+        dist = distances(lats, lons)
+        speed = (np.divide(dist, elapsed, out=np.zeros(len(chunk)), where=elapsed > 0) * 2.237).astype(np.int64) # miles per hour
+        old_speed = np.array([(-1 if row[4] is None else row[4]) for row in chunk], dtype=np.int64)
+        if overwrite:
+            changed = speed != old_speed
+        else:
+            changed = old_speed == -1
+        pks.append(np.array([row[0] for row in chunk], dtype=np.int64)[changed])
+        speeds.append(speed[changed])
+        prev = chunk[-1][1:4]
+    if len(pks) == 0:
+        return 0
+    pks = np.concatenate(pks)
+    speeds = np.concatenate(speeds)
+    with transaction.atomic():
+        Position.objects.bulk_update([Position(pk=int(pks[i]), speed=int(speeds[i])) for i in range(0, len(pks))], ['speed'], batch_size=IMPORT_BATCH_SIZE)
+    invalidate_positions(user, dts, dte)
+    return len(pks)
+
 def populate(user):
     """ A function to be called from a background process that goes through the database ensuring there is at least one Position object for each minute of time, even if it has to calculate them. """
     try:
@@ -329,58 +1086,6 @@ def populate(user):
     else:
         return(False)
 
-def get_source_ids():
-    """ Returns a list of all the strings relating to data sources that have been used to import data into the database. """
-    if cache.has_key('all_source_ids'):
-        ret = cache.get('all_source_ids')
-    else:
-        ret = []
-        for data in Position.objects.values('source').distinct():
-            ret.append(data['source'])
-        cache.set('all_source_ids', ret, 86400)
-
-    return ret
-
-def nearest_amenities(lat, lon, dist=100):
-    """
-    Query OpenStreetMap to get the nearest amenities to the point specified.
-
-    :param lat: The latitude of the query point.
-    :param lon: The longitude of the query point.
-    :param dist: The distance from the query point to search.
-    :return: A list of dictionaries, each representing an amenity listed in OpenStreetMap.
-    :rtype: list
-
-    """
-    ret = []
-    api = overpy.Overpass()
-    query = "[out:json]; nwr[amenity](around:" + str(dist) + "," + str(lat) + "," + str(lon) + "); out center;"
-    result = api.query(query)
-    for node in result.nodes:
-        item = dict(node.tags)
-        if 'name' in item:
-            item['lat'] = float(node.lat)
-            item['lon'] = float(node.lon)
-            ret.append(item)
-    for way in result.ways:
-        item = dict(way.tags)
-        if 'name' in item:
-            item['lat'] = float(way.center_lat)
-            item['lon'] = float(way.center_lon)
-            ret.append(item)
-    query = "[out:json]; nwr[leisure](around:" + str(dist) + "," + str(lat) + "," + str(lon) + "); out center;"
-    result = api.query(query)
-    for node in result.nodes:
-        item = dict(node.tags)
-        if 'name' in item:
-            item['lat'] = float(node.lat)
-            item['lon'] = float(node.lon)
-            ret.append(item)
-    for way in result.ways:
-        item = dict(way.tags)
-        if 'name' in item:
-            item['lat'] = float(way.center_lat)
-            item['lon'] = float(way.center_lon)
-            ret.append(item)
-    return ret
-
+def get_source_ids(user):
+    """ Returns a list of all the strings relating to data sources that have been used to import data for a user, from their PositionSources. """
+    return list(PositionSource.objects.filter(user=user.profile).order_by('source').values_list('source', flat=True))
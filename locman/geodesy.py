@@ -0,0 +1,185 @@
+import numpy as np
+import math, heapq
+
+EARTH_RADIUS = 6371000 # metres
+GRID_CELL_SIZE = 0.05 # degrees
+GRID_COLUMNS = int(round(360 / GRID_CELL_SIZE))
+GRID_ROWS = int(round(180 / GRID_CELL_SIZE))
+
+def distance(lat1, lon1, lat2, lon2):
+    """ Returns the distance, in metres, between lat1,lon1 and lat2,lon2. """
+    dlat = math.radians(lat2-lat1)
+    dlon = math.radians(lon2-lon1)
+    a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2)
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    d = EARTH_RADIUS * c
+
+    return(d)
+
+def haversine(lat1, lon1, lat2, lon2):
+    """
+    Array version of distance(). Each argument may be a float or a numpy array of float64 values in degrees, and the
+    usual numpy broadcasting rules apply.
+
+    :return: A numpy array of the distances, in metres, between each lat1,lon1 and lat2,lon2.
+    :rtype: numpy.ndarray
+    """
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlat = lat2 - lat1
+    dlon = np.radians(lon2) - np.radians(lon1)
+    a = np.sin(dlat/2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+    return(EARTH_RADIUS * c)
+
+def distances(lats, lons):
+    """
+    Returns the distance, in metres, between each pair of consecutive points in a track.
+
+    :param lats: A numpy array of latitudes.
+    :param lons: A numpy array of longitudes, the same length as lats.
+    :return: A numpy array one element shorter than lats, where element i is the distance from point i to point i + 1.
+    :rtype: numpy.ndarray
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if len(lats) < 2:
+        return np.zeros(0, dtype=np.float64)
+    return haversine(lats[:-1], lons[:-1], lats[1:], lons[1:])
+
+def distances_to(lats, lons, lat, lon):
+    """
+    Returns the distance, in metres, from each point in a track to a single point lat,lon.
+
+    :param lats: A numpy array of latitudes.
+    :param lons: A numpy array of longitudes, the same length as lats.
+    :return: A numpy array the same length as lats.
+    :rtype: numpy.ndarray
+    """
+    return haversine(np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64), float(lat), float(lon))
+
+def cumulative_distance(lats, lons):
+    """
+    Returns the distance, in metres, travelled along a track up to each of its points.
+
+    :param lats: A numpy array of latitudes.
+    :param lons: A numpy array of longitudes, the same length as lats.
+    :return: A numpy array the same length as lats, starting at zero.
+    :rtype: numpy.ndarray
+    """
+    ret = np.zeros(len(lats), dtype=np.float64)
+    if len(lats) > 1:
+        np.cumsum(distances(lats, lons), out=ret[1:])
+    return ret
+
+def bearings(lats, lons):
+    """
+    Returns the initial bearing, in degrees clockwise from north, from each point in a track to the next.
+
+    :param lats: A numpy array of latitudes.
+    :param lons: A numpy array of longitudes, the same length as lats.
+    :return: A numpy array one element shorter than lats, with values between 0 and 360.
+    :rtype: numpy.ndarray
+    """
+    lats = np.radians(np.asarray(lats, dtype=np.float64))
+    lons = np.radians(np.asarray(lons, dtype=np.float64))
+    if len(lats) < 2:
+        return np.zeros(0, dtype=np.float64)
+    dlon = lons[1:] - lons[:-1]
+    y = np.sin(dlon) * np.cos(lats[1:])
+    x = np.cos(lats[:-1]) * np.sin(lats[1:]) - np.sin(lats[:-1]) * np.cos(lats[1:]) * np.cos(dlon)
+    return np.degrees(np.arctan2(y, x)) % 360
+
+def simplify(lats, lons, tolerance=0.0, max_points=None, starts=None):
+    """
+    Simplifies one or more tracks using the Douglas-Peucker algorithm. The most significant points are found first,
+    so the algorithm can stop as soon as the remaining points are all within `tolerance` of the simplified line, or
+    as soon as `max_points` points have been chosen, whichever comes first. The first and last point of each track are
+    always kept.
+
+    :param lats: A numpy array of latitudes.
+    :param lons: A numpy array of longitudes, the same length as lats.
+    :param tolerance: The distance, in degrees, that a point may be from the simplified line before it must be kept.
+    :param max_points: Optional, the maximum number of points to keep.
+    :param starts: Optional, a list of the indices at which each track starts, if lats and lons contain more than one.
+    :return: A numpy boolean array the same length as lats, True for each point that should be kept.
+    :rtype: numpy.ndarray
+    """
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    n = len(lats)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    if starts is None:
+        starts = [0]
+    bounds = list(starts) + [n]
+    heap = []
+    for i in range(0, len(bounds) - 1):
+        a = bounds[i]
+        b = bounds[i + 1] - 1
+        keep[a] = True
+        keep[b] = True
+        _simplify_push(heap, lats, lons, a, b)
+    kept = int(np.count_nonzero(keep))
+    while len(heap) > 0:
+        if ((not(max_points is None)) and (kept >= max_points)):
+            break
+        d, a, b, i = heapq.heappop(heap)
+        if -d <= tolerance:
+            break
+        keep[i] = True
+        kept = kept + 1
+        _simplify_push(heap, lats, lons, a, i)
+        _simplify_push(heap, lats, lons, i, b)
+    return keep
+
+def _simplify_push(heap, lats, lons, a, b):
+    """ Finds the point between a and b furthest from the line joining them, and adds it to the heap used by simplify(). """
+    if b - a < 2:
+        return
+    x = lons[a + 1:b] - lons[a]
+    y = lats[a + 1:b] - lats[a]
+    dx = lons[b] - lons[a]
+    dy = lats[b] - lats[a]
+    norm = math.hypot(dx, dy)
+    if norm == 0.0:
+        d = np.hypot(x, y)
+    else:
+        d = np.abs((dy * x) - (dx * y)) / norm
+    i = int(np.argmax(d))
+    heapq.heappush(heap, (-float(d[i]), a, b, a + 1 + i))
+
+def zoom_tolerance(zoom):
+    """ Returns the width, in degrees, of a single pixel on a standard 256 pixel tiled map at the specified zoom level. """
+    return 360.0 / (256 * math.pow(2, zoom))
+
+def grid_cells(lats, lons):
+    """
+    Returns the number of the grid cell containing each point. The grid divides the world into squares of
+    GRID_CELL_SIZE degrees, numbered in rows from the south west corner, so nearby points can be found with an index
+    lookup on a handful of cell numbers rather than a range query on latitude and longitude.
+
+    :param lats: A numpy array of latitudes.
+    :param lons: A numpy array of longitudes, the same length as lats.
+    :return: A numpy array of int64 cell numbers, the same length as lats.
+    :rtype: numpy.ndarray
+    """
+    rows = np.clip(np.floor((np.asarray(lats, dtype=np.float64) + 90) / GRID_CELL_SIZE), 0, GRID_ROWS - 1)
+    columns = np.clip(np.floor((np.asarray(lons, dtype=np.float64) + 180) / GRID_CELL_SIZE), 0, GRID_COLUMNS - 1)
+    return (rows * GRID_COLUMNS + columns).astype(np.int64)
+
+def grid_cell(lat, lon):
+    """ Returns the number of the grid cell containing lat,lon. Scalar version of grid_cells(). """
+    return int(grid_cells([lat], [lon])[0])
+
+def grid_cells_in_box(minlat, minlon, maxlat, maxlon):
+    """ Returns a list of the numbers of every grid cell that overlaps a bounding box. """
+    ret = []
+    first = grid_cell(minlat, minlon)
+    last = grid_cell(maxlat, maxlon)
+    for row in range(first // GRID_COLUMNS, (last // GRID_COLUMNS) + 1):
+        for column in range(first % GRID_COLUMNS, (last % GRID_COLUMNS) + 1):
+            ret.append(row * GRID_COLUMNS + column)
+    return ret
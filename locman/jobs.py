@@ -0,0 +1,102 @@
+from django.db import transaction
+from .models import Job
+import datetime, pytz
+
+JOB_STAGES = ['import', 'refill', 'fill', 'events', 'enrich']
+JOB_COUNTED = ['import', 'refill'] # Each request for these is a separate piece of work; requests for the other stages are coalesced
+JOB_DEPENDENCIES = {'fill': ['import'], 'events': ['import', 'refill', 'fill']} # Stages that must be finished before each stage can start
+JOB_LEASE = datetime.timedelta(hours=6) # After this long, a stage is assumed to have crashed and stops blocking anything else
+
+def _lock_jobs(user):
+    """ Locks, and returns as a dictionary keyed by stage, all of a user's Job rows. Must be called within a transaction. """
+    Job.objects.bulk_create([Job(user=user.profile, stage=stage) for stage in JOB_STAGES], ignore_conflicts=True)
+    return {job.stage: job for job in Job.objects.select_for_update().filter(user=user.profile).order_by('stage')}
+
+def _is_running(job, now):
+    return ((job.running) and (not(job.lease is None)) and (job.lease > now))
+
+def _is_pending(job, now):
+    return ((job.pending > 0) and (job.updated + JOB_LEASE > now))
+
+def _is_blocked(jobs, stage, now):
+    """ Returns True if any stage that `stage` depends on is still waiting to run or running. """
+    for dependency in JOB_DEPENDENCIES.get(stage, []):
+        if ((_is_pending(jobs[dependency], now)) or (_is_running(jobs[dependency], now))):
+            return True
+    return False
+
+def request_job(user, stage):
+    """
+    Records that a stage of a user's processing needs to run. Requests for a stage that is already waiting to run
+    are coalesced into one, and a stage that can't start yet is started by finish_job once what it depends on has
+    finished, so the caller only needs to queue the task if this returns True.
+
+    :param stage: One of JOB_STAGES.
+    :return: True if the task for the stage should be queued now.
+    :rtype: bool
+    """
+    now = datetime.datetime.now(tz=pytz.utc)
+    with transaction.atomic():
+        jobs = _lock_jobs(user)
+        job = jobs[stage]
+        if stage in JOB_COUNTED:
+            job.pending = job.pending + 1
+            job.save()
+            return True
+        if _is_pending(job, now):
+            return False # Already asked for, and will be run
+        job.pending = 1
+        job.save()
+        return ((not(_is_running(job, now))) and (not(_is_blocked(jobs, stage, now))))
+
+def start_job(user, stage):
+    """
+    Called by a task before it starts work on a stage of a user's processing. Counted stages always start; other
+    stages only start if they have been requested, aren't already running and aren't waiting for another stage.
+
+    :param stage: One of JOB_STAGES.
+    :return: True if the task should go ahead, or False if it should quietly return, as it will be run again when needed.
+    :rtype: bool
+    """
+    now = datetime.datetime.now(tz=pytz.utc)
+    with transaction.atomic():
+        jobs = _lock_jobs(user)
+        job = jobs[stage]
+        if stage in JOB_COUNTED:
+            job.running = True
+            job.lease = now + JOB_LEASE
+            job.save()
+            return True
+        if ((not(_is_pending(job, now))) or (_is_running(job, now)) or (_is_blocked(jobs, stage, now))):
+            return False
+        job.pending = 0
+        job.running = True
+        job.lease = now + JOB_LEASE
+        job.save()
+        return True
+
+def finish_job(user, stage):
+    """
+    Called by a task when it has finished work on a stage of a user's processing, whether or not it succeeded.
+
+    :param stage: One of JOB_STAGES.
+    :return: A list of the stages that were waiting for this one (or were requested again while it ran) and can now start. The caller should queue their tasks.
+    :rtype: list
+    """
+    now = datetime.datetime.now(tz=pytz.utc)
+    ret = []
+    with transaction.atomic():
+        jobs = _lock_jobs(user)
+        job = jobs[stage]
+        if stage in JOB_COUNTED:
+            job.pending = max(job.pending - 1, 0)
+        job.running = ((stage in JOB_COUNTED) and (job.pending > 0))
+        if not(job.running):
+            job.lease = None
+        job.save()
+        for other in JOB_STAGES:
+            if ((other in JOB_COUNTED) or ((other != stage) and (not(stage in JOB_DEPENDENCIES.get(other, []))))):
+                continue # Anything else will have been queued already, or will be queued when whatever it's waiting for finishes
+            if ((_is_pending(jobs[other], now)) and (not(_is_running(jobs[other], now))) and (not(_is_blocked(jobs, other, now)))):
+                ret.append(other)
+    return ret
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from locman.archive import archive_positions, restore_positions, archive_age
+import sys, datetime, dateutil.parser, pytz
+
+class Command(BaseCommand):
+	"""
+	Command for moving old positions out of the database and into the compressed archive, or bringing them back again.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="The username of the user whose positions are to be archived.")
+		parser.add_argument("-d", "--days", action="store", dest="days", default="", help="Archive positions older than this many days. Defaults to the LOCMAN_ARCHIVE_DAYS setting.")
+		parser.add_argument("-r", "--restore", action="store", dest="restore_time", default="", help="Instead of archiving, move archived positions from this time onwards (ISO 8601, UTC) back into the database.")
+
+	def handle(self, *args, **kwargs):
+
+		try:
+			user = User.objects.get(username=kwargs['input_user'])
+		except User.DoesNotExist:
+			sys.stderr.write(self.style.ERROR("A valid user must be specified using the --user switch. See help for more details.\n"))
+			sys.exit(1)
+
+		if kwargs['restore_time'] != '':
+			try:
+				dts = dateutil.parser.parse(kwargs['restore_time'])
+			except ValueError:
+				sys.stderr.write(self.style.ERROR("Could not understand the date given. Use ISO 8601 format, eg 2023-01-01T00:00:00.\n"))
+				sys.exit(1)
+			if dts.tzinfo is None:
+				dts = pytz.utc.localize(dts)
+			count = restore_positions(user, dts)
+			sys.stdout.write(self.style.SUCCESS(str(count) + " positions restored\n"))
+			return
+
+		age = archive_age()
+		if kwargs['days'] != '':
+			age = datetime.timedelta(days=int(kwargs['days']))
+		if age is None:
+			sys.stderr.write(self.style.ERROR("Archiving is switched off. Set LOCMAN_ARCHIVE_DAYS in settings_local.py or use the --days switch.\n"))
+			sys.exit(1)
+
+		count = archive_positions(user, datetime.datetime.now(tz=pytz.utc) - age)
+		sys.stdout.write(self.style.SUCCESS(str(count) + " positions archived\n"))
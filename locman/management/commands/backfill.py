@@ -0,0 +1,110 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max, Min
+from locman.models import Position, Event, Watermark, BackfillPartition
+from locman.backfill import BACKFILL_PARTITION_SIZES, backfill_partitions, backfill_partition
+from locman.stops import STOP_DETECTORS
+from locman.jobs import request_job, start_job, finish_job
+from locman.stats import refresh_stats
+from locman.workers import worker_count, start_worker
+from locman.tasks import queue_job, STAGE_TASKS
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing, sys, dateutil.parser, pytz, time, json
+
+class Command(BaseCommand):
+	"""
+	Command for filling in the gaps, calculating the speeds and generating the events for the whole of a user's history in one go, a lot
+	more quickly than the background tasks can. The history is split into partitions that are processed in parallel, and each partition
+	is recorded as it is finished, so if the command is stopped it carries on where it left off next time.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="The username of the user whose history is to be processed.")
+		parser.add_argument("-s", "--start", action="store", dest="start_time", default="", help="The start of the timespan, in ISO 8601 format, UTC. Defaults to the user's earliest position.")
+		parser.add_argument("-e", "--end", action="store", dest="end_time", default="", help="The end of the timespan, in ISO 8601 format, UTC. Defaults to the user's latest position.")
+		parser.add_argument("-p", "--partition", action="store", dest="partition", default="week", help="The size of each partition, one of " + ", ".join(BACKFILL_PARTITION_SIZES.keys()) + ". Defaults to week.")
+		parser.add_argument("-w", "--workers", action="store", dest="workers", default="", help="The number of worker processes. Defaults to LOCMAN_WORKERS, or the number of CPUs.")
+		parser.add_argument("-m", "--method", action="store", dest="method", default="", help="The stop detector to use, one of " + ", ".join(STOP_DETECTORS) + ". Defaults to the one chosen in the user's profile.")
+		parser.add_argument("--rebuild", action="store_true", dest="rebuild", help="Throw away the calculated positions, events and finished partitions within the timespan first, and start again from scratch.")
+
+	def handle(self, *args, **kwargs):
+
+		try:
+			user = User.objects.get(username=kwargs['input_user'])
+		except User.DoesNotExist:
+			sys.stderr.write(self.style.ERROR("A valid user must be specified using the --user switch. See help for more details.\n"))
+			sys.exit(1)
+
+		if not(kwargs['partition'] in BACKFILL_PARTITION_SIZES):
+			sys.stderr.write(self.style.ERROR("Unknown partition size '" + kwargs['partition'] + "'. Use one of " + ", ".join(BACKFILL_PARTITION_SIZES.keys()) + ".\n"))
+			sys.exit(1)
+		method = kwargs['method']
+		if method == '':
+			method = user.profile.stop_detector
+		if not(method in STOP_DETECTORS):
+			sys.stderr.write(self.style.ERROR("Unknown stop detector '" + method + "'. Use one of " + ", ".join(STOP_DETECTORS) + ".\n"))
+			sys.exit(1)
+		try:
+			workers = worker_count() if kwargs['workers'] == '' else max(int(kwargs['workers']), 1)
+		except ValueError:
+			sys.stderr.write(self.style.ERROR("The number of workers must be a number.\n"))
+			sys.exit(1)
+
+		extent = Position.objects.filter(user=user.profile).aggregate(Min('time'), Max('time'))
+		if extent['time__min'] is None:
+			sys.stderr.write(self.style.ERROR("No location data found for '" + user.username + "'\n"))
+			sys.exit(1)
+		dts = extent['time__min']
+		dte = extent['time__max']
+		try:
+			if kwargs['start_time'] != '':
+				dts = dateutil.parser.parse(kwargs['start_time'])
+			if kwargs['end_time'] != '':
+				dte = dateutil.parser.parse(kwargs['end_time'])
+		except ValueError:
+			sys.stderr.write(self.style.ERROR("Could not understand the dates given. Use ISO 8601 format, eg 2023-01-01T00:00:00.\n"))
+			sys.exit(1)
+		if dts.tzinfo is None:
+			dts = pytz.utc.localize(dts)
+		if dte.tzinfo is None:
+			dte = pytz.utc.localize(dte)
+
+		partitions = backfill_partitions(dts, dte, kwargs['partition'])
+		if kwargs['rebuild']:
+			with transaction.atomic():
+				Position.objects.filter(user=user.profile, explicit=False, source='cron', time__gte=partitions[0][0], time__lt=partitions[-1][1]).delete()
+				Event.objects.filter(user=user.profile, timestart__gte=partitions[0][0], timestart__lt=partitions[-1][1]).delete()
+				BackfillPartition.objects.filter(user=user.profile, start__gte=partitions[0][0], start__lt=partitions[-1][1]).delete()
+		finished = list(BackfillPartition.objects.filter(user=user.profile, start__lt=partitions[-1][1], end__gt=partitions[0][0]).values_list('start', 'end'))
+		todo = [p for p in partitions if not(any([((p[0] >= f[0]) and (p[1] <= f[1])) for f in finished]))]
+		sys.stdout.write(str(len(partitions)) + " partitions, " + str(len(partitions) - len(todo)) + " already done, using " + str(workers) + " workers\n")
+
+		# Hold the user's background processing back while the backfill runs, as if it were a very big import.
+		request_job(user, 'import')
+		start_job(user, 'import')
+		positions = 0
+		events = 0
+		start = time.time()
+		try:
+			with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=start_worker) as pool:
+				futures = [pool.submit(backfill_partition, user.pk, p[0].timestamp(), p[1].timestamp(), extent['time__min'].timestamp(), extent['time__max'].timestamp(), method) for p in todo]
+				for n, future in enumerate(as_completed(futures)):
+					result = future.result()
+					positions = positions + result['positions']
+					events = events + result['events']
+					start_job(user, 'import') # Renews the lease, so that the background tasks keep waiting
+					sys.stdout.write("\r" + str(n + 1) + "/" + str(len(todo)) + " partitions done, " + str(positions) + " positions and " + str(events) + " events created")
+					sys.stdout.flush()
+			sys.stdout.write("\n")
+		finally:
+			# Event generation carries on from the last event, and the statistics are worked out again, as --rebuild may have thrown the latest away.
+			last = Event.objects.filter(user=user.profile).order_by('-timeend').values_list('timeend', flat=True).first()
+			Watermark.objects.update_or_create(user=user.profile, name='events', defaults={'time': (partitions[0][0] if last is None else last), 'state': json.dumps({})})
+			refresh_stats(user, ['last_calculated', 'last_event'])
+			request_job(user, 'events')
+			for stage in finish_job(user, 'import'):
+				STAGE_TASKS[stage](user.pk)
+		if events > 0:
+			queue_job(user.pk, 'enrich')
+		sys.stdout.write(self.style.SUCCESS(str(len(todo)) + " partitions processed in " + str(round(time.time() - start, 2)) + "s\n"))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from locman.models import Position
+from locman.geodesy import grid_cells
+import sys
+
+BACKFILL_BATCH_SIZE = 5000
+
+class Command(BaseCommand):
+	"""
+	Command for filling in the grid cell of positions imported before the cell was stored. New positions have their cell set when
+	they are created, so this only needs running once after upgrading.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="Optional, the username of the user whose positions are to be updated. Defaults to everyone.")
+
+	def handle(self, *args, **kwargs):
+
+		query = Position.objects.filter(cell=None)
+		if kwargs['input_user'] != '':
+			try:
+				user = User.objects.get(username=kwargs['input_user'])
+			except User.DoesNotExist:
+				sys.stderr.write(self.style.ERROR("User '" + kwargs['input_user'] + "' not found.\n"))
+				sys.exit(1)
+			query = query.filter(user=user.profile)
+		query = query.order_by('pk').values_list('pk', 'lat', 'lon')
+
+		count = 0
+		last_pk = 0
+		while True:
+			rows = list(query.filter(pk__gt=last_pk)[0:BACKFILL_BATCH_SIZE])
+			if len(rows) == 0:
+				break
+			cells = grid_cells([row[1] for row in rows], [row[2] for row in rows])
+			with transaction.atomic():
+				Position.objects.bulk_update([Position(pk=rows[i][0], cell=int(cells[i])) for i in range(0, len(rows))], ['cell'], batch_size=BACKFILL_BATCH_SIZE)
+			count = count + len(rows)
+			last_pk = rows[-1][0]
+			sys.stdout.write(str(count) + " positions updated\r")
+		sys.stdout.write(self.style.SUCCESS(str(count) + " positions updated\n"))
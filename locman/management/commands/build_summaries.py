@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db.models import Max, Min
+from locman.models import Position
+from locman.summaries import update_day_summaries
+from locman.functions import rebuild_sources
+import sys, dateutil.parser, pytz
+
+class Command(BaseCommand):
+	"""
+	Command for building the daily summaries and the rollup pyramid of a user's positions, used for quickly querying long timespans,
+	and the record of the span of time covered by each of their sources.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="The username of the user whose summaries are to be built.")
+		parser.add_argument("-s", "--start", action="store", dest="start_time", default="", help="The start of the timespan, in ISO 8601 format, UTC. Defaults to the user's earliest position.")
+		parser.add_argument("-e", "--end", action="store", dest="end_time", default="", help="The end of the timespan, in ISO 8601 format, UTC. Defaults to the user's latest position.")
+
+	def handle(self, *args, **kwargs):
+
+		try:
+			user = User.objects.get(username=kwargs['input_user'])
+		except User.DoesNotExist:
+			sys.stderr.write(self.style.ERROR("A valid user must be specified using the --user switch. See help for more details.\n"))
+			sys.exit(1)
+
+		extent = Position.objects.filter(user=user.profile).aggregate(Min('time'), Max('time'))
+		dts = extent['time__min']
+		dte = extent['time__max']
+		if dts is None:
+			sys.stderr.write(self.style.ERROR("No location data found for '" + user.username + "'\n"))
+			sys.exit(1)
+
+		try:
+			if kwargs['start_time'] != '':
+				dts = dateutil.parser.parse(kwargs['start_time'])
+			if kwargs['end_time'] != '':
+				dte = dateutil.parser.parse(kwargs['end_time'])
+		except ValueError:
+			sys.stderr.write(self.style.ERROR("Could not understand the dates given. Use ISO 8601 format, eg 2023-01-01T00:00:00.\n"))
+			sys.exit(1)
+		if dts.tzinfo is None:
+			dts = pytz.utc.localize(dts)
+		if dte.tzinfo is None:
+			dte = pytz.utc.localize(dte)
+
+		count = update_day_summaries(user, dts, dte)
+		sys.stdout.write(self.style.SUCCESS(str(count) + " days summarised\n"))
+		count = rebuild_sources(user)
+		sys.stdout.write(self.style.SUCCESS(str(count) + " sources found\n"))
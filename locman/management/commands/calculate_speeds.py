@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db.models import Max, Min
+from locman.models import Position
+from locman.functions import calculate_speeds
+import sys, dateutil.parser, pytz
+
+class Command(BaseCommand):
+	"""
+	Command for recalculating the speed of a user's positions over a particular timespan.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="The username of the user whose speeds are to be calculated.")
+		parser.add_argument("-s", "--start", action="store", dest="start_time", default="", help="The start of the timespan, in ISO 8601 format, UTC. Defaults to the user's earliest position.")
+		parser.add_argument("-e", "--end", action="store", dest="end_time", default="", help="The end of the timespan, in ISO 8601 format, UTC. Defaults to the user's latest position.")
+		parser.add_argument("-a", "--all", action="store_true", dest="overwrite", default=False, help="Recalculate all speeds in the timespan, not just those that are missing.")
+
+	def handle(self, *args, **kwargs):
+
+		try:
+			user = User.objects.get(username=kwargs['input_user'])
+		except User.DoesNotExist:
+			sys.stderr.write(self.style.ERROR("A valid user must be specified using the --user switch. See help for more details.\n"))
+			sys.exit(1)
+
+		extent = Position.objects.filter(user=user.profile).aggregate(Min('time'), Max('time'))
+		dts = extent['time__min']
+		dte = extent['time__max']
+		if dts is None:
+			sys.stderr.write(self.style.ERROR("No location data found for '" + user.username + "'\n"))
+			sys.exit(1)
+
+		try:
+			if kwargs['start_time'] != '':
+				dts = dateutil.parser.parse(kwargs['start_time'])
+			if kwargs['end_time'] != '':
+				dte = dateutil.parser.parse(kwargs['end_time'])
+		except ValueError:
+			sys.stderr.write(self.style.ERROR("Could not understand the dates given. Use ISO 8601 format, eg 2023-01-01T00:00:00.\n"))
+			sys.exit(1)
+		if dts.tzinfo is None:
+			dts = pytz.utc.localize(dts)
+		if dte.tzinfo is None:
+			dte = pytz.utc.localize(dte)
+
+		count = calculate_speeds(user, dts, dte, overwrite=kwargs['overwrite'])
+		sys.stdout.write(self.style.SUCCESS(str(count) + " speeds updated\n"))
@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Max, Min
+from locman.models import Position, Event
+from locman.functions import load_positions, create_stop_event
+from locman.stats import refresh_stats
+from locman.archive import archived_dates
+from locman.stops import detect_stops, STOP_DETECTORS
+from locman.tasks import queue_job
+import sys, datetime, dateutil.parser, pytz, time
+
+class Command(BaseCommand):
+	"""
+	Command for re-running stop detection over a user's history, for comparing the stop detectors or their settings. By default the
+	stops found are only listed; use --save to replace the user's events in the timespan with them.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="The username of the user whose positions are to be examined.")
+		parser.add_argument("-s", "--start", action="store", dest="start_time", default="", help="The start of the timespan, in ISO 8601 format, UTC. Defaults to the user's earliest position.")
+		parser.add_argument("-e", "--end", action="store", dest="end_time", default="", help="The end of the timespan, in ISO 8601 format, UTC. Defaults to the user's latest position.")
+		parser.add_argument("-m", "--method", action="store", dest="method", default="", help="The stop detector to use, one of " + ", ".join(STOP_DETECTORS) + ". Defaults to the one chosen in the user's profile.")
+		parser.add_argument("--max-speed", action="store", dest="max_speed", default="2", help="For the speed_gap detector, the speed in miles per hour above which the user is considered to be moving. Defaults to 2.")
+		parser.add_argument("--min-length", action="store", dest="min_length", default="300", help="The minimum length of a stop, in seconds. Defaults to 300.")
+		parser.add_argument("--radius", action="store", dest="radius", default="100", help="For the dwell detector, the distance in metres the user may wander while still being considered stopped. Defaults to 100.")
+		parser.add_argument("--regression", action="store_true", dest="regression", help="For the speed_gap detector, reproduce the results of the original, non-incremental stop detection exactly.")
+		parser.add_argument("--save", action="store_true", dest="save", help="Replace the user's events within the timespan with the stops found. The amenities near each one are looked up in the background.")
+		parser.add_argument("-q", "--quiet", action="store_true", dest="quiet", help="Only show the number of stops found, not the stops themselves.")
+
+	def handle(self, *args, **kwargs):
+
+		try:
+			user = User.objects.get(username=kwargs['input_user'])
+		except User.DoesNotExist:
+			sys.stderr.write(self.style.ERROR("A valid user must be specified using the --user switch. See help for more details.\n"))
+			sys.exit(1)
+
+		method = kwargs['method']
+		if method == '':
+			method = user.profile.stop_detector
+		if not(method in STOP_DETECTORS):
+			sys.stderr.write(self.style.ERROR("Unknown stop detector '" + method + "'. Use one of " + ", ".join(STOP_DETECTORS) + ".\n"))
+			sys.exit(1)
+
+		extent = Position.objects.filter(user=user.profile).aggregate(Min('time'), Max('time'))
+		dts = extent['time__min']
+		dte = extent['time__max']
+		archived = archived_dates(user)
+		if len(archived) > 0:
+			first = pytz.utc.localize(datetime.datetime(archived[0].year, archived[0].month, archived[0].day))
+			if ((dts is None) or (first < dts)):
+				dts = first
+			if dte is None:
+				dte = pytz.utc.localize(datetime.datetime(archived[-1].year, archived[-1].month, archived[-1].day)) + datetime.timedelta(days=1)
+		if dts is None:
+			sys.stderr.write(self.style.ERROR("No location data found for '" + user.username + "'\n"))
+			sys.exit(1)
+
+		try:
+			if kwargs['start_time'] != '':
+				dts = dateutil.parser.parse(kwargs['start_time'])
+			if kwargs['end_time'] != '':
+				dte = dateutil.parser.parse(kwargs['end_time'])
+		except ValueError:
+			sys.stderr.write(self.style.ERROR("Could not understand the dates given. Use ISO 8601 format, eg 2023-01-01T00:00:00.\n"))
+			sys.exit(1)
+		if dts.tzinfo is None:
+			dts = pytz.utc.localize(dts)
+		if dte.tzinfo is None:
+			dte = pytz.utc.localize(dte)
+
+		start = time.time()
+		points = load_positions(user, dts, dte)
+		loaded = time.time()
+		found = detect_stops(points, method, max_speed=float(kwargs['max_speed']), min_length=float(kwargs['min_length']), radius=float(kwargs['radius']), regression=kwargs['regression'])
+		finished = time.time()
+
+		if not(kwargs['quiet']):
+			for i in range(0, len(found['start'])):
+				stop_start = datetime.datetime.fromtimestamp(found['start'][i], tz=pytz.utc)
+				stop_end = datetime.datetime.fromtimestamp(found['end'][i], tz=pytz.utc)
+				sys.stdout.write(stop_start.strftime("%Y-%m-%d %H:%M:%S") + " | " + str(stop_end - stop_start) + " | " + str(round(found['lat'][i], 6)) + ", " + str(round(found['lon'][i], 6)) + "\n")
+		sys.stdout.write(self.style.SUCCESS(str(len(found['start'])) + " stops found in " + str(len(points['time'])) + " positions (" + str(round(loaded - start, 2)) + "s loading, " + str(round(finished - loaded, 2)) + "s detecting)\n"))
+
+		if kwargs['save']:
+			with transaction.atomic():
+				deleted = Event.objects.filter(user=user.profile, timestart__gte=dts, timeend__lte=dte).delete()[0]
+				refresh_stats(user, ['last_event'])
+				for i in range(0, len(found['start'])):
+					create_stop_event(user, datetime.datetime.fromtimestamp(found['start'][i], tz=pytz.utc), datetime.datetime.fromtimestamp(found['end'][i], tz=pytz.utc), float(found['lat'][i]), float(found['lon'][i]))
+			sys.stdout.write(self.style.SUCCESS(str(deleted) + " events replaced with " + str(len(found['start'])) + "\n"))
+			queue_job(user.pk, 'enrich')
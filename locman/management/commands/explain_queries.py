@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand
+from django.contrib.auth.models import User
+from locman.models import Position, Event
+import sys, datetime, time
+
+class Command(BaseCommand):
+	"""
+	Command for showing the query plans, and timings, of the queries the Location Manager runs most often. Run it before and after a
+	schema change to see whether the database is using the indexes.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="The username of the user whose data is to be queried.")
+		parser.add_argument("-d", "--days", action="store", dest="days", default="1", help="The length of the timespan used for range queries, in days, ending at the user's latest position. Defaults to 1.")
+
+	def handle(self, *args, **kwargs):
+
+		try:
+			user = User.objects.get(username=kwargs['input_user'])
+		except User.DoesNotExist:
+			sys.stderr.write(self.style.ERROR("A valid user must be specified using the --user switch. See help for more details.\n"))
+			sys.exit(1)
+
+		try:
+			days = int(kwargs['days'])
+		except ValueError:
+			days = 0
+		if days < 1:
+			sys.stderr.write(self.style.ERROR("The --days switch must be a whole number of days, 1 or more.\n"))
+			sys.exit(1)
+
+		dte = Position.objects.filter(user=user.profile).order_by('-time').values_list('time', flat=True).first()
+		if dte is None:
+			sys.stderr.write(self.style.ERROR("No location data found for '" + user.username + "'\n"))
+			sys.exit(1)
+		dts = dte - datetime.timedelta(days=days)
+		source = Position.objects.filter(user=user.profile).values_list('source', flat=True).first()
+
+		queries = [
+			("Earliest position", Position.objects.filter(user=user.profile).order_by('time').values_list('time', flat=True)[0:1]),
+			("Latest position", Position.objects.filter(user=user.profile).order_by('-time').values_list('time', flat=True)[0:1]),
+			("Latest position from a source", Position.objects.filter(user=user.profile, source=source).order_by('-time').values_list('time', flat=True)[0:1]),
+			("Latest calculated position", Position.objects.filter(user=user.profile, explicit=False, source='cron').order_by('-time').values_list('time', flat=True)[0:1]),
+			("Position range", Position.objects.filter(user=user.profile, time__gte=dts, time__lte=dte).order_by('time').values_list('time', 'lat', 'lon', 'speed', 'elevation', 'explicit')),
+			("Explicit position range", Position.objects.filter(user=user.profile, time__gte=dts, time__lte=dte, explicit=True).order_by('time').values_list('time', 'lat', 'lon', 'elevation')),
+			("Latest event", Event.objects.filter(user=user.profile).order_by('-timeend').values_list('timeend', flat=True)[0:1]),
+		]
+		for label, query in queries:
+			sys.stdout.write(self.style.SUCCESS(label + "\n"))
+			sys.stdout.write(query.explain() + "\n")
+			start = time.time()
+			count = len(list(query))
+			sys.stdout.write(str(count) + " rows in " + str(round((time.time() - start) * 1000, 1)) + "ms\n\n")
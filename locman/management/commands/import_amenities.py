@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from locman.amenities import import_extract
+import os, sys
+
+class Command(BaseCommand):
+	"""
+	Command for loading amenities from an OpenStreetMap extract, so that events within it can be enriched without querying Overpass.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-i", "--input", action="store", dest="input_file", default="", help="The OpenStreetMap extract to be imported, in OSM XML format, optionally compressed with bzip2 or gzip.")
+
+	def handle(self, *args, **kwargs):
+
+		extract_file = kwargs['input_file']
+		if ((extract_file == '') or (os.path.isdir(extract_file))):
+			sys.stderr.write(self.style.ERROR("Input file must be specified using the --input switch. See help for more details.\n"))
+			sys.exit(1)
+
+		extract_file = os.path.abspath(extract_file)
+		if not(os.path.exists(extract_file)):
+			sys.stderr.write(self.style.ERROR("File not found: '" + extract_file + "'\n"))
+			sys.exit(1)
+
+		count = import_extract(extract_file)
+		sys.stdout.write(self.style.SUCCESS(str(count) + " amenities imported from " + extract_file + "\n"))
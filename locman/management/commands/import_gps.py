@@ -1,6 +1,8 @@
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.contrib.auth.models import User
 from locman.tasks import *
+from locman.functions import IMPORT_METHODS
 import os, sys, datetime, shutil
 
 class Command(BaseCommand):
@@ -12,6 +14,9 @@ class Command(BaseCommand):
 		parser.add_argument("-i", "--input", action="store", dest="input_file", default="", help="The file, containing GPS data, to be imported.")
 		parser.add_argument("-f", "--format", action="store", dest="input_format", default="", help="The type of the file being imported.", choices=['gpx', 'csv', 'fit'])
 		parser.add_argument("-s", "--source", action="store", dest="input_source", default="", help="An identifier for the source of the imported GPS data. For example: phone_gps.")
+		parser.add_argument("-u", "--user", action="store", dest="input_user", default="", help="The username of the user whose GPS data is being imported.")
+		parser.add_argument("-m", "--method", action="store", dest="import_method", default="bulk", help="The method used to write the data to the database. Defaults to 'bulk'.", choices=IMPORT_METHODS)
+		parser.add_argument("--force", action="store_true", dest="force", help="Import the file even if it, or the data in it, has been imported before.")
 
 	def handle(self, *args, **kwargs):
 
@@ -20,6 +25,7 @@ class Command(BaseCommand):
 		temp_file = os.path.join(temp_dir, str(datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S")) + "_" + os.path.basename(uploaded_file))
 		file_source = kwargs['input_source']
 		format = kwargs['input_format']
+		method = kwargs['import_method']
 
 		if ((uploaded_file == '') or (os.path.isdir(uploaded_file))):
 			sys.stderr.write(self.style.ERROR("Input file must be specified using the --input switch. See help for more details.\n"))
@@ -29,6 +35,12 @@ class Command(BaseCommand):
 			sys.stderr.write(self.style.ERROR("Data source must be specified using the --source switch. See help for more details.\n"))
 			sys.exit(1)
 
+		try:
+			user = User.objects.get(username=kwargs['input_user'])
+		except User.DoesNotExist:
+			sys.stderr.write(self.style.ERROR("A valid user must be specified using the --user switch. See help for more details.\n"))
+			sys.exit(1)
+
 		if not(os.path.exists(uploaded_file)):
 			sys.stderr.write(self.style.ERROR("File not found: '" + uploaded_file + "'\n"))
 			sys.exit(1)
@@ -41,8 +53,5 @@ class Command(BaseCommand):
 			os.makedirs(temp_dir)
 		shutil.copyfile(uploaded_file, temp_file)
 
-		if format == '':
-			import_uploaded_file(temp_file, file_source)
-		else:
-			import_uploaded_file(temp_file, file_source, format)
+		queue_import(user.pk, temp_file, file_source, format, method, kwargs['force'])
 		sys.stdout.write(self.style.SUCCESS(uploaded_file + "\n"))
@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from background_task.tasks import autodiscover
+from background_task.utils import SignalManager
+from locman import tasks
+from locman.workers import WORKER_QUEUES, worker_count, worker_user_limit, waiting_tasks, choose_tasks, start_worker, run_task
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing, itertools, logging, sys, os, time
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+	"""
+	Command for running the background tasks in a pool of worker processes, instead of one process_tasks per queue. Different users'
+	tasks run in parallel, users take it in turns so that one user's long backfill doesn't hold up everybody else, and separate spans
+	of the same user's history can be filled in at the same time.
+	"""
+	def add_arguments(self, parser):
+
+		parser.add_argument("-w", "--workers", action="store", dest="workers", default="", help="The number of worker processes. Defaults to LOCMAN_WORKERS, or the number of CPUs.")
+		parser.add_argument("-p", "--per-user", action="store", dest="per_user", default="", help="The most tasks that may run at once for any one user. Defaults to LOCMAN_WORKERS_PER_USER, or 1. Only tasks refilling separate spans of history ever run alongside each other.")
+		parser.add_argument("-q", "--queue", action="append", dest="queues", default=[], help="A queue to take tasks from. May be given more than once. Defaults to " + " and ".join(WORKER_QUEUES) + ".")
+		parser.add_argument("--sleep", action="store", dest="sleep", default="5", help="The time in seconds to wait before looking for new tasks, when there are none. Defaults to 5.")
+
+	def handle(self, *args, **kwargs):
+
+		try:
+			workers = worker_count() if kwargs['workers'] == '' else max(int(kwargs['workers']), 1)
+			per_user = worker_user_limit() if kwargs['per_user'] == '' else max(int(kwargs['per_user']), 1)
+			sleep = float(kwargs['sleep'])
+		except ValueError:
+			sys.stderr.write(self.style.ERROR("The number of workers, tasks per user and the sleep time must be numbers.\n"))
+			sys.exit(1)
+		queues = kwargs['queues']
+		if len(queues) == 0:
+			queues = WORKER_QUEUES
+
+		autodiscover()
+		signals = SignalManager()
+		locked_by = str(os.getpid()) # Tasks are locked by this process, which outlives the workers, so the import view can tell they're still running
+		counter = itertools.count()
+		served = {}
+		running = {}
+		sys.stdout.write(self.style.SUCCESS("Running tasks from " + ", ".join(queues) + " with " + str(workers) + " workers\n"))
+
+		# Workers are started fresh rather than forked, so they don't share this process's database connections.
+		with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=start_worker) as pool:
+			try:
+				while not(signals.kill_now):
+					for future in [future for future in running if future.done()]:
+						running.pop(future)
+						if not(future.exception() is None):
+							logger.error('Worker failed', exc_info=future.exception())
+
+					started = 0
+					if len(running) < workers:
+						chosen = choose_tasks(waiting_tasks(queues, [task_id for task_id, shard, span in running.values()]), [(shard, span) for task_id, shard, span in running.values()], workers - len(running), per_user, served)
+						for task, shard, span in chosen:
+							locked = task.lock(locked_by)
+							if locked is None:
+								continue # Someone else got there first
+							running[pool.submit(run_task, locked.pk)] = (locked.pk, shard, span)
+							served[shard] = next(counter)
+							started = started + 1
+
+					if started == 0:
+						close_old_connections()
+						if len(running) > 0:
+							wait(list(running), timeout=sleep, return_when=FIRST_COMPLETED)
+						else:
+							time.sleep(sleep)
+			except KeyboardInterrupt:
+				sys.stdout.write("Waiting for running tasks to finish\n")
+
+		sys.stdout.write(self.style.SUCCESS("All workers stopped\n"))
@@ -5,6 +5,7 @@ from django.db.models.signals import post_save
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 from macaddress.fields import MACAddressField
+from .geodesy import grid_cell
 import datetime, pytz, math, json
 
 def friendly_time(seconds):
@@ -31,6 +32,7 @@ def friendly_time(seconds):
 class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     token = models.ForeignKey(Token, null=False, on_delete=models.CASCADE)
+    stop_detector = models.SlugField(max_length=32, default='speed_gap', choices=[('speed_gap', 'Speed gap'), ('dwell', 'Dwell')])
     def __str__(self):
         return str(self.user.username)
 
@@ -76,11 +78,15 @@ class Position(models.Model):
     lat = models.FloatField()
     lon = models.FloatField()
     elevation = models.FloatField(null=True, blank=True)
-    time = models.DateTimeField(unique=True)
+    time = models.DateTimeField()
     speed = models.IntegerField(blank=True, null=True)
     explicit = models.BooleanField(default=True)
     source = models.SlugField(max_length=32)
+    cell = models.IntegerField(null=True, blank=True)
     user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='positions')
+    def save(self, *args, **kwargs):
+        self.cell = grid_cell(self.lat, self.lon)
+        super().save(*args, **kwargs)
     class Meta:
         app_label = 'locman'
         verbose_name = 'position'
@@ -88,11 +94,13 @@ class Position(models.Model):
         indexes = [
             models.Index(fields=['lat', 'lon']),
             models.Index(fields=['speed']),
-            models.Index(fields=['explicit']),
             models.Index(fields=['source']),
+            models.Index(fields=['user', 'source', 'time'], name='locman_pos_user_src_time_idx'),
+            models.Index(fields=['user', 'explicit', 'source', 'time'], name='locman_pos_user_exp_src_idx'),
+            models.Index(fields=['user', 'cell', 'time'], name='locman_pos_user_cell_time_idx'),
         ]
         constraints = [
-            models.UniqueConstraint(fields=['time', 'source', 'explicit'], name='locman_time_source_expl_uniq')
+            models.UniqueConstraint(fields=['user', 'time'], name='locman_position_user_time_uniq') # Also serves as the (user, time) index
         ]
 
 class Event(models.Model):
@@ -101,102 +109,265 @@ class Event(models.Model):
     lat = models.FloatField(null=True, blank=True)
     lon = models.FloatField(null=True, blank=True)
     amenities_data = models.TextField(default="[]")
+    amenities_status = models.SlugField(max_length=16, default='done', choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')])
+    amenities_attempts = models.IntegerField(default=0)
+    amenities_retry = models.DateTimeField(null=True, blank=True)
     user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='events')
     @property
     def amenities(self):
-        if self.pk:
-            return json.loads(self.amenities_data)
-        ret = nearest_amenities(e.lat, e.lon)
-        self.amenities_data = json.dumps(ret)
-        return ret
+        """ The amenities near the event, or None if they haven't been looked up yet. Lookups happen in the background; see amenities.enrich_pending_events. """
+        if self.amenities_status == 'pending':
+            return None
+        return json.loads(self.amenities_data)
     def __str__(self):
         return self.timestart.strftime("%Y-%m-%d %H:%M:%S") + " | " + str(self.timeend - self.timestart)
-    def __distance(self, lat1, lon1, lat2, lon2):
-        """ Returns the distance, in km, between lat1,lon1 and lat2,lon2. """
-        radius = 6371.0 # km
-
-        dlat = math.radians(lat2-lat1)
-        dlon = math.radians(lon2-lon1)
-        a = math.sin(dlat/2) * math.sin(dlat/2) + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon/2) * math.sin(dlon/2)
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        d = radius * c
-
-        return(d)
-
-    def geojson(self):
-        lasttime = datetime.datetime(1970, 1, 1, 0, 0, 0, tzinfo=pytz.UTC)
-        lastlat = 0.0
-        lastlon = 0.0
-        minlat = 360.0
-        minlon = 360.0
-        maxlat = -360.0
-        maxlon = -360.0
-        track = []
-        geo = []
-        dist = 0.0
-        poi = []
-
-        max_speed = [0, 0.0, 0.0, None]
-        max_height = [0, 0.0, 0.0, None]
-        min_height = 9999
-
-        for point in Position.objects.filter(time__gte=self.timestart).filter(time__lte=self.timeend):
-            if not(point.speed is None):
-                if point.speed > max_speed[0]:
-                    max_speed = [point.speed, point.lat, point.lon, point.time.astimezone(pytz.timezone(settings.TIME_ZONE))]
-            if not(point.elevation is None):
-                if point.elevation < min_height:
-                    min_height = point.elevation
-                if point.elevation > max_height[0]:
-                    max_height = [point.elevation, point.lat, point.lon, point.time.astimezone(pytz.timezone(settings.TIME_ZONE))]
-            if ((lastlat != 0.0) & (lastlon != 0.0)):
-                dist = dist + self.__distance(lastlat, lastlon, point.lat, point.lon)
-            if (point.time - lasttime).total_seconds() > 90:
-                if len(track) > 1:
-                    geo.append(track)
-                lastlat = 0.0
-                lastlon = 0.0
-                track = []
-            data = [point.lon, point.lat]
-            if (lastlat != point.lat) or (lastlon != point.lon):
-                track.append(data)
-                if point.lon < minlon:
-                    minlon = point.lon
-                if point.lon > maxlon:
-                    maxlon = point.lon
-                if point.lat < minlat:
-                    minlat = point.lat
-                if point.lat > maxlat:
-                    maxlat = point.lat
-            lasttime = point.time
-            lastlat = point.lat
-            lastlon = point.lon
-        if len(track) > 1:
-            geo.append(track)
-
-        events = Event.objects.filter(timestart__gte=self.timestart, timeend__lte=self.timeend)
-        if max_speed[0] > 10:
-            poi.append({"type": "Point", "coordinates": [max_speed[2], max_speed[1]], "properties": {"type": "poi", "time": max_speed[3], "label": "Maximum speed " + str(max_speed[0]) + "mph at " + str(max_speed[3].strftime('%H:%M:%S'))}})
-        if not(max_height[3] is None):
-            height_diff = max_height[0] - min_height
-            if ((height_diff > 50) or (max_height[0] > 200)):
-                poi.append({"type": "Point", "coordinates": [max_height[2], max_height[1]], "properties": {"type": "poi", "time": max_height[3], "label": "Maximum elevation " + str(int(max_height[0])) + "m at " + str(max_height[3].strftime('%H:%M:%S'))}})
-
-        polyline = {"type":"MultiLineString","coordinates":geo}
-        if events.count() + len(poi) == 0:
-            geometry = polyline
-        else:
-            geometry = {"type": "GeometryCollection", "geometries": [polyline]}
-            for p in poi:
-                geometry['geometries'].append(p)
-            for event in events:
-                geometry['geometries'].append({"type": "Point", "coordinates": [event.lon, event.lat], "properties": {"type": "stop", "arrive": event.timestart, "leave": event.timeend, "label": "Stopped for " + friendly_time((event.timeend - event.timestart).total_seconds())}})
-        ret = {"type":"Feature", "bbox":[minlon, maxlat, maxlon, minlat], "properties":{"distance": dist}, "geometry":geometry}
-        return ret
+    def geojson(self, tolerance=None, max_points=None):
+        """ Returns a GeoJSON Feature describing the route taken during this event. See routes.route_geojson for the parameters. """
+        from .routes import route_geojson
+        return route_geojson(self.user.user, self.timestart, self.timeend, tolerance, max_points)
     class Meta:
         app_label = 'locman'
         verbose_name = 'event'
         verbose_name_plural = 'events'
         indexes = [
             models.Index(fields=['timestart', 'timeend']),
+            models.Index(fields=['user', 'timestart'], name='locman_event_user_start_idx'),
+            models.Index(fields=['user', 'timeend'], name='locman_event_user_end_idx'),
+            models.Index(fields=['user', 'amenities_status', 'amenities_retry'], name='locman_event_enrich_idx'),
+        ]
+
+class DaySummary(models.Model):
+    """ Statistics for a single user's positions over a single day (UTC), so that queries over long timespans don't need to read every position. """
+    date = models.DateField()
+    points = models.IntegerField(default=0)
+    distance = models.FloatField(default=0.0)
+    minlat = models.FloatField(null=True, blank=True)
+    minlon = models.FloatField(null=True, blank=True)
+    maxlat = models.FloatField(null=True, blank=True)
+    maxlon = models.FloatField(null=True, blank=True)
+    min_elevation = models.FloatField(null=True, blank=True)
+    max_elevation = models.FloatField(null=True, blank=True)
+    max_elevation_lat = models.FloatField(null=True, blank=True)
+    max_elevation_lon = models.FloatField(null=True, blank=True)
+    max_elevation_time = models.DateTimeField(null=True, blank=True)
+    max_speed = models.IntegerField(null=True, blank=True)
+    max_speed_lat = models.FloatField(null=True, blank=True)
+    max_speed_lon = models.FloatField(null=True, blank=True)
+    max_speed_time = models.DateTimeField(null=True, blank=True)
+    first_time = models.DateTimeField()
+    first_lat = models.FloatField()
+    first_lon = models.FloatField()
+    last_time = models.DateTimeField()
+    last_lat = models.FloatField()
+    last_lon = models.FloatField()
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='day_summaries')
+    def __str__(self):
+        return str(self.user) + " | " + self.date.strftime("%Y-%m-%d")
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'day summary'
+        verbose_name_plural = 'day summaries'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'date'], name='locman_daysummary_user_date_uniq')
+        ]
+
+class PositionRollup(models.Model):
+    """ A user's average position over a fixed period of time. Rollups are kept at several resolutions, so that long timespans can be drawn without reading every position. """
+    resolution = models.IntegerField()
+    time = models.DateTimeField()
+    lat = models.FloatField()
+    lon = models.FloatField()
+    minlat = models.FloatField(null=True, blank=True)
+    minlon = models.FloatField(null=True, blank=True)
+    maxlat = models.FloatField(null=True, blank=True)
+    maxlon = models.FloatField(null=True, blank=True)
+    elevation = models.FloatField(null=True, blank=True)
+    elevation_points = models.IntegerField(default=0)
+    speed = models.IntegerField(null=True, blank=True)
+    points = models.IntegerField(default=0)
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='rollups')
+    def __str__(self):
+        return str(self.user) + " | " + str(self.resolution) + "s | " + self.time.strftime("%Y-%m-%d %H:%M:%S")
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'position rollup'
+        verbose_name_plural = 'position rollups'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'resolution', 'time'], name='locman_rollup_user_res_time_uniq')
+        ]
+
+class Watermark(models.Model):
+    """ Records how far one of the background processes has got through a user's data, along with anything it needs to remember, so the next run can carry on from where it left off. """
+    name = models.SlugField(max_length=32)
+    time = models.DateTimeField()
+    state = models.TextField(default="{}")
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='watermarks')
+    def __str__(self):
+        return str(self.user) + " | " + self.name + " | " + self.time.strftime("%Y-%m-%d %H:%M:%S")
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'watermark'
+        verbose_name_plural = 'watermarks'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'name'], name='locman_watermark_user_name_uniq')
+        ]
+
+class Amenity(models.Model):
+    """ A named amenity or leisure facility from OpenStreetMap, loaded from an extract so that the amenities near an event can be found without querying Overpass. """
+    osm_type = models.SlugField(max_length=8)
+    osm_id = models.BigIntegerField()
+    name = models.CharField(max_length=255, default='')
+    lat = models.FloatField()
+    lon = models.FloatField()
+    cell = models.IntegerField()
+    tags_data = models.TextField(default="{}")
+    @property
+    def tags(self):
+        return json.loads(self.tags_data)
+    def __str__(self):
+        return str(self.name)
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'amenity'
+        verbose_name_plural = 'amenities'
+        indexes = [
+            models.Index(fields=['cell', 'lat', 'lon'], name='locman_amenity_cell_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['osm_type', 'osm_id'], name='locman_amenity_osm_uniq')
+        ]
+
+class AmenityExtract(models.Model):
+    """ An OpenStreetMap extract that has been loaded into the Amenity table. Amenities within its bounds are looked up locally. """
+    filename = models.CharField(max_length=255)
+    minlat = models.FloatField()
+    minlon = models.FloatField()
+    maxlat = models.FloatField()
+    maxlon = models.FloatField()
+    amenities = models.IntegerField(default=0)
+    imported = models.DateTimeField(auto_now=True)
+    def __str__(self):
+        return str(self.filename)
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'amenity extract'
+        verbose_name_plural = 'amenity extracts'
+
+class AmenityCache(models.Model):
+    """ A previous answer from Overpass, for a point outside every loaded extract. Co-ordinates are rounded to AMENITY_CACHE_PRECISION decimal places, so nearby lookups share an answer. """
+    lat = models.FloatField()
+    lon = models.FloatField()
+    dist = models.IntegerField()
+    amenities_data = models.TextField(default="[]")
+    time = models.DateTimeField(auto_now=True)
+    def __str__(self):
+        return str(self.lat) + ", " + str(self.lon) + " | " + str(self.dist) + "m"
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'amenity cache entry'
+        verbose_name_plural = 'amenity cache entries'
+        constraints = [
+            models.UniqueConstraint(fields=['lat', 'lon', 'dist'], name='locman_amenitycache_uniq')
+        ]
+
+class ImportedFile(models.Model):
+    """ A file that has been imported, identified by a SHA-256 hash of its contents, so that uploading the same file again can be skipped. """
+    sha256 = models.CharField(max_length=64)
+    filename = models.CharField(max_length=255, default='')
+    source = models.SlugField(max_length=32)
+    size = models.BigIntegerField(default=0)
+    points = models.IntegerField(default=0)
+    time = models.DateTimeField(auto_now=True)
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='imported_files')
+    def __str__(self):
+        return str(self.user) + " | " + str(self.filename)
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'imported file'
+        verbose_name_plural = 'imported files'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'sha256'], name='locman_importedfile_user_hash_uniq')
+        ]
+
+class ImportSegment(models.Model):
+    """ A fingerprint of the positions last imported from a source within one IMPORT_SEGMENT_SIZE period, so that re-importing unchanged data can be skipped. """
+    time = models.DateTimeField()
+    source = models.SlugField(max_length=32)
+    fingerprint = models.CharField(max_length=64)
+    points = models.IntegerField(default=0)
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='import_segments')
+    def __str__(self):
+        return str(self.user) + " | " + self.source + " | " + self.time.strftime("%Y-%m-%d %H:%M:%S")
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'import segment'
+        verbose_name_plural = 'import segments'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'source', 'time'], name='locman_importsegment_uniq')
+        ]
+
+class PositionSource(models.Model):
+    """ The span of time covered by a user's explicit positions from one source, and how many there are, kept up to date by import_data so that it never needs to be worked out from the position table. """
+    source = models.SlugField(max_length=32)
+    first = models.DateTimeField()
+    last = models.DateTimeField()
+    points = models.BigIntegerField(default=0)
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='sources')
+    def __str__(self):
+        return str(self.user) + " | " + self.source
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'position source'
+        verbose_name_plural = 'position sources'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'source'], name='locman_positionsource_uniq')
+        ]
+
+class UserStats(models.Model):
+    """ The times of a user's latest explicit position, calculated position and event, kept up to date as they are written so that they never need to be worked out from the position and event tables. See stats.py. """
+    user = models.OneToOneField(UserProfile, primary_key=True, on_delete=models.CASCADE, related_name='stats')
+    last_explicit = models.DateTimeField(null=True, blank=True)
+    last_calculated = models.DateTimeField(null=True, blank=True)
+    last_event = models.DateTimeField(null=True, blank=True)
+    def __str__(self):
+        return str(self.user)
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'user statistics'
+        verbose_name_plural = 'user statistics'
+
+class Job(models.Model):
+    """ The state of one stage of a user's background processing, used to coordinate the background tasks. See jobs.py. """
+    stage = models.SlugField(max_length=16)
+    pending = models.IntegerField(default=0)
+    running = models.BooleanField(default=False)
+    lease = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='jobs')
+    def __str__(self):
+        return str(self.user) + " | " + self.stage
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'job'
+        verbose_name_plural = 'jobs'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'stage'], name='locman_job_user_stage_uniq')
+        ]
+
+class BackfillPartition(models.Model):
+    """ A partition of a user's history that the backfill command has finished processing, so that it can carry on where it left off if it is stopped. See backfill.py. """
+    start = models.DateTimeField()
+    end = models.DateTimeField()
+    positions = models.IntegerField(default=0)
+    events = models.IntegerField(default=0)
+    time = models.DateTimeField(auto_now=True)
+    user = models.ForeignKey(UserProfile, null=False, on_delete=models.CASCADE, related_name='backfill_partitions')
+    def __str__(self):
+        return str(self.user) + " | " + self.start.strftime("%Y-%m-%d") + " - " + self.end.strftime("%Y-%m-%d")
+    class Meta:
+        app_label = 'locman'
+        verbose_name = 'backfill partition'
+        verbose_name_plural = 'backfill partitions'
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'start'], name='locman_backfillpartition_uniq')
         ]
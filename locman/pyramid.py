@@ -0,0 +1,195 @@
+from django.db import transaction
+from .models import PositionRollup, DaySummary
+from .functions import load_positions, _chunks, SPEED_CHUNK_SIZE
+import numpy as np
+import datetime, pytz
+
+ROLLUP_RESOLUTIONS = [60, 600, 3600] # seconds. Each level is built from the one before, so each must divide the next, and all must divide a day.
+ROLLUP_FIELDS = ['time', 'lat', 'lon', 'minlat', 'minlon', 'maxlat', 'maxlon', 'elevation', 'elevation_points', 'speed', 'points']
+
+def _raw_level(points):
+    """ Converts the arrays returned by load_positions into the form used by rollup_points, treating each position as a bucket of one. """
+    ret = {}
+    ret['time'] = points['time']
+    ret['lat'] = points['lat']
+    ret['lon'] = points['lon']
+    located = (points['lat'] != 0.0) | (points['lon'] != 0.0) # Positions at exactly 0,0 are left out of the bounding box
+    ret['minlat'] = np.where(located, points['lat'], np.inf)
+    ret['minlon'] = np.where(located, points['lon'], np.inf)
+    ret['maxlat'] = np.where(located, points['lat'], -np.inf)
+    ret['maxlon'] = np.where(located, points['lon'], -np.inf)
+    ret['elevation'] = points['elevation']
+    ret['elevation_points'] = (~np.isnan(points['elevation'])).astype(np.int64)
+    ret['speed'] = points['speed']
+    ret['points'] = np.ones(len(points['time']), dtype=np.int64)
+    ret['located'] = located.astype(np.int64)
+    return ret
+
+def _finite(value):
+    """ Converts a numpy value to a float, or None if it is NaN or infinite. """
+    if np.isfinite(value):
+        return float(value)
+    return None
+
+def rollup_points(level, resolution):
+    """
+    Aggregates a level of the pyramid into buckets of `resolution` seconds. Latitude, longitude and elevation are
+    averaged, weighted by the number of positions in each of the source buckets, the bounding box is kept exactly and
+    speed is the maximum. Positions at exactly 0,0 are left out of the average position and the bounding box, so
+    buckets with no other positions are placed at 0,0 and have an infinite bounding box.
+
+    :param level: A dictionary of numpy arrays in time order, with the keys in ROLLUP_FIELDS plus 'located', the number of positions not at 0,0.
+    :param resolution: The size of the new buckets, in seconds. Buckets are aligned to the epoch.
+    :return: A dictionary of numpy arrays with the same keys as `level`, one element per non-empty bucket.
+    :rtype: dict
+    """
+    buckets = np.floor(level['time'] / resolution) * resolution
+    ret = {}
+    if len(buckets) == 0:
+        for k in ROLLUP_FIELDS:
+            ret[k] = np.zeros(0, dtype=(np.int64 if k in ['points', 'elevation_points'] else np.float64))
+        ret['located'] = np.zeros(0, dtype=np.int64)
+        return ret
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    weights = level['located']
+    ret['time'] = buckets[starts]
+    ret['points'] = np.add.reduceat(level['points'], starts)
+    ret['located'] = np.add.reduceat(weights, starts)
+    located = ret['located'] > 0
+    ret['lat'] = np.zeros(len(starts), dtype=np.float64)
+    ret['lon'] = np.zeros(len(starts), dtype=np.float64)
+    np.divide(np.add.reduceat(level['lat'] * weights, starts), ret['located'], out=ret['lat'], where=located)
+    np.divide(np.add.reduceat(level['lon'] * weights, starts), ret['located'], out=ret['lon'], where=located)
+    ret['minlat'] = np.minimum.reduceat(level['minlat'], starts)
+    ret['minlon'] = np.minimum.reduceat(level['minlon'], starts)
+    ret['maxlat'] = np.maximum.reduceat(level['maxlat'], starts)
+    ret['maxlon'] = np.maximum.reduceat(level['maxlon'], starts)
+    ret['elevation_points'] = np.add.reduceat(level['elevation_points'], starts)
+    total = np.add.reduceat(np.nan_to_num(level['elevation']) * level['elevation_points'], starts)
+    ret['elevation'] = np.full(len(starts), np.nan)
+    np.divide(total, ret['elevation_points'], out=ret['elevation'], where=(ret['elevation_points'] > 0))
+    ret['speed'] = np.fmax.reduceat(level['speed'], starts) # fmax ignores NaN unless every speed in the bucket is unknown
+    return ret
+
+def update_rollups(user, dts, dte, points=None):
+    """
+    Rebuilds every level of a user's rollup pyramid for the timespan between dts and dte, which should be aligned to
+    the coarsest resolution (whole UTC days are always safe.) Should be called whenever positions within the timespan
+    have been added, changed or removed.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param points: Optional, the arrays returned by load_positions for this timespan, if the caller already has them.
+    :return: The number of rollups created.
+    :rtype: int
+    """
+    if points is None:
+        points = load_positions(user, dts, dte)
+    level = _raw_level(points)
+    rollups = []
+    for resolution in ROLLUP_RESOLUTIONS:
+        level = rollup_points(level, resolution)
+        for i in range(0, len(level['time'])):
+            rollups.append(PositionRollup(user=user.profile, resolution=resolution,
+                time=datetime.datetime.fromtimestamp(level['time'][i], tz=pytz.utc),
+                lat=float(level['lat'][i]), lon=float(level['lon'][i]),
+                minlat=_finite(level['minlat'][i]), minlon=_finite(level['minlon'][i]),
+                maxlat=_finite(level['maxlat'][i]), maxlon=_finite(level['maxlon'][i]),
+                elevation=(None if np.isnan(level['elevation'][i]) else float(level['elevation'][i])),
+                elevation_points=int(level['elevation_points'][i]),
+                speed=(None if np.isnan(level['speed'][i]) else int(level['speed'][i])),
+                points=int(level['points'][i])))
+    with transaction.atomic():
+        PositionRollup.objects.filter(user=user.profile, time__gte=dts, time__lte=dte).delete()
+        PositionRollup.objects.bulk_create(rollups, batch_size=SPEED_CHUNK_SIZE)
+    return len(rollups)
+
+def choose_resolution(dts, dte, resolution=None, max_points=None):
+    """
+    Picks the coarsest level of the pyramid that satisfies a request. A level satisfies `resolution` if its buckets
+    are no longer than `resolution` seconds, and satisfies `max_points` if a position in every bucket of the timespan
+    would still come to no more than `max_points`, assuming one raw position per second.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param resolution: Optional, the coarsest acceptable resolution, in seconds.
+    :param max_points: Optional, the maximum number of points wanted.
+    :return: The resolution of the chosen level in seconds, 1 meaning the raw positions.
+    :rtype: int
+    """
+    levels = [1] + ROLLUP_RESOLUTIONS
+    if ((resolution is None) and (max_points is None)):
+        return 1
+    duration = max((dte - dts).total_seconds(), 1)
+    ret = 1
+    for level in levels:
+        if ((not(resolution is None)) and (level > resolution)):
+            break
+        ret = level
+        if ((not(max_points is None)) and (duration / level <= max_points)):
+            break
+    return ret
+
+def load_level(user, dts, dte, resolution=1):
+    """
+    Reads a level of a user's pyramid between dts and dte into numpy arrays, in the same form as load_positions, so
+    that anything drawing positions can use a rollup level in their place. Each rollup appears as a single position at
+    the start of its bucket, and is marked as explicit if any of the positions it contains had an elevation. Days whose
+    rollups haven't been built yet (those without a DaySummary) are read from the raw positions and rolled up on the
+    fly instead, with the same result.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param resolution: The resolution of the level to read, in seconds. 1 reads the raw positions using load_positions.
+    :return: A dictionary of numpy arrays, as returned by load_positions.
+    :rtype: dict
+    """
+    if resolution <= 1:
+        return load_positions(user, dts, dte)
+    start = datetime.datetime.fromtimestamp(np.floor(dts.timestamp() / resolution) * resolution, tz=pytz.utc)
+    end = datetime.datetime.fromtimestamp((np.floor(dte.timestamp() / resolution) + 1) * resolution, tz=pytz.utc) - datetime.timedelta(microseconds=1)
+    built = set(DaySummary.objects.filter(user=user.profile, date__gte=start.date(), date__lte=end.date()).values_list('date', flat=True))
+    parts = []
+    day = start.date()
+    while day <= end.date():
+        part_start = max(start, datetime.datetime(day.year, day.month, day.day, tzinfo=pytz.utc))
+        while ((day < end.date()) and ((day + datetime.timedelta(days=1) in built) == (day in built))):
+            day = day + datetime.timedelta(days=1)
+        part_end = min(end, datetime.datetime(day.year, day.month, day.day, tzinfo=pytz.utc) + datetime.timedelta(days=1) - datetime.timedelta(microseconds=1))
+        if day in built:
+            parts.append(_read_level(user, part_start, part_end, resolution))
+        else:
+            parts.append(_rollup_positions(load_positions(user, part_start, part_end), resolution))
+        day = day + datetime.timedelta(days=1)
+    ret = {}
+    for k in parts[0].keys():
+        ret[k] = np.concatenate([part[k] for part in parts])
+    return ret
+
+def _rollup_positions(points, resolution):
+    """ Rolls up the arrays returned by load_positions to a level of the pyramid, as update_rollups would, returning them in the form used by load_level. """
+    level = _raw_level(points)
+    for r in ROLLUP_RESOLUTIONS:
+        level = rollup_points(level, r)
+        if r >= resolution:
+            break
+    return {'time': level['time'], 'lat': level['lat'], 'lon': level['lon'], 'speed': level['speed'], 'elevation': level['elevation'], 'explicit': level['elevation_points'] > 0}
+
+def _read_level(user, dts, dte, resolution):
+    """ Does the work for load_level, reading the rollups of one resolution starting between dts and dte. """
+    query = PositionRollup.objects.filter(user=user.profile, resolution=resolution, time__gte=dts, time__lte=dte).order_by('time').values_list('time', 'lat', 'lon', 'speed', 'elevation', 'elevation_points')
+    columns = {'time': [], 'lat': [], 'lon': [], 'speed': [], 'elevation': [], 'explicit': []}
+    for chunk in _chunks(query.iterator(chunk_size=SPEED_CHUNK_SIZE), SPEED_CHUNK_SIZE):
+        columns['time'].append(np.array([row[0].timestamp() for row in chunk], dtype=np.float64))
+        columns['lat'].append(np.array([row[1] for row in chunk], dtype=np.float64))
+        columns['lon'].append(np.array([row[2] for row in chunk], dtype=np.float64))
+        columns['speed'].append(np.array([row[3] for row in chunk], dtype=np.float64))
+        columns['elevation'].append(np.array([row[4] for row in chunk], dtype=np.float64))
+        columns['explicit'].append(np.array([row[5] > 0 for row in chunk], dtype=bool))
+    ret = {}
+    for k in columns.keys():
+        if len(columns[k]) == 0:
+            ret[k] = np.zeros(0, dtype=(bool if k == 'explicit' else np.float64))
+        else:
+            ret[k] = np.concatenate(columns[k])
+    return ret
@@ -0,0 +1,184 @@
+from django.conf import settings
+from rest_framework.utils.encoders import JSONEncoder
+from .models import Event, friendly_time
+from .pyramid import choose_resolution, load_level
+from .summaries import summarise
+from .geodesy import distances, simplify
+import numpy as np
+import datetime, pytz, json
+
+ROUTE_STREAM_THRESHOLD = 20000 # Routes with more coordinates than this are sent as a StreamingHttpResponse
+ROUTE_STREAM_BUFFER = 65536
+ROUTE_STREAM_ROWS = 1000 # Co-ordinates encoded at a time by iter_json
+
+def route_geojson(user, dts, dte, tolerance=None, max_points=None, resolution=None):
+    """
+    Generates a GeoJSON Feature describing the route travelled by a user between two times. The positions are read into
+    arrays from the coarsest level of the rollup pyramid that satisfies `resolution` and `max_points`, and optionally
+    simplified. The distance, bounding box and points of interest come from summarise, so are always based on the full
+    resolution data. Simplifying needs the whole route at once, so it is held in memory, but only as numpy arrays: the
+    co-ordinates of each track are an (n, 2) array, a view of one array for the whole route, which iter_json encodes a
+    piece at a time and the REST framework's encoder converts with tolist.
+
+    :param dts: A datetime representing the start of the route.
+    :param dte: A datetime representing the end of the route.
+    :param tolerance: Optional, the distance in degrees that the simplified route may stray from the full route.
+    :param max_points: Optional, the maximum number of points in the simplified route.
+    :param resolution: Optional, the coarsest acceptable time resolution of the route, in seconds.
+    :return: A dictionary representing a GeoJSON Feature.
+    :rtype: dict
+    """
+    tz = pytz.timezone(settings.TIME_ZONE)
+    level = choose_resolution(dts, dte, resolution, max_points)
+    points = load_level(user, dts, dte, level)
+    times = points['time']
+    lats = points['lat']
+    lons = points['lon']
+    minlat = 360.0
+    minlon = 360.0
+    maxlat = -360.0
+    maxlon = -360.0
+    geo = []
+    dist = 0.0
+    poi = []
+
+    max_speed = [0, 0.0, 0.0, None]
+    max_height = [0, 0.0, 0.0, None]
+    min_height = 9999
+
+    if level == 1:
+        summary = summarise(user, dts, dte, points)
+    else:
+        summary = summarise(user, dts, dte)
+    if not(summary is None):
+        if ((not(summary['max_speed'] is None)) and (summary['max_speed'] > 0)):
+            max_speed = [summary['max_speed'], summary['max_speed_lat'], summary['max_speed_lon'], summary['max_speed_time'].astimezone(tz)]
+        if not(summary['max_elevation'] is None):
+            min_height = min(min_height, summary['min_elevation'])
+            if summary['max_elevation'] > 0:
+                max_height = [summary['max_elevation'], summary['max_elevation_lat'], summary['max_elevation_lon'], summary['max_elevation_time'].astimezone(tz)]
+        dist = summary['distance'] / 1000.0
+        if not(summary['minlat'] is None):
+            minlat = summary['minlat']
+            minlon = summary['minlon']
+            maxlat = summary['maxlat']
+            maxlon = summary['maxlon']
+
+    if len(times) > 0:
+        # A gap of more than 90 seconds (or a missing bucket, for rollups) starts a new track. Within a track, points
+        # that haven't moved are dropped.
+        new_track = np.ones(len(times), dtype=bool)
+        new_track[1:] = np.diff(times) > max(90, level * 1.5)
+        prev_lats = np.concatenate(([0.0], lats[:-1]))
+        prev_lons = np.concatenate(([0.0], lons[:-1]))
+        prev_lats[new_track] = 0.0
+        prev_lons[new_track] = 0.0
+        keep = (lats != prev_lats) | (lons != prev_lons)
+
+        # Tracks with fewer than two points are discarded before any simplification. If there are too many tracks for
+        # max_points to allow for even their end points, only the longest are kept.
+        track_ids = np.cumsum(new_track)[keep]
+        track_lats = lats[keep]
+        track_lons = lons[keep]
+        starts = np.flatnonzero(np.concatenate(([True], track_ids[1:] != track_ids[:-1])))
+        lengths = np.diff(np.concatenate((starts, [len(track_ids)])))
+        wanted = lengths > 1
+        if ((not(max_points is None)) and (np.count_nonzero(wanted) * 4 > max_points)):
+            step = np.concatenate((distances(track_lats, track_lons), [0.0]))
+            step[starts[1:] - 1] = 0.0 # The step from the end of one track to the start of the next isn't part of either
+            track_length = np.add.reduceat(step, starts)
+            track_length[~wanted] = -1.0
+            wanted = np.zeros(len(starts), dtype=bool)
+            wanted[np.argsort(-track_length, kind='stable')[0:max(1, int(max_points / 4))]] = True
+            wanted = wanted & (lengths > 1)
+        selected = np.repeat(wanted, lengths)
+        track_lats = track_lats[selected]
+        track_lons = track_lons[selected]
+        lengths = lengths[wanted]
+        starts = (np.cumsum(lengths) - lengths).tolist()
+        if len(starts) > 0:
+            if ((not(tolerance is None)) or (not(max_points is None))):
+                simple = simplify(track_lats, track_lons, tolerance=(tolerance or 0.0), max_points=max_points, starts=starts)
+                starts = (np.cumsum(simple)[starts] - 1).tolist()
+                track_lats = track_lats[simple]
+                track_lons = track_lons[simple]
+            coordinates = np.column_stack((track_lons, track_lats))
+            starts.append(len(coordinates))
+            for j in range(0, len(starts) - 1):
+                geo.append(coordinates[starts[j]:starts[j + 1]])
+
+    events = Event.objects.filter(user=user.profile, timestart__gte=dts, timeend__lte=dte)
+    if max_speed[0] > 10:
+        poi.append({"type": "Point", "coordinates": [max_speed[2], max_speed[1]], "properties": {"type": "poi", "time": max_speed[3], "label": "Maximum speed " + str(max_speed[0]) + "mph at " + str(max_speed[3].strftime('%H:%M:%S'))}})
+    if not(max_height[3] is None):
+        height_diff = max_height[0] - min_height
+        if ((height_diff > 50) or (max_height[0] > 200)):
+            poi.append({"type": "Point", "coordinates": [max_height[2], max_height[1]], "properties": {"type": "poi", "time": max_height[3], "label": "Maximum elevation " + str(int(max_height[0])) + "m at " + str(max_height[3].strftime('%H:%M:%S'))}})
+
+    polyline = {"type":"MultiLineString","coordinates":geo}
+    if events.count() + len(poi) == 0:
+        geometry = polyline
+    else:
+        geometry = {"type": "GeometryCollection", "geometries": [polyline]}
+        for p in poi:
+            geometry['geometries'].append(p)
+        for event in events:
+            geometry['geometries'].append({"type": "Point", "coordinates": [event.lon, event.lat], "properties": {"type": "stop", "arrive": event.timestart, "leave": event.timeend, "label": "Stopped for " + friendly_time((event.timeend - event.timestart).total_seconds())}})
+    ret = {"type":"Feature", "bbox":[minlon, maxlat, maxlon, minlat], "properties":{"distance": dist}, "geometry":geometry}
+    return ret
+
+def route_size(geojson):
+    """ Returns the number of co-ordinates in the route part of a GeoJSON Feature generated by route_geojson. """
+    geometry = geojson['geometry']
+    if geometry['type'] == 'GeometryCollection':
+        geometry = geometry['geometries'][0]
+    return sum([len(track) for track in geometry['coordinates']])
+
+def iter_json(data):
+    """
+    Encodes a dictionary as JSON, a piece at a time. Lists of lists, such as the tracks of a MultiLineString, are
+    encoded one element at a time, and numpy arrays ROUTE_STREAM_ROWS rows at a time, so a very long route can be sent
+    to the client without ever building the whole response, or a list of Python floats for every co-ordinate, in
+    memory. Only the encoding is streamed; the route itself is built by route_geojson first. Intended to be used with
+    StreamingHttpResponse.
+    """
+    buffer = []
+    size = 0
+    for piece in _iter_json(data, JSONEncoder()):
+        buffer.append(piece)
+        size = size + len(piece)
+        if size >= ROUTE_STREAM_BUFFER:
+            yield ''.join(buffer)
+            buffer = []
+            size = 0
+    if len(buffer) > 0:
+        yield ''.join(buffer)
+
+def _iter_json(data, encoder):
+    """ Does the work for iter_json. Lists of co-ordinate pairs are encoded in one go, arrays of them in pieces, and anything nested more deeply is split up. """
+    if isinstance(data, np.ndarray):
+        yield '['
+        for i in range(0, len(data), ROUTE_STREAM_ROWS):
+            if i > 0:
+                yield ', '
+            yield encoder.encode(data[i:i + ROUTE_STREAM_ROWS].tolist())[1:-1]
+        yield ']'
+    elif isinstance(data, dict):
+        yield '{'
+        first = True
+        for k, v in data.items():
+            if not(first):
+                yield ', '
+            first = False
+            yield json.dumps(str(k)) + ': '
+            yield from _iter_json(v, encoder)
+        yield '}'
+    elif ((isinstance(data, list)) and (len(data) > 0) and ((isinstance(data[0], (dict, np.ndarray))) or ((isinstance(data[0], list)) and (len(data[0]) > 0) and (isinstance(data[0][0], (list, dict)))))):
+        yield '['
+        for i in range(0, len(data)):
+            if i > 0:
+                yield ', '
+            yield from _iter_json(data[i], encoder)
+        yield ']'
+    else:
+        yield encoder.encode(data)
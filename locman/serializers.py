@@ -6,7 +6,7 @@ class EventSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Event
-        fields = ['timestart', 'timeend', 'lat', 'lon', 'amenities']
+        fields = ['timestart', 'timeend', 'lat', 'lon', 'amenities', 'amenities_status']
 
 class PositionSerializer(serializers.ModelSerializer):
 
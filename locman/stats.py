@@ -0,0 +1,50 @@
+from django.db.models import Q, Subquery
+from .models import Position, Event, UserStats
+
+STATS_FIELDS = ['last_explicit', 'last_calculated', 'last_event']
+
+def _latest(user, field):
+    """ Returns a query for the value of one of the STATS_FIELDS, worked out from the position and event tables. """
+    if field == 'last_explicit':
+        return Position.objects.filter(user=user.profile, explicit=True).order_by('-time').values('time')[:1]
+    if field == 'last_calculated':
+        return Position.objects.filter(user=user.profile, explicit=False, source='cron').order_by('-time').values('time')[:1]
+    return Event.objects.filter(user=user.profile).order_by('-timestart').values('timestart')[:1]
+
+def refresh_stats(user, fields=None):
+    """
+    Works out some or all of a user's UserStats again from the position and event tables, creating them if they
+    don't exist yet. Each field is a single indexed lookup of the latest row, done within the UPDATE statement
+    itself. Call this after deleting positions or events that might have been the latest; call advance_stats after
+    adding them.
+
+    :param fields: Optional, a list of the STATS_FIELDS to work out. Defaults to all of them.
+    """
+    if fields is None:
+        fields = STATS_FIELDS
+    UserStats.objects.bulk_create([UserStats(user=user.profile)], ignore_conflicts=True)
+    UserStats.objects.filter(pk=user.profile.pk).update(**{field: Subquery(_latest(user, field)) for field in fields})
+
+def advance_stats(user, **values):
+    """
+    Moves some of a user's UserStats forward, after positions or events have been added. Each is a single conditional
+    UPDATE, so concurrent callers can't move a value backwards. Should be called within the same transaction as the
+    rows are written.
+
+    :param values: Keyword arguments, each one of STATS_FIELDS and the latest datetime just written (or None).
+    """
+    for field, dt in values.items():
+        if dt is None:
+            continue
+        query = UserStats.objects.filter(Q(pk=user.profile.pk) & (Q(**{field + '__isnull': True}) | Q(**{field + '__lt': dt})))
+        if ((query.update(**{field: dt}) == 0) and (not(UserStats.objects.filter(pk=user.profile.pk).exists()))):
+            refresh_stats(user) # Created from scratch, which includes what has just been written
+            return
+
+def user_stats(user):
+    """ Returns a user's UserStats, working them out first if they have never been recorded. """
+    stats = UserStats.objects.filter(pk=user.profile.pk).first()
+    if stats is None:
+        refresh_stats(user)
+        stats = UserStats.objects.get(pk=user.profile.pk)
+    return stats
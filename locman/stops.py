@@ -0,0 +1,137 @@
+from .geodesy import haversine
+import numpy as np
+
+STOP_DETECTORS = ['speed_gap', 'dwell']
+
+def _empty_stops():
+    return {'start': np.zeros(0), 'end': np.zeros(0), 'lat': np.zeros(0), 'lon': np.zeros(0), 'resume': None}
+
+def _mean_positions(points, starts, ends):
+    """ Returns the average latitude and longitude of all the positions between each start and end time, inclusive. """
+    times = points['time']
+    i = np.searchsorted(times, starts, side='left')
+    j = np.searchsorted(times, ends, side='right')
+    count = np.maximum(j - i, 1)
+    lat_total = np.concatenate(([0.0], np.cumsum(points['lat'])))
+    lon_total = np.concatenate(([0.0], np.cumsum(points['lon'])))
+    return (lat_total[j] - lat_total[i]) / count, (lon_total[j] - lon_total[i]) / count
+
+def speed_gap(points, max_speed=2, min_length=300, regression=False, **kwargs):
+    """
+    The original stop detection heuristic. A stop is a gap of at least `min_length` seconds between two positions
+    at which the user was moving faster than `max_speed`, with moving positions less than a minute either side of it.
+    Stops less than `min_length` seconds apart are merged.
+
+    :param points: A dictionary of numpy arrays, as returned by load_positions.
+    :param max_speed: The speed in miles per hour that the user needs to be moving before we consider it not part of a 'stop'.
+    :param min_length: The minimum length of a stop, in seconds.
+    :param regression: If True, reproduce generate_events from before stop detection was streamed exactly, including its habit of never checking the last possible window of moving positions.
+    :return: A dictionary of numpy arrays: 'start' and 'end' (seconds since the epoch), and 'lat' and 'lon' (the average position during the stop). 'resume' is always None.
+    :rtype: dict
+    """
+    moving = np.nan_to_num(points['speed'], nan=-1.0) > max_speed
+    times = points['time'][moving]
+    windows = len(times) - (4 if regression else 3)
+    if windows <= 0:
+        return _empty_stops()
+    gaps = np.diff(times)
+    hit = np.flatnonzero((gaps[1:windows + 1] >= min_length) & (gaps[0:windows] < 60) & (gaps[2:windows + 2] < 60))
+    if len(hit) == 0:
+        return _empty_stops()
+    starts = times[hit + 1]
+    ends = times[hit + 2]
+    new = np.ones(len(starts), dtype=bool)
+    new[1:] = (starts[1:] - ends[:-1]) >= min_length
+    last = np.concatenate((np.flatnonzero(new)[1:] - 1, [len(starts) - 1]))
+    ret = {'start': starts[new], 'end': ends[last], 'resume': None}
+    ret['lat'], ret['lon'] = _mean_positions(points, ret['start'], ret['end'])
+    return ret
+
+def dwell(points, radius=100, min_length=300, resample=30, **kwargs):
+    """
+    Finds stops by clustering positions in time: a stop is a run of consecutive positions that all lie within
+    `radius` metres of the first, lasting at least `min_length` seconds. Positions are thinned to one every `resample`
+    seconds first, and positions at exactly 0,0 are ignored. The run at the very end of the data may still be growing,
+    so it is never reported; instead its start is returned as 'resume', the point from which detection should be run
+    again once there is more data.
+
+    :param points: A dictionary of numpy arrays, as returned by load_positions.
+    :param radius: The distance, in metres, the user may wander while still being considered stopped.
+    :param min_length: The minimum length of a stop, in seconds.
+    :param resample: The minimum time, in seconds, between the positions considered.
+    :return: A dictionary of numpy arrays, as returned by speed_gap, plus 'resume', a time in seconds since the epoch or None if there was no data.
+    :rtype: dict
+    """
+    located = (points['lat'] != 0.0) | (points['lon'] != 0.0)
+    times = points['time'][located]
+    buckets = np.floor(times / resample)
+    keep = np.concatenate(([True], buckets[1:] != buckets[:-1])) if len(times) > 0 else np.zeros(0, dtype=bool)
+    times = times[keep]
+    lats = points['lat'][located][keep]
+    lons = points['lon'][located][keep]
+    n = len(times)
+    ret = _empty_stops()
+    if n == 0:
+        return ret
+    # An anchor can only start a stop if the first position at least min_length seconds later is still within radius
+    # of it, so every other anchor can be ruled out in one go. Those too near the end to tell stay in.
+    reach = np.searchsorted(times, times + min_length, side='left')
+    possible = reach >= n
+    known = ~possible
+    possible[known] = haversine(lats[known], lons[known], lats[reach[known]], lons[reach[known]]) <= radius
+    candidates = np.flatnonzero(possible)
+    starts = []
+    ends = []
+    stop_lats = []
+    stop_lons = []
+    i = 0
+    while True:
+        k = np.searchsorted(candidates, i)
+        if k >= len(candidates):
+            break
+        i = int(candidates[k])
+        # Find the first position after i that is more than `radius` from it, looking further ahead each time.
+        j = i + 1
+        block = 8
+        left = False
+        while j < n:
+            hi = min(n, j + block)
+            outside = np.flatnonzero(haversine(lats[i], lons[i], lats[j:hi], lons[j:hi]) > radius)
+            if len(outside) > 0:
+                j = j + int(outside[0])
+                left = True
+                break
+            j = hi
+            block = block * 2
+        if not(left):
+            ret['resume'] = float(times[i])
+            break
+        if times[j - 1] - times[i] >= min_length:
+            starts.append(times[i])
+            ends.append(times[j - 1])
+            stop_lats.append(np.mean(lats[i:j]))
+            stop_lons.append(np.mean(lons[i:j]))
+            i = j
+        else:
+            i = i + 1
+    ret['start'] = np.array(starts, dtype=np.float64)
+    ret['end'] = np.array(ends, dtype=np.float64)
+    ret['lat'] = np.array(stop_lats, dtype=np.float64)
+    ret['lon'] = np.array(stop_lons, dtype=np.float64)
+    return ret
+
+def detect_stops(points, method='speed_gap', **kwargs):
+    """
+    Runs one of the stop detectors over a set of positions. Any keyword arguments are passed to the detector, and
+    those it doesn't use are ignored, so the same settings can be tried with each.
+
+    :param points: A dictionary of numpy arrays, as returned by load_positions.
+    :param method: The name of the detector, one of STOP_DETECTORS.
+    :return: A dictionary of numpy arrays, as returned by the detector.
+    :rtype: dict
+    """
+    if method == 'speed_gap':
+        return speed_gap(points, **kwargs)
+    if method == 'dwell':
+        return dwell(points, **kwargs)
+    raise ValueError("Unknown stop detector: '" + str(method) + "'")
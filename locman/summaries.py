@@ -0,0 +1,244 @@
+from django.db import transaction
+from django.db.models import Min, Max
+from .models import DaySummary, PositionRollup
+from .functions import load_positions
+from .pyramid import update_rollups, ROLLUP_RESOLUTIONS
+from .geodesy import distance, distances
+import numpy as np
+import datetime, pytz
+
+SUMMARY_FIELDS = ['points', 'distance', 'minlat', 'minlon', 'maxlat', 'maxlon', 'min_elevation', 'max_elevation', 'max_elevation_lat', 'max_elevation_lon', 'max_elevation_time', 'max_speed', 'max_speed_lat', 'max_speed_lon', 'max_speed_time', 'first_time', 'first_lat', 'first_lon', 'last_time', 'last_lat', 'last_lon']
+
+def _day_start(date):
+    return datetime.datetime(date.year, date.month, date.day, 0, 0, 0, tzinfo=pytz.utc)
+
+def _slice_points(points, dts, dte):
+    """ Returns the part of a set of arrays returned by load_positions that falls between dts and dte, inclusive. """
+    i = np.searchsorted(points['time'], dts.timestamp(), side='left')
+    j = np.searchsorted(points['time'], dte.timestamp(), side='right')
+    ret = {}
+    for k in points.keys():
+        ret[k] = points[k][i:j]
+    return ret
+
+def summarise_points(points):
+    """
+    Calculates summary statistics for a set of positions. Distances are in metres, and positions at exactly 0,0 (usually a
+    GPS device reporting that it has no fix) are ignored when calculating distance and bounding box.
+
+    :param points: A dictionary of numpy arrays, as returned by load_positions.
+    :return: A dictionary with the same keys as SUMMARY_FIELDS, or None if there are no points.
+    :rtype: dict
+    """
+    times = points['time']
+    lats = points['lat']
+    lons = points['lon']
+    if len(times) == 0:
+        return None
+    speeds = np.nan_to_num(points['speed'], nan=-1.0)
+    elevations = points['elevation']
+    ret = {}
+    for k in SUMMARY_FIELDS:
+        ret[k] = None
+    ret['points'] = len(times)
+    step = distances(lats, lons)
+    ret['distance'] = float(np.sum(step[(lats[:-1] != 0.0) & (lons[:-1] != 0.0)]))
+    located = (lats != 0.0) | (lons != 0.0)
+    if located.any():
+        ret['minlat'] = float(np.min(lats[located]))
+        ret['minlon'] = float(np.min(lons[located]))
+        ret['maxlat'] = float(np.max(lats[located]))
+        ret['maxlon'] = float(np.max(lons[located]))
+    i = int(np.argmax(speeds))
+    if speeds[i] >= 0:
+        ret['max_speed'] = int(speeds[i])
+        ret['max_speed_lat'] = float(lats[i])
+        ret['max_speed_lon'] = float(lons[i])
+        ret['max_speed_time'] = datetime.datetime.fromtimestamp(times[i], tz=pytz.utc)
+    if not(np.isnan(elevations).all()):
+        i = int(np.nanargmax(elevations))
+        ret['min_elevation'] = float(np.nanmin(elevations))
+        ret['max_elevation'] = float(elevations[i])
+        ret['max_elevation_lat'] = float(lats[i])
+        ret['max_elevation_lon'] = float(lons[i])
+        ret['max_elevation_time'] = datetime.datetime.fromtimestamp(times[i], tz=pytz.utc)
+    ret['first_time'] = datetime.datetime.fromtimestamp(times[0], tz=pytz.utc)
+    ret['first_lat'] = float(lats[0])
+    ret['first_lon'] = float(lons[0])
+    ret['last_time'] = datetime.datetime.fromtimestamp(times[-1], tz=pytz.utc)
+    ret['last_lat'] = float(lats[-1])
+    ret['last_lon'] = float(lons[-1])
+    return ret
+
+def combine_summaries(summaries):
+    """
+    Combines a list of summaries, in time order, into a single summary of the whole timespan they cover. The distance
+    between the end of each summary and the start of the next is included.
+
+    :param summaries: A list of dictionaries as returned by summarise_points. None values are ignored.
+    :return: A dictionary with the same keys as SUMMARY_FIELDS, or None if there is nothing to combine.
+    :rtype: dict
+    """
+    ret = None
+    for item in summaries:
+        if item is None:
+            continue
+        if ret is None:
+            ret = dict(item)
+            continue
+        if ((ret['last_lat'] != 0.0) & (ret['last_lon'] != 0.0)):
+            ret['distance'] = ret['distance'] + distance(ret['last_lat'], ret['last_lon'], item['first_lat'], item['first_lon'])
+        ret['distance'] = ret['distance'] + item['distance']
+        ret['points'] = ret['points'] + item['points']
+        for k in ['minlat', 'minlon', 'min_elevation']:
+            if ((ret[k] is None) or ((not(item[k] is None)) and (item[k] < ret[k]))):
+                ret[k] = item[k]
+        for k in ['maxlat', 'maxlon']:
+            if ((ret[k] is None) or ((not(item[k] is None)) and (item[k] > ret[k]))):
+                ret[k] = item[k]
+        for k in ['max_speed', 'max_elevation']:
+            if ((ret[k] is None) or ((not(item[k] is None)) and (item[k] > ret[k]))):
+                for field in [k, k + '_lat', k + '_lon', k + '_time']:
+                    ret[field] = item[field]
+        for k in ['last_time', 'last_lat', 'last_lon']:
+            ret[k] = item[k]
+    return ret
+
+def update_day_summaries(user, dts, dte):
+    """
+    Recalculates the DaySummary objects, and the rollup pyramid, for every day (UTC) touched by the timespan between
+    dts and dte. Should be called whenever positions within the timespan have been added, changed or removed.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :return: The number of days updated.
+    :rtype: int
+    """
+    day = dts.astimezone(pytz.utc).date()
+    last_day = dte.astimezone(pytz.utc).date()
+    count = 0
+    while day <= last_day:
+        start = _day_start(day)
+        end = start + datetime.timedelta(days=1) - datetime.timedelta(microseconds=1)
+        points = load_positions(user, start, end)
+        summary = summarise_points(points)
+        update_rollups(user, start, end, points) # Before the summary, as a day's rollups are only read once it has one
+        with transaction.atomic():
+            DaySummary.objects.filter(user=user.profile, date=day).delete()
+            if not(summary is None):
+                DaySummary.objects.create(user=user.profile, date=day, **summary)
+        count = count + 1
+        day = day + datetime.timedelta(days=1)
+    return count
+
+def _split_days(user, dts, dte):
+    """
+    Splits the timespan between dts and dte into days (UTC), each with its DaySummary. Days without one, either
+    because there are no positions or because the positions have changed since it was built, must be read from the raw
+    positions instead, so runs of them are merged into a single part.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :return: A list of (start, end, summary) tuples in time order, covering the timespan. summary is a dictionary of the day's SUMMARY_FIELDS, or None.
+    :rtype: list
+    """
+    dts = dts.astimezone(pytz.utc)
+    dte = dte.astimezone(pytz.utc)
+    summaries = {}
+    for summary in DaySummary.objects.filter(user=user.profile, date__gte=dts.date(), date__lte=dte.date()).values('date', *SUMMARY_FIELDS):
+        summaries[summary.pop('date')] = summary
+    ret = []
+    day = dts.date()
+    while day <= dte.date():
+        start = max(dts, _day_start(day))
+        end = min(dte, _day_start(day) + datetime.timedelta(days=1) - datetime.timedelta(microseconds=1))
+        summary = summaries.get(day)
+        if ((summary is None) and (len(ret) > 0) and (ret[-1][2] is None)):
+            ret[-1] = (ret[-1][0], end, None)
+        else:
+            ret.append((start, end, summary))
+        day = day + datetime.timedelta(days=1)
+    return ret
+
+def summarise(user, dts, dte, points=None):
+    """
+    Returns summary statistics for a user's positions between dts and dte. Days lying entirely within the timespan are
+    taken from the DaySummary table, so only the partial days at either end, and any days whose summaries haven't been
+    built yet, need to be read from the raw positions.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :param points: Optional, the arrays returned by load_positions for this timespan, if the caller already has them. The raw positions are then taken from these rather than read again.
+    :return: A dictionary with the same keys as SUMMARY_FIELDS, or None if there is no data in the timespan.
+    :rtype: dict
+    """
+    summaries = []
+    for start, end, summary in _split_days(user, dts, dte):
+        day_start = _day_start(start.date())
+        if ((not(summary is None)) and (start == day_start) and (end >= day_start + datetime.timedelta(days=1) - datetime.timedelta(seconds=1))):
+            summaries.append(summary)
+        elif points is None:
+            summaries.append(summarise_points(load_positions(user, start, end)))
+        else:
+            summaries.append(summarise_points(_slice_points(points, start, end)))
+    return combine_summaries(summaries)
+
+def _combine_bbox(a, b):
+    """ Combines two bounding boxes, as returned by the aggregates in bounding_box. Either may have None values. """
+    ret = {}
+    for k in ['minlat', 'minlon']:
+        ret[k] = min([x for x in [a[k], b[k]] if not(x is None)], default=None)
+    for k in ['maxlat', 'maxlon']:
+        ret[k] = max([x for x in [a[k], b[k]] if not(x is None)], default=None)
+    return ret
+
+def _bbox_span(user, start, end, levels):
+    """
+    Does the work for bounding_box. Finds the bounding box of the positions from `start` (inclusive) to `end`
+    (exclusive), both in seconds since the epoch, using the whole buckets of the first rollup level in `levels` and the
+    remaining levels for the parts left over at either end. If `levels` is empty, the raw positions are read.
+    """
+    empty = {'minlat': None, 'minlon': None, 'maxlat': None, 'maxlon': None}
+    if start >= end:
+        return empty
+    dts = datetime.datetime.fromtimestamp(start, tz=pytz.utc)
+    dte = datetime.datetime.fromtimestamp(end, tz=pytz.utc)
+    if len(levels) == 0:
+        points = load_positions(user, dts, dte)
+        located = ((points['lat'] != 0.0) | (points['lon'] != 0.0)) & (points['time'] < end)
+        if not(located.any()):
+            return empty
+        return {'minlat': float(np.min(points['lat'][located])), 'minlon': float(np.min(points['lon'][located])), 'maxlat': float(np.max(points['lat'][located])), 'maxlon': float(np.max(points['lon'][located]))}
+    level = levels[0]
+    a = np.ceil(start / level) * level
+    b = np.floor(end / level) * level
+    if a >= b:
+        return _bbox_span(user, start, end, levels[1:])
+    query = PositionRollup.objects.filter(user=user.profile, resolution=level, time__gte=datetime.datetime.fromtimestamp(a, tz=pytz.utc), time__lt=datetime.datetime.fromtimestamp(b, tz=pytz.utc))
+    ret = query.aggregate(minlat=Min('minlat'), minlon=Min('minlon'), maxlat=Max('maxlat'), maxlon=Max('maxlon'))
+    ret = _combine_bbox(ret, _bbox_span(user, start, a, levels[1:]))
+    ret = _combine_bbox(ret, _bbox_span(user, b, end, levels[1:]))
+    return ret
+
+def bounding_box(user, dts, dte):
+    """
+    Returns the bounding box of a user's positions between dts and dte, ignoring any positions at exactly 0,0. Whole
+    days come from the DaySummary table and whole hours, ten minute periods and minutes from the rollup pyramid, so at
+    most a couple of minutes at either end of the timespan need to be read from the raw positions. Days whose
+    summaries (and so rollups) haven't been built yet are read from the raw positions.
+
+    :param dts: A datetime representing the start of the timespan.
+    :param dte: A datetime representing the end of the timespan.
+    :return: A dictionary with the keys minlat, minlon, maxlat and maxlon, which are None if there is no data.
+    :rtype: dict
+    """
+    levels = sorted(ROLLUP_RESOLUTIONS, reverse=True)
+    ret = {'minlat': None, 'minlon': None, 'maxlat': None, 'maxlon': None}
+    for start, end, summary in _split_days(user, dts, dte):
+        if summary is None:
+            ret = _combine_bbox(ret, _bbox_span(user, start.timestamp(), end.timestamp() + 0.000001, []))
+        elif ((start == _day_start(start.date())) and (end == start + datetime.timedelta(days=1) - datetime.timedelta(microseconds=1))):
+            ret = _combine_bbox(ret, summary)
+        else:
+            ret = _combine_bbox(ret, _bbox_span(user, start.timestamp(), end.timestamp() + 0.000001, levels))
+    return ret
@@ -1,12 +1,38 @@
 from background_task import background
-from .models import Position
+from .models import Position, ImportedFile
 from django.contrib.auth.models import User
 from django.db.models import Max, Min, Avg
-from django.core.cache import cache
-from background_task.models import Task
-from .functions import generate_events, extrapolate_position, calculate_speed
-from .functions import parse_file_fit, parse_file_gpx, parse_file_csv, import_data
-import datetime, pytz, os
+from .functions import generate_events, regenerate_events, calculate_speeds, fill_gaps, FILL_WINDOW
+from .functions import parse_file_fit, parse_file_gpx, parse_file_csv, import_data, file_digest
+from .summaries import update_day_summaries
+from .archive import archive_positions, archive_age
+from .amenities import enrich_pending_events
+from .jobs import request_job, start_job, finish_job
+import datetime, pytz, os, math
+
+def queue_job(user_id, stage):
+    """
+    Asks for a stage of a user's processing ('fill', 'events' or 'enrich') to be run. The task is queued straight
+    away if it can start; otherwise it is queued as soon as whatever it is waiting for has finished. Asking again
+    before it has run makes no difference.
+    """
+    if request_job(User.objects.get(pk=user_id), stage):
+        STAGE_TASKS[stage](user_id)
+
+def _queue_ready(user_id, stages):
+    """ Queues the tasks for the stages returned by finish_job. """
+    for stage in stages:
+        STAGE_TASKS[stage](user_id)
+
+def queue_import(user_id, filename, source, format="", method='bulk', force=False):
+    """ Queues a file for importing. Always use this rather than queueing import_uploaded_file directly, so that later stages know to wait for it. """
+    request_job(User.objects.get(pk=user_id), 'import')
+    import_uploaded_file(user_id, filename, source, format, method, force)
+
+def queue_refill(user_id, start_time, end_time, events_start=None, events_end=None):
+    """ Queues a span of history for filling in again. Always use this rather than queueing refill_span directly, so that later stages know to wait for it. """
+    request_job(User.objects.get(pk=user_id), 'refill')
+    refill_span(user_id, start_time, end_time, events_start, events_end)
 
 @background(schedule=0, queue='process')
 def generate_location_events(user_id):
@@ -15,121 +41,169 @@ def generate_location_events(user_id):
     know about the places defined in the Viewer, but it can tell you when and where the user stopped for
     more than a particular amount of time. The Viewer can check this in order to create loc_prox events.
     """
-    if Task.objects.filter(queue='process', task_name__icontains='tasks.generate_location_events').count() > 1:
-        return # If there's already an instance of this task running or queued, don't start another.
-    if Task.objects.filter(queue='process', task_name__icontains='tasks.fill_locations').count() > 1:
-        generate_location_events(user_id, schedule=60) # If a fill_locations task is running or queued, defer for 60 seconds.
-        return
-    if Task.objects.filter(queue='imports', task_name__icontains='tasks.import_uploaded_file').count() > 0:
-        generate_location_events(user_id, schedule=60) # If there are imports running or queued, quit and reschedule for 60 seconds time.
-        return
     user = User.objects.get(pk=user_id)
-    generate_events(user)
+    if not(start_job(user, 'events')):
+        return # Already running, or waiting for an import or fill to finish, which will queue it again
+    try:
+        if len(generate_events(user)) > 0:
+            queue_job(user_id, 'enrich') # Look up the amenities near the new events separately, so slow lookups don't hold this up
+    finally:
+        _queue_ready(user_id, finish_job(user, 'events'))
+
+@background(schedule=0, queue='process')
+def enrich_event_amenities(user_id):
+    """
+    A background task for looking up the amenities near events that have been generated but not yet enriched, a
+    batch at a time. It reschedules itself while there are events waiting, including those waiting to be retried
+    after a failed lookup.
+    """
+    user = User.objects.get(pk=user_id)
+    if not(start_job(user, 'enrich')):
+        return # Already running
+    delay = None
+    try:
+        delay = enrich_pending_events(user)
+    finally:
+        _queue_ready(user_id, finish_job(user, 'enrich'))
+    if ((not(delay is None)) and (request_job(user, 'enrich'))):
+        enrich_event_amenities(user_id, schedule=int(math.ceil(delay)))
+
+@background(schedule=0, queue='process')
+def update_summaries(user_id, start_time, end_time):
+    """
+    A background task for bringing the daily summaries and the rollup pyramid up to date, after positions
+    have been added or changed. Only the days touched by the timespan are rebuilt.
+
+    :param start_time: The start of the timespan, in seconds since the epoch.
+    :param end_time: The end of the timespan, in seconds since the epoch.
+    """
+    user = User.objects.get(pk=user_id)
+    update_day_summaries(user, datetime.datetime.fromtimestamp(start_time, tz=pytz.utc), datetime.datetime.fromtimestamp(end_time, tz=pytz.utc))
+
+@background(schedule=0, queue='process')
+def refill_span(user_id, start_time, end_time, events_start=None, events_end=None):
+    """
+    A background task for filling in the gaps in a span of history whose calculated positions were thrown away
+    because an import changed the positions within it (see functions.invalidate_span), and then generating the
+    events within it again, if needed. Unlike fill_locations, only the span itself is touched. Queue it with
+    queue_refill.
+
+    :param start_time: The start of the span to fill, in seconds since the epoch.
+    :param end_time: The end of the span to fill, in seconds since the epoch.
+    :param events_start: Optional, the start of the span whose events need generating again, in seconds since the epoch.
+    :param events_end: Optional, the end of the span whose events need generating again, in seconds since the epoch.
+    """
+    user = User.objects.get(pk=user_id)
+    if not(start_job(user, 'refill')):
+        return
+    try:
+        dt = datetime.datetime.fromtimestamp(start_time, tz=pytz.utc)
+        max_dt = datetime.datetime.fromtimestamp(end_time, tz=pytz.utc)
+        while(dt < max_dt):
+            dte = min(dt + FILL_WINDOW, max_dt)
+            fill_gaps(user, dt, dte, 'cron')
+            dt = dte
+        update_summaries(user_id, start_time, end_time)
+        if not(events_start is None):
+            if len(regenerate_events(user, datetime.datetime.fromtimestamp(events_start, tz=pytz.utc), datetime.datetime.fromtimestamp(events_end, tz=pytz.utc))) > 0:
+                queue_job(user_id, 'enrich')
+    finally:
+        _queue_ready(user_id, finish_job(user, 'refill'))
 
 @background(schedule=0, queue='process')
 def fill_locations(user_id):
     """
     A background task for going through the explicitly imported position data and filling in any gaps by
-    calling extrapolate_position. If this task is complete to the best of our ability, call the function
-    for generating events.
+    calling fill_gaps, a week at a time. If this task is complete to the best of our ability, ask for events
+    to be generated.
     """
     user = User.objects.get(pk=user_id)
-
-    if Task.objects.filter(queue='process', task_name__icontains='tasks.fill_locations').count() > 1:
-        return # If there's already an instance of this task running, don't start another.
-    if Task.objects.filter(queue='imports', task_name__icontains='tasks.import_uploaded_file').count() > 1:
-        fill_locations(user_id, schedule=60)
-        return # Hold off if we're still importing files
+    if not(start_job(user, 'fill')):
+        return # Already running, or waiting for an import to finish, which will queue it again
     try:
         min_dt = Position.objects.filter(user=user.profile, explicit=False, source='cron').aggregate(Max('time'))['time__max']
-    except:
-        min_dt = None
-    if min_dt is None:
-        min_dt = Position.objects.filter(user=user.profile).aggregate(Min('time'))['time__min']
-    max_dt = Position.objects.filter(user=user.profile).aggregate(Max('time'))['time__max']
-    if max_dt is None: # The database is probably empty, so just quit quietly
-        return
-    med_dt = min_dt + datetime.timedelta(days=28)
-    is_med = False
-    if med_dt < max_dt:
-        is_med = True
-        max_dt = med_dt # ensure we don't go completely crazy with the extrapolating
-    if Task.objects.filter(queue='imports', task_name__icontains='tasks.import_uploaded_file', locked_by=None).count() > 0:
-        fill_locations(user_id, schedule=60) # If there are imports running, quit and reschedule for 60 seconds time
-        return
-    if Task.objects.filter(queue='imports', task_name__icontains='tasks.import_uploaded_file').count() > 1:
-        fill_locations(user_id, schedule=60) # If there are multiple imports queued, quit and reschedule for 60 seconds time
-        return
-
-    dt = min_dt + datetime.timedelta(minutes=5)
-    addcount = 0
-    while(dt < max_dt):
-        try:
-            pos = Position.objects.get(user=user.profile, time=dt)
-        except:
-            pos = extrapolate_position(user, dt, 'cron')
-            if pos:
-                addcount = addcount + 1
-
-        if pos.speed is None:
-            pos.speed = calculate_speed(pos)
-            pos.save()
-
-        if cache.has_key('last_calculated_position'):
-            last_max = cache.get('last_calculated_position')
-            di = dt.timestamp()
-            if di > last_max:
-                cache.set('last_calculated_position', di, 86400)
-
-        dt = dt + datetime.timedelta(seconds=60)
-
-    if is_med:
-        fill_locations(user_id, schedule=60) # If there are still explicit locations stored, quit and reschedule for 60 seconds time
-    else:
-        generate_location_events(user_id) # Otherwise generate some events
+        if min_dt is None:
+            min_dt = Position.objects.filter(user=user.profile).aggregate(Min('time'))['time__min']
+        else:
+            min_dt = min_dt + datetime.timedelta(seconds=60)
+        max_dt = Position.objects.filter(user=user.profile).aggregate(Max('time'))['time__max']
+        if max_dt is None: # The database is probably empty, so just quit quietly
+            return
+
+        dt = min_dt
+        while(dt < max_dt):
+            dte = min(dt + FILL_WINDOW, max_dt)
+            fill_gaps(user, dt, dte, 'cron')
+            dt = dte
+        update_summaries(user_id, min_dt.timestamp(), max_dt.timestamp())
+
+        age = archive_age()
+        if not(age is None):
+            archive_positions(user, datetime.datetime.now(tz=pytz.utc) - age) # Move anything that has become old enough into the archive
+
+        request_job(user, 'events') # Once everything is filled in, generate some events. It starts when this finishes.
+    finally:
+        _queue_ready(user_id, finish_job(user, 'fill'))
 
 @background(schedule=0, queue='imports')
-def import_uploaded_file(user_id, filename, source, format=""):
+def import_uploaded_file(user_id, filename, source, format="", method='bulk', force=False):
     """
     A background task for importing a data file, previously uploaded via a POST to
     the web interface. Once the import is complete, the function calculates the speed
-    for all imported position values.
+    for all imported position values in a single pass. A file identical to one already
+    imported is skipped, as is anything that follows from an import that changed nothing.
+    Queue it with queue_import.
 
     :param filename: The path of the uploadedfile to import.
     :param source: A string representing the source of the file for future provenance checking, eg 'phone_gps'.
+    :param method: The import method passed to import_data, 'bulk' (default), 'upsert' or 'row'.
+    :param force: If True, import the file even if it, or the data in it, has been imported before.
     """
     user = User.objects.get(pk=user_id)
-
-    if Task.objects.filter(queue='process', task_name__icontains='tasks.fill_locations').count() > 1:
-        import_uploaded_file(user_id, filename, source, format, schedule=60) # If a fill_locations task is running or queued, defer for 60 seconds.
+    if not(start_job(user, 'import')):
         return
-    if format == '':
-
-        if filename.lower().endswith('.gpx'):
-            import_data(user, parse_file_gpx(filename, source), source)
-        if filename.lower().endswith('.fit'):
-            import_data(user, parse_file_fit(filename, source), source)
-        if filename.lower().endswith('.csv'):
-            import_data(user, parse_file_csv(filename, source), source)
-        if filename.lower().endswith('.txt'):
-            import_data(user, parse_file_csv(filename, source), source)
-
-    else:
-
-        if format == 'gpx':
-            import_data(user, parse_file_gpx(filename, source), source)
-        if format == 'fit':
-            import_data(user, parse_file_fit(filename, source), source)
-        if format == 'csv':
-            import_data(user, parse_file_csv(filename, source), source)
+    try:
+        _import_file(user, filename, source, format, method, force)
+    finally:
+        _queue_ready(user_id, finish_job(user, 'import'))
 
+def _import_file(user, filename, source, format, method, force):
+    """ Does the work of import_uploaded_file. """
+    if format == '':
+        format = os.path.splitext(filename)[1].lower().lstrip('.')
+    parsers = {'gpx': parse_file_gpx, 'fit': parse_file_fit, 'csv': parse_file_csv, 'txt': parse_file_csv}
+    stats = None
+    digest = None
     if os.path.exists(filename):
+        digest = file_digest(filename)
+    if ((not(force)) and (not(digest is None)) and (ImportedFile.objects.filter(user=user.profile, sha256=digest).exists())):
         os.remove(filename)
+        return # Seen this exact file before, so there's nothing to do
+    if format in parsers:
+        stats = import_data(user, parsers[format](filename, source), source, method, force)
+        if not(digest is None):
+            ImportedFile.objects.update_or_create(user=user.profile, sha256=digest, defaults={'filename': os.path.basename(filename)[0:255], 'source': source, 'size': os.path.getsize(filename), 'points': stats['inserted'] + stats['updated'] + stats['skipped']})
 
-    dt = datetime.datetime.utcnow().replace(tzinfo=pytz.utc) - datetime.timedelta(days=30)
-    for pos in Position.objects.filter(user=user.profile, time__gte=dt, speed=None).order_by('time'):
-        pos.speed = calculate_speed(pos)
-        pos.save()
-
-    fill_locations(user_id) # Once we're done, call the fill locations task.
+    if os.path.exists(filename):
+        os.remove(filename)
 
+    if ((stats is None) or (stats['changed_start'] is None)):
+        return # Nothing changed, so nothing needs recalculating
+
+    for span in stats['changed']:
+        calculate_speeds(user, span[0], span[1], overwrite=True)
+        update_summaries(user.pk, (span[0] - datetime.timedelta(hours=12)).timestamp(), span[1].timestamp())
+    last_filled = Position.objects.filter(user=user.profile, explicit=False, source='cron').aggregate(Max('time'))['time__max']
+    for span in stats['invalidated']:
+        if ((span['events_start'] is None) and ((last_filled is None) or (span['fill_start'] >= last_filled))):
+            continue # fill_locations carries on from the last calculated position, so will fill this in anyway
+        events_start = None
+        events_end = None
+        if not(span['events_start'] is None):
+            events_start = span['events_start'].timestamp()
+            events_end = span['events_end'].timestamp()
+        queue_refill(user.pk, span['fill_start'].timestamp(), span['fill_end'].timestamp(), events_start, events_end)
+
+    request_job(user, 'fill') # Once we're done, fill in the gaps. It starts when this, and any other imports, have finished.
+
+STAGE_TASKS = {'fill': fill_locations, 'events': generate_location_events, 'enrich': enrich_event_amenities}
@@ -1,3 +1,1548 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.db import connection
+from django.db.models import Max
+from django.core.cache import cache
+from unittest import mock
+from types import SimpleNamespace
+from django.contrib.auth.models import User
+from .models import Position, Event, Watermark, DaySummary, Amenity, AmenityExtract, AmenityCache, Job, UserStats
+from .functions import import_data, calculate_speeds, fill_gaps, generate_events, regenerate_events
+from .functions import extrapolate_position, calculate_speed, parse_file_gpx, parse_file_fit, SEMICIRCLES_TO_DEGREES
+from .functions import _detect_stops, _stop_state_to_json, _stop_state_from_json
+from .backfill import backfill_partitions, backfill_partition
+from .routes import ROUTE_STREAM_THRESHOLD
+from .pyramid import choose_resolution, load_level, ROLLUP_RESOLUTIONS
+from .summaries import summarise, summarise_points, bounding_box, update_day_summaries, SUMMARY_FIELDS
+from .functions import load_positions, get_location_events, get_position, invalidate_positions
+from .serializers import PositionSerializer
+from .views import POSITION_BATCH_LIMIT
+from .archive import write_day, read_day, archived_dates, archive_positions, archived_neighbour
+from .stops import speed_gap, dwell, detect_stops
+from .amenities import query_overpass, local_amenities, known_amenities, nearest_amenities, import_extract, enrich_pending_events, AMENITY_RETRY_DELAY, AMENITY_MAX_ATTEMPTS
+from .tasks import enrich_event_amenities, refill_span, import_uploaded_file
+from .workers import choose_tasks, waiting_tasks, task_shard
+from .stats import advance_stats, refresh_stats, user_stats
+from .functions import get_process_stats
+from .jobs import request_job, start_job, finish_job, JOB_LEASE
+from background_task.models import Task
+from .geodesy import distance, distances, distances_to, cumulative_distance, bearings, simplify, grid_cells, grid_cell, grid_cells_in_box, GRID_CELL_SIZE, GRID_COLUMNS
+import numpy as np
+import datetime, pytz, tempfile, os, math, random, json, shutil, gzip, re, threading, http.server
 
-# Create your tests here.
+def track(start, hours=4, stops=[], step=30, lat=50.0, lon=-1.0, offset=0.0):
+    """
+    Makes a list of (time, lat, lon, alt) rows for import_data, moving north at about 4mph except during the stops.
+
+    :param stops: A list of (start, length) tuples, both in seconds from the start of the track, during which the user doesn't move.
+    :param offset: Added to every latitude, to make a track that differs from another everywhere.
+    """
+    ret = []
+    for i in range(0, int(hours * 3600 / step)):
+        if not(any([((i * step > s) and (i * step <= s + length)) for s, length in stops])):
+            lat = lat + 0.001 * (step / 60)
+        ret.append((start + datetime.timedelta(seconds=i * step), lat + offset, lon, None))
+    return ret
+
+def process(user, dts, dte):
+    """ Calculates the speeds between dts and dte, fills in the gaps, then calculates the speeds again with the new positions in place. """
+    calculate_speeds(user, dts, dte, overwrite=True)
+    fill_gaps(user, dts, dte, 'cron')
+    calculate_speeds(user, dts, dte, overwrite=True)
+
+def varied_track(start):
+    """ Makes a track like track(), lasting 57 hours and wandering east and west, with elevations and an hour a day at 0,0. """
+    ret = []
+    for dt, lat, lon, alt in track(start, hours=57, stops=[(3600, 7200), (40000, 20000)], step=45):
+        lon = lon + 0.01 * math.sin(dt.timestamp() / 5000.0)
+        if dt.hour == 3: # A GPS device with no fix
+            lat = 0.0
+            lon = 0.0
+        ret.append((dt, lat, lon, 20.0 + dt.hour))
+    return ret
+
+def positions(user):
+    return list(Position.objects.filter(user=user.profile).order_by('time').values_list('time', 'lat', 'lon', 'speed', 'explicit', 'source'))
+
+def event_times(user):
+    return list(Event.objects.filter(user=user.profile).order_by('timestart').values_list('timestart', 'timeend'))
+
+class FillGapsTestCase(TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        # Explicit positions at irregular times, some on whole minutes, with gaps of up to 20 minutes
+        self.rows = []
+        t = 30
+        for i in range(0, 60):
+            self.rows.append((self.start + datetime.timedelta(seconds=t), 50.0 + 0.0003 * i + 0.0001 * (i % 3), -1.0 - 0.0002 * (i % 7), None))
+            t = t + [45, 60, 150, 1200, 90, 600][i % 6]
+        self.users = []
+        for username in ['fill', 'loop']:
+            user = User.objects.create(username=username)
+            import_data(user, self.rows, 'phone')
+            self.users.append(user)
+
+    def fill_loop(self, user, dts, dte):
+        """ Fills in the gaps a minute at a time, with extrapolate_position and calculate_speed, as fill_locations used to. """
+        first = self.rows[0][0]
+        last = self.rows[-1][0]
+        dt = dts
+        while dt < dte:
+            if ((dt > first) and (dt < last) and (not(Position.objects.filter(user=user.profile, time=dt).exists()))):
+                pos = extrapolate_position(user, dt, 'cron')
+                pos.speed = calculate_speed(pos)
+                pos.save()
+            dt = dt + datetime.timedelta(seconds=60)
+
+    def assertSameFill(self):
+        found = [list(Position.objects.filter(user=user.profile, explicit=False).order_by('time').values_list('time', 'lat', 'lon', 'speed', 'source')) for user in self.users]
+        self.assertTrue(len(found[0]) > 100)
+        self.assertEqual([p[0] for p in found[0]], [p[0] for p in found[1]])
+        for a, b in zip(found[0], found[1]):
+            self.assertAlmostEqual(a[1], b[1], places=9)
+            self.assertAlmostEqual(a[2], b[2], places=9)
+            self.assertEqual(a[3], b[3])
+            self.assertEqual(a[4], b[4])
+
+    def test_same_as_loop(self):
+        dts = self.start - datetime.timedelta(hours=1) # Slots before the first and after the last position are left empty
+        dte = self.rows[-1][0] + datetime.timedelta(hours=1)
+        self.assertTrue(fill_gaps(self.users[0], dts, dte, 'cron') > 0)
+        self.fill_loop(self.users[1], dts, dte)
+        self.assertSameFill()
+
+    def test_existing_calculated_positions(self):
+        middle = self.start + datetime.timedelta(hours=3)
+        dte = self.rows[-1][0] + datetime.timedelta(hours=1)
+        for user in self.users:
+            fill_gaps(user, self.start, middle, 'cron') # The same positions both ways, as test_same_as_loop shows
+        fill_gaps(self.users[0], self.start, dte, 'cron')
+        self.fill_loop(self.users[1], self.start, dte)
+        self.assertSameFill()
+        self.assertEqual(fill_gaps(self.users[0], self.start, dte, 'cron'), 0) # Nothing left to fill
+
+GPX_FIXTURE = """<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+  <wpt lat="51.0" lon="-2.0"><time>2023-03-01T07:00:00Z</time><name>Not a track point</name></wpt>
+  <trk><name>Test</name>
+    <trkseg>
+      <trkpt lat="50.1" lon="-1.1"><ele>12.5</ele><time>2023-03-01T08:00:00Z</time></trkpt>
+      <trkpt lat="50.2" lon="-1.2"><time>2023-03-01T08:00:01.500Z</time></trkpt>
+      <trkpt lat="50.3" lon="-1.3"><ele>13</ele></trkpt>
+    </trkseg>
+    <trkseg>
+      <trkpt lat="50.4" lon="-1.4"><ele>14</ele><time>2023-03-01T09:00:05+01:00</time></trkpt>
+      <trkpt lat="50.5" lon="-1.5"><time>2023-03-01T08:00:10</time><extensions><speed>3</speed></extensions></trkpt>
+    </trkseg>
+  </trk>
+</gpx>
+"""
+
+class ParseFileTestCase(TestCase):
+
+    def write(self, data, suffix):
+        fd, filename = tempfile.mkstemp(suffix=suffix)
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(data)
+        self.addCleanup(os.remove, filename)
+        return filename
+
+    def test_gpx(self):
+        items = list(parse_file_gpx(self.write(GPX_FIXTURE, '.gpx')))
+        self.assertEqual([(item['date'], item['lat'], item['lon'], item.get('alt')) for item in items], [
+            (datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc), 50.1, -1.1, 12.5),
+            (datetime.datetime(2023, 3, 1, 8, 0, 1, 500000, tzinfo=pytz.utc), 50.2, -1.2, None), # No elevation
+            (datetime.datetime(2023, 3, 1, 8, 0, 5, tzinfo=pytz.utc), 50.4, -1.4, 14.0), # The point without a time is skipped
+            (datetime.datetime(2023, 3, 1, 8, 0, 10, tzinfo=pytz.utc), 50.5, -1.5, None) # No time zone is taken as UTC
+        ])
+
+    def test_gpx_1_0(self):
+        items = list(parse_file_gpx(self.write(GPX_FIXTURE.replace('version="1.1"', 'version="1.0"').replace('GPX/1/1', 'GPX/1/0'), '.gpx')))
+        self.assertEqual(len(items), 4)
+
+    def test_fit(self):
+        def record(**fields):
+            units = {'position_lat': 'semicircles', 'position_long': 'semicircles', 'enhanced_altitude': 'm'}
+            return SimpleNamespace(fields=[SimpleNamespace(name=k, value=v, units=units.get(k)) for k, v in fields.items()])
+        records = [
+            record(timestamp=datetime.datetime(2023, 3, 1, 8, 0, 0), position_lat=596523235, position_long=-11930465, enhanced_altitude=12.5, heart_rate=90),
+            record(timestamp=datetime.datetime(2023, 3, 1, 8, 0, 1), heart_rate=91), # No position
+            record(timestamp=datetime.datetime(2023, 3, 1, 9, 0, 2, tzinfo=pytz.timezone('Etc/GMT-1')), position_lat=-596523235, position_long=None),
+            record(timestamp=datetime.datetime(2023, 3, 1, 9, 0, 3, tzinfo=datetime.timezone(datetime.timedelta(hours=1))), position_lat=1 << 30, position_long=-(1 << 30))
+        ]
+        fit = mock.Mock()
+        fit.get_messages.return_value = iter(records)
+        with mock.patch('locman.functions.FitFile', return_value=fit) as FitFile:
+            items = parse_file_fit('test.fit', 'watch')
+            self.assertEqual(FitFile.call_count, 0) # A generator, so nothing is read until it is needed
+            items = list(items)
+        fit.get_messages.assert_called_once_with('record')
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0][0], datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)) # Naive timestamps are UTC
+        self.assertAlmostEqual(items[0][1], 596523235 * SEMICIRCLES_TO_DEGREES)
+        self.assertAlmostEqual(items[0][1], 50.0, places=6)
+        self.assertAlmostEqual(items[0][2], -1.0, places=6)
+        self.assertEqual(items[0][3], 12.5)
+        self.assertEqual(items[1], (datetime.datetime(2023, 3, 1, 8, 0, 3, tzinfo=pytz.utc), 90.0, -90.0, None))
+
+    def test_fit_unreadable(self):
+        with mock.patch('locman.functions.FitFile', side_effect=Exception('Not a FIT file')):
+            self.assertEqual(list(parse_file_fit('test.fit')), [])
+
+    def test_gpx_import(self):
+        user = User.objects.create(username='test')
+        ret = import_data(user, parse_file_gpx(self.write(GPX_FIXTURE, '.gpx')), 'phone')
+        self.assertEqual(ret['inserted'], 4)
+        self.assertEqual(list(Position.objects.filter(user=user.profile).order_by('time').values_list('elevation', flat=True)), [12.5, None, 14.0, None])
+
+class CalculateSpeedsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.start = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        rows = []
+        t = 0
+        for i in range(0, 100):
+            rows.append((self.start + datetime.timedelta(seconds=t), 50.0 + 0.0004 * i * (i % 4), -1.0 + 0.0003 * (i % 5), None))
+            t = t + [1, 5, 30, 60, 200, 7][i % 6]
+        import_data(self.user, rows, 'phone')
+        self.first = rows[0][0]
+        self.last = rows[-1][0]
+
+    def expected(self, dts=None):
+        """ The speeds that calculate_speed gives for each position, the first (with nothing before it) being 0. """
+        ret = []
+        for pos in Position.objects.filter(user=self.user.profile).order_by('time'):
+            if ((not(dts is None)) and (pos.time < dts)):
+                ret.append(pos.speed)
+            elif pos.time == self.first:
+                ret.append(0)
+            else:
+                ret.append(int(calculate_speed(pos)))
+        return ret
+
+    def speeds(self):
+        return list(Position.objects.filter(user=self.user.profile).order_by('time').values_list('speed', flat=True))
+
+    def test_same_as_calculate_speed(self):
+        with mock.patch('locman.functions.SPEED_CHUNK_SIZE', 7): # So that the chunks join up part way through the positions
+            self.assertEqual(calculate_speeds(self.user, self.first, self.last), 100)
+        self.assertEqual(self.speeds(), self.expected())
+
+    def test_part_of_the_span(self):
+        dts = self.first + datetime.timedelta(hours=1)
+        with mock.patch('locman.functions.SPEED_CHUNK_SIZE', 7):
+            calculate_speeds(self.user, dts, self.last)
+        self.assertEqual(self.speeds(), self.expected(dts)) # The position before dts is used, but not updated
+
+    def test_overwrite(self):
+        calculate_speeds(self.user, self.first, self.last)
+        expected = self.speeds()
+        wrong = Position.objects.filter(user=self.user.profile, time__gte=self.first + datetime.timedelta(minutes=30)).update(speed=999)
+        self.assertEqual(calculate_speeds(self.user, self.first, self.last), 0) # Only positions without a speed are updated
+        with mock.patch('locman.functions.SPEED_CHUNK_SIZE', 7):
+            updated = calculate_speeds(self.user, self.first, self.last, overwrite=True)
+        self.assertEqual(updated, wrong)
+        self.assertEqual(self.speeds(), expected)
+
+class ImportDataTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.start = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        self.rows = track(self.start, hours=1)
+
+    def test_insert(self):
+        ret = import_data(self.user, self.rows, 'phone')
+        self.assertEqual((ret['inserted'], ret['updated'], ret['skipped']), (len(self.rows), 0, 0))
+        self.assertEqual(ret['start'], self.rows[0][0])
+        self.assertEqual(ret['end'], self.rows[-1][0])
+        self.assertEqual([p[0:3] for p in positions(self.user)], [row[0:3] for row in self.rows])
+
+    def test_unchanged_rows_skipped(self):
+        import_data(self.user, self.rows, 'phone')
+        ret = import_data(self.user, self.rows, 'phone', force=True)
+        self.assertEqual((ret['inserted'], ret['updated'], ret['skipped']), (0, 0, len(self.rows)))
+        self.assertTrue(ret['changed_start'] is None)
+
+    def test_unchanged_segments_skipped(self):
+        rows = track(self.start, hours=3)
+        import_data(self.user, rows, 'phone')
+        with CaptureQueriesContext(connection) as queries:
+            ret = import_data(self.user, rows, 'phone')
+        table = connection.ops.quote_name(Position._meta.db_table)
+        self.assertFalse(any([table in query['sql'] for query in queries.captured_queries])) # Positions aren't read or written at all
+        self.assertEqual((ret['inserted'], ret['updated'], ret['skipped']), (0, 0, len(rows)))
+        changed = rows[0:120] + [(row[0], row[1] + 0.01, row[2], row[3]) for row in rows[120:240]] + rows[240:]
+        ret = import_data(self.user, changed, 'phone')
+        self.assertEqual((ret['inserted'], ret['updated'], ret['skipped']), (0, 120, len(rows) - 120))
+        self.assertEqual(ret['changed'], [[rows[120][0], rows[239][0]]])
+
+    def test_methods_agree(self):
+        changed = track(self.start + datetime.timedelta(minutes=30), hours=1, offset=0.01)
+        found = []
+        for method in ['bulk', 'upsert', 'row']:
+            user = User.objects.create(username=method)
+            import_data(user, self.rows, 'phone', method=method)
+            ret = import_data(user, changed, 'watch', method=method)
+            found.append(positions(user))
+            self.assertEqual((ret['inserted'], ret['updated']), (len(self.rows) / 2, len(self.rows) / 2))
+            self.assertEqual(ret['changed_start'], changed[0][0])
+        self.assertEqual(found[1], found[0])
+        self.assertEqual(found[2], found[0])
+        self.assertEqual([p[0:3] for p in found[0]], [row[0:3] for row in self.rows[0:len(self.rows) // 2] + changed])
+        self.assertEqual([p[5] for p in found[0]], ['phone'] * (len(self.rows) // 2) + ['watch'] * len(changed))
+
+class StopDetectionTestCase(TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        # Stops of 20 minutes, 2 minutes (too short to count), two of 10 minutes close enough together to be merged, and an hour
+        self.rows = track(self.start, hours=7, stops=[(3600, 1200), (7200, 120), (10800, 600), (11520, 600), (18000, 3600)])
+
+    def moving(self):
+        return [row[0] for i, row in enumerate(self.rows) if ((i == 0) or (row[1] != self.rows[i - 1][1]))]
+
+    def test_resume(self):
+        times = self.moving()
+        whole = list(_detect_stops(times, {}))
+        self.assertEqual(len(whole), 3)
+        for split in range(1, len(times), 7):
+            state = {}
+            found = list(_detect_stops(times[0:split], state))
+            state = _stop_state_from_json(_stop_state_to_json(state)) # As kept in the Watermark between runs
+            found = found + list(_detect_stops(times[split:], state))
+            self.assertEqual(found, whole)
+
+    def test_generate_events_in_pieces(self):
+        whole = User.objects.create(username='whole')
+        pieces = User.objects.create(username='pieces')
+        for user in [whole, pieces]:
+            Watermark.objects.create(user=user.profile, name='events', time=self.start)
+        import_data(whole, self.rows, 'phone')
+        process(whole, self.rows[0][0], self.rows[-1][0])
+        generate_events(whole)
+        for i in range(0, len(self.rows), 100):
+            rows = self.rows[i:i + 100]
+            import_data(pieces, rows, 'phone')
+            process(pieces, self.rows[max(i - 1, 0)][0], rows[-1][0])
+            generate_events(pieces)
+        self.assertEqual(len(event_times(whole)), 3)
+        self.assertEqual(event_times(pieces), event_times(whole))
+
+class InvalidateSpanTestCase(TestCase):
+    maxDiff = None
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.day1 = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        self.day5 = datetime.datetime(2023, 3, 5, 8, 0, 0, tzinfo=pytz.utc)
+        import_data(self.user, track(self.day1, stops=[(7200, 1800)]), 'phone')
+        import_data(self.user, track(self.day5, stops=[(3600, 1800)]), 'phone')
+        process(self.user, self.day1, self.day5 + datetime.timedelta(hours=4))
+        Watermark.objects.update_or_create(user=self.user.profile, name='events', defaults={'time': self.day1, 'state': '{}'})
+        generate_events(self.user)
+        self.events = event_times(self.user)
+
+    def reimport(self, rows):
+        """ Imports changed rows, and does what the import task and the tasks it queues would do afterwards. """
+        ret = import_data(self.user, rows, 'phone')
+        for span in ret['changed']:
+            process(self.user, span[0], span[1])
+        for span in ret['invalidated']:
+            if not(span['events_start'] is None):
+                regenerate_events(self.user, span['events_start'], span['events_end'])
+        generate_events(self.user)
+        return ret
+
+    def test_events_found(self):
+        self.assertEqual(len(self.events), 3) # The gap between the two days counts as a stop too
+
+    def test_reimport_before_later_events(self):
+        ret = self.reimport(track(self.day1, stops=[(7200, 1800)], offset=0.0001))
+        self.assertFalse(ret['invalidated'][0]['events_start'] is None)
+        self.assertEqual(event_times(self.user), self.events)
+
+    def test_reimport_without_watermark(self):
+        Watermark.objects.filter(user=self.user.profile).delete() # As on an install upgraded from before watermarks, or after a backfill
+        self.reimport(track(self.day1, stops=[(7200, 1800)], offset=0.0001))
+        self.assertEqual(event_times(self.user), self.events)
+
+    def test_reimport_last_events(self):
+        Watermark.objects.filter(user=self.user.profile).update(time=self.day5 + datetime.timedelta(hours=2)) # Event generation hasn't got to the end yet
+        ret = self.reimport(track(self.day5, stops=[(3600, 1800)], offset=0.0001))
+        self.assertTrue(ret['invalidated'][0]['events_start'] is None) # Rewinding the watermark is enough
+        self.assertEqual(event_times(self.user), self.events)
+
+    def test_reimport_without_any_events_left(self):
+        Event.objects.filter(user=self.user.profile, timestart__gte=self.day5).delete()
+        Watermark.objects.filter(user=self.user.profile).delete()
+        self.reimport(track(self.day1, stops=[(7200, 1800)], offset=0.0001))
+        self.assertEqual(event_times(self.user), self.events) # Found again from the positions
+
+class BackfillTestCase(TestCase):
+
+    def setUp(self):
+        self.start = datetime.datetime(2023, 3, 1, 22, 0, 0, tzinfo=pytz.utc)
+        self.rows = track(self.start, hours=30, stops=[(3600, 1800), (7200, 600), (36000, 5400), (100000, 3600)], step=45)
+        self.tasks = User.objects.create(username='tasks')
+        self.backfill = User.objects.create(username='backfill')
+        for user in [self.tasks, self.backfill]:
+            import_data(user, self.rows, 'phone')
+            Watermark.objects.update_or_create(user=user.profile, name='events', defaults={'time': self.start, 'state': '{}'})
+        process(self.tasks, self.rows[0][0], self.rows[-1][0])
+        generate_events(self.tasks)
+
+    def run_backfill(self, size):
+        first = self.rows[0][0]
+        last = self.rows[-1][0]
+        for dts, dte in backfill_partitions(first, last, size):
+            backfill_partition(self.backfill.pk, dts.timestamp(), dte.timestamp(), first.timestamp(), last.timestamp(), 'speed_gap')
+
+    def test_events_found(self):
+        self.assertEqual(len(event_times(self.tasks)), 4)
+
+    def test_same_as_tasks(self):
+        self.run_backfill('day')
+        self.assertEqual(positions(self.backfill), positions(self.tasks))
+        self.assertEqual(event_times(self.backfill), event_times(self.tasks))
+
+    def test_run_again(self):
+        self.run_backfill('day')
+        self.run_backfill('week')
+        self.assertEqual(positions(self.backfill), positions(self.tasks))
+        self.assertEqual(event_times(self.backfill), event_times(self.tasks))
+
+class GeodesyTestCase(SimpleTestCase):
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.lats = [rand.uniform(-80, 80) for i in range(0, 200)]
+        self.lons = [rand.uniform(-179, 179) for i in range(0, 200)]
+        self.lats = self.lats + [50.0, 50.0, 50.0001, -33.9, -33.9] # Including a repeated point and some very short distances
+        self.lons = self.lons + [-1.0, -1.0, -1.0, 151.2, 151.2001]
+
+    def bearing(self, lat1, lon1, lat2, lon2):
+        """ The initial bearing from lat1,lon1 to lat2,lon2, worked out a point at a time. """
+        lat1 = math.radians(lat1)
+        lat2 = math.radians(lat2)
+        dlon = math.radians(lon2 - lon1)
+        y = math.sin(dlon) * math.cos(lat2)
+        x = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+        return math.degrees(math.atan2(y, x)) % 360
+
+    def douglas_peucker(self, lats, lons, a, b, tolerance, keep):
+        """ The usual recursive version of the algorithm, to check simplify() against. """
+        keep[a] = True
+        keep[b] = True
+        if b - a < 2:
+            return
+        dx = lons[b] - lons[a]
+        dy = lats[b] - lats[a]
+        norm = math.hypot(dx, dy)
+        furthest = None
+        dmax = 0.0
+        for i in range(a + 1, b):
+            if norm == 0.0:
+                d = math.hypot(lons[i] - lons[a], lats[i] - lats[a])
+            else:
+                d = abs((dy * (lons[i] - lons[a])) - (dx * (lats[i] - lats[a]))) / norm
+            if ((furthest is None) or (d > dmax)):
+                furthest = i
+                dmax = d
+        if dmax > tolerance:
+            self.douglas_peucker(lats, lons, a, furthest, tolerance, keep)
+            self.douglas_peucker(lats, lons, furthest, b, tolerance, keep)
+
+    def test_distances(self):
+        expected = [distance(self.lats[i], self.lons[i], self.lats[i + 1], self.lons[i + 1]) for i in range(0, len(self.lats) - 1)]
+        np.testing.assert_allclose(distances(self.lats, self.lons), expected, rtol=1e-9, atol=1e-6)
+        np.testing.assert_allclose(cumulative_distance(self.lats, self.lons), [0.0] + list(np.cumsum(expected)), rtol=1e-9, atol=1e-6)
+        expected = [distance(self.lats[i], self.lons[i], 50.0, -1.0) for i in range(0, len(self.lats))]
+        np.testing.assert_allclose(distances_to(self.lats, self.lons, 50.0, -1.0), expected, rtol=1e-9, atol=1e-6)
+        self.assertEqual(len(distances([50.0], [-1.0])), 0)
+        self.assertEqual(list(cumulative_distance([50.0], [-1.0])), [0.0])
+
+    def test_bearings(self):
+        expected = [self.bearing(self.lats[i], self.lons[i], self.lats[i + 1], self.lons[i + 1]) for i in range(0, len(self.lats) - 1)]
+        result = bearings(self.lats, self.lons)
+        self.assertTrue(np.all((result >= 0) & (result < 360)))
+        diff = np.abs(result - np.array(expected))
+        np.testing.assert_allclose(np.minimum(diff, 360 - diff), 0.0, atol=1e-6) # 359.999... and 0 are the same bearing
+        np.testing.assert_allclose(bearings([50.0, 50.1, 50.1, 50.0], [-1.0, -1.0, -0.9, -0.9]), [0.0, 89.96, 180.0], atol=0.01)
+        self.assertEqual(len(bearings([50.0], [-1.0])), 0)
+
+    def test_simplify(self):
+        lats = np.array([50.0 + 0.001 * i + 0.0005 * math.sin(i / 3.0) for i in range(0, 300)])
+        lons = np.array([-1.0 + 0.0002 * i + 0.0003 * math.cos(i / 7.0) for i in range(0, 300)])
+        for tolerance in [0.0, 0.00001, 0.0001, 0.001, 1.0]:
+            expected = np.zeros(len(lats), dtype=bool)
+            self.douglas_peucker(lats, lons, 0, len(lats) - 1, tolerance, expected)
+            self.assertEqual(list(simplify(lats, lons, tolerance=tolerance)), list(expected), tolerance)
+        everything = simplify(lats, lons)
+        for max_points in [2, 10, 50]:
+            keep = simplify(lats, lons, max_points=max_points)
+            self.assertEqual(int(np.count_nonzero(keep)), max_points)
+            self.assertTrue(keep[0] and keep[-1])
+            self.assertTrue(np.all(everything[keep]))
+        keep = simplify(lats, lons, tolerance=1.0, starts=[0, 100, 250])
+        self.assertEqual(list(np.flatnonzero(keep)), [0, 99, 100, 249, 250, 299]) # Each track keeps its own first and last points
+        self.assertEqual(len(simplify([], [])), 0)
+
+    def test_grid_cells(self):
+        lats = self.lats + [0.0, 0.05, 0.0499999, 50.05, 50.1, -90.0, 90.0, 51.0 - 1e-9]
+        lons = self.lons + [0.0, 0.05, 0.0499999, -1.05, -1.0, -180.0, 180.0, -1.1 + 1e-9]
+        cells = grid_cells(lats, lons)
+        for i in range(0, len(lats)):
+            row = int(math.floor((lats[i] + 90) / GRID_CELL_SIZE))
+            column = int(math.floor((lons[i] + 180) / GRID_CELL_SIZE))
+            row = min(row, int(round(180 / GRID_CELL_SIZE)) - 1)
+            column = min(column, GRID_COLUMNS - 1)
+            self.assertEqual(int(cells[i]), row * GRID_COLUMNS + column, (lats[i], lons[i]))
+            self.assertEqual(grid_cell(lats[i], lons[i]), int(cells[i]))
+        self.assertNotEqual(grid_cell(0.0, 0.0), grid_cell(0.0, -0.0000001))
+        self.assertNotEqual(grid_cell(0.0, 0.0), grid_cell(-0.0000001, 0.0))
+
+    def test_grid_cells_in_box(self):
+        box = grid_cells_in_box(50.93, -1.43, 51.07, -1.31)
+        self.assertEqual(len(box), len(set(box)))
+        rand = random.Random(2)
+        for i in range(0, 500):
+            lat = rand.uniform(50.93, 51.07)
+            lon = rand.uniform(-1.43, -1.31)
+            self.assertIn(grid_cell(lat, lon), box)
+        self.assertEqual(len(box), 4 * 3) # Rows 2818 to 2821, columns 3571 to 3573
+        self.assertEqual(grid_cells_in_box(50.01, -1.04, 50.02, -1.03), [grid_cell(50.01, -1.04)])
+
+class RouteTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create(username='test')
+        cls.other = User.objects.create(username='other')
+        cls.start = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        rows = []
+        for i in range(0, ROUTE_STREAM_THRESHOLD + 1): # One position a second, each one a little further north, with a gap making two tracks
+            dt = cls.start + datetime.timedelta(seconds=(i + (0 if i < 5000 else 300)))
+            rows.append((dt, 50.0 + 0.00001 * i, -1.0 + 0.00001 * (i % 100), None))
+        cls.times = [row[0] for row in rows]
+        import_data(cls.user, rows, 'phone')
+        import_data(cls.other, [(dt, lat + 1.0, lon, alt) for dt, lat, lon, alt in rows], 'phone')
+
+    def get(self, count, **params):
+        """ Requests the route covering the first `count` positions, returning whether it was streamed and the decoded response. """
+        self.client.force_login(self.user)
+        pk = self.start.strftime('%Y%m%d%H%M%S') + self.times[count - 1].strftime('%Y%m%d%H%M%S')
+        response = self.client.get(reverse('route-detail', args=[pk]), params)
+        self.assertEqual(response.status_code, 200)
+        if response.streaming:
+            return True, json.loads(b''.join(response.streaming_content))
+        return False, json.loads(response.content)
+
+    def coordinates(self, data):
+        geometry = data['geo']['geometry']
+        if geometry['type'] == 'GeometryCollection':
+            geometry = geometry['geometries'][0]
+        return geometry['coordinates']
+
+    def test_threshold(self):
+        streamed, data = self.get(ROUTE_STREAM_THRESHOLD)
+        self.assertFalse(streamed)
+        self.assertEqual(sum([len(track) for track in self.coordinates(data)]), ROUTE_STREAM_THRESHOLD)
+        streamed, data = self.get(ROUTE_STREAM_THRESHOLD + 1)
+        self.assertTrue(streamed)
+        self.assertEqual(sum([len(track) for track in self.coordinates(data)]), ROUTE_STREAM_THRESHOLD + 1)
+
+    def test_streamed_same_as_buffered(self):
+        streamed, data = self.get(ROUTE_STREAM_THRESHOLD + 1)
+        self.assertTrue(streamed)
+        with mock.patch('locman.views.ROUTE_STREAM_THRESHOLD', ROUTE_STREAM_THRESHOLD * 2):
+            streamed, expected = self.get(ROUTE_STREAM_THRESHOLD + 1)
+        self.assertFalse(streamed)
+        self.assertEqual(data, expected)
+        self.assertEqual(len(self.coordinates(data)), 2)
+        with mock.patch('locman.views.ROUTE_STREAM_THRESHOLD', 10), mock.patch('locman.routes.ROUTE_STREAM_ROWS', 7):
+            streamed, data = self.get(ROUTE_STREAM_THRESHOLD + 1, tolerance=0.00002) # So each track is encoded in several pieces
+            self.assertTrue(streamed)
+        with mock.patch('locman.views.ROUTE_STREAM_THRESHOLD', ROUTE_STREAM_THRESHOLD * 2):
+            streamed, expected = self.get(ROUTE_STREAM_THRESHOLD + 1, tolerance=0.00002)
+        self.assertEqual(data, expected)
+
+    def test_other_users(self):
+        streamed, data = self.get(ROUTE_STREAM_THRESHOLD + 1)
+        lats = [lat for track in self.coordinates(data) for lon, lat in track]
+        self.assertEqual(len(lats), ROUTE_STREAM_THRESHOLD + 1)
+        self.assertLess(max(lats), 51.0) # None of the other user's positions, all of which are a degree further north
+        self.assertEqual(data['geo']['bbox'][1], max(lats))
+
+class SummariesTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.start = datetime.datetime(2023, 3, 1, 20, 0, 0, tzinfo=pytz.utc)
+        self.end = datetime.datetime(2023, 3, 4, 5, 0, 0, tzinfo=pytz.utc)
+        import_data(self.user, varied_track(self.start), 'phone')
+        calculate_speeds(self.user, self.start, self.end)
+
+    def raw(self, dts, dte):
+        """ The summary of a timespan worked out from its raw positions. """
+        return summarise_points(load_positions(self.user, dts, dte))
+
+    def raw_bbox(self, dts, dte):
+        summary = self.raw(dts, dte)
+        return {k: summary[k] for k in ['minlat', 'minlon', 'maxlat', 'maxlon']}
+
+    def assertSameSummary(self, summary, expected):
+        self.assertEqual(summary.keys(), expected.keys())
+        for k in SUMMARY_FIELDS:
+            if isinstance(expected[k], float):
+                self.assertAlmostEqual(summary[k], expected[k], places=6, msg=k)
+            else:
+                self.assertEqual(summary[k], expected[k], k)
+
+    def spans(self):
+        """ Timespans starting and ending mid-day, at midnight, a second before midnight and part way through a minute. """
+        ret = []
+        for dts in [self.start, datetime.datetime(2023, 3, 2, 0, 0, 0, tzinfo=pytz.utc), datetime.datetime(2023, 3, 2, 13, 17, 23, tzinfo=pytz.utc)]:
+            for dte in [self.end, datetime.datetime(2023, 3, 3, 23, 59, 59, tzinfo=pytz.utc), datetime.datetime(2023, 3, 3, 0, 0, 0, tzinfo=pytz.utc), datetime.datetime(2023, 3, 2, 22, 41, 7, tzinfo=pytz.utc)]:
+                ret.append((dts, dte))
+        return ret
+
+    def test_summarise(self):
+        self.assertEqual(update_day_summaries(self.user, self.start, self.end), 4)
+        self.assertEqual(DaySummary.objects.filter(user=self.user.profile).count(), 4)
+        for dts, dte in self.spans():
+            self.assertSameSummary(summarise(self.user, dts, dte), self.raw(dts, dte))
+            self.assertSameSummary(summarise(self.user, dts, dte, load_positions(self.user, dts, dte)), self.raw(dts, dte))
+            self.assertEqual(bounding_box(self.user, dts, dte), self.raw_bbox(dts, dte))
+
+    def test_not_built(self):
+        for dts, dte in self.spans():
+            self.assertSameSummary(summarise(self.user, dts, dte), self.raw(dts, dte))
+            self.assertEqual(bounding_box(self.user, dts, dte), self.raw_bbox(dts, dte))
+        update_day_summaries(self.user, datetime.datetime(2023, 3, 2, 0, 0, 0, tzinfo=pytz.utc), datetime.datetime(2023, 3, 2, 12, 0, 0, tzinfo=pytz.utc))
+        for dts, dte in self.spans(): # Some days built, others not
+            self.assertSameSummary(summarise(self.user, dts, dte), self.raw(dts, dte))
+            self.assertEqual(bounding_box(self.user, dts, dte), self.raw_bbox(dts, dte))
+
+    def test_changed(self):
+        update_day_summaries(self.user, self.start, self.end)
+        dt = datetime.datetime(2023, 3, 2, 14, 30, 15, tzinfo=pytz.utc)
+        with self.captureOnCommitCallbacks(execute=True):
+            import_data(self.user, [(dt, 60.0, 1.5, 300.0)], 'other') # Further north and east than anything else, and higher
+        self.assertFalse(DaySummary.objects.filter(user=self.user.profile, date=dt.date()).exists())
+        for dts, dte in self.spans():
+            self.assertSameSummary(summarise(self.user, dts, dte), self.raw(dts, dte))
+            self.assertEqual(bounding_box(self.user, dts, dte), self.raw_bbox(dts, dte))
+        self.assertEqual(bounding_box(self.user, self.start, self.end)['maxlat'], 60.0)
+        self.assertEqual(summarise(self.user, self.start, self.end)['max_elevation'], 300.0)
+
+class PyramidTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.start = datetime.datetime(2023, 3, 1, 20, 0, 0, tzinfo=pytz.utc)
+        self.end = datetime.datetime(2023, 3, 4, 5, 0, 0, tzinfo=pytz.utc)
+        import_data(self.user, varied_track(self.start), 'phone')
+        calculate_speeds(self.user, self.start, self.end)
+
+    def levels(self):
+        """ Reads every level of the pyramid for a few timespans, some of them not aligned to the buckets. """
+        ret = []
+        for dts, dte in [(self.start, self.end), (datetime.datetime(2023, 3, 2, 0, 0, 0, tzinfo=pytz.utc), datetime.datetime(2023, 3, 2, 23, 59, 59, tzinfo=pytz.utc)), (datetime.datetime(2023, 3, 1, 22, 17, 23, tzinfo=pytz.utc), datetime.datetime(2023, 3, 3, 0, 41, 7, tzinfo=pytz.utc))]:
+            for resolution in ROLLUP_RESOLUTIONS:
+                ret.append(load_level(self.user, dts, dte, resolution))
+        return ret
+
+    def assertSameLevels(self, levels, expected):
+        self.assertEqual(len(levels), len(expected))
+        for i in range(0, len(levels)):
+            self.assertEqual(levels[i].keys(), expected[i].keys())
+            for k in expected[i].keys():
+                self.assertEqual(levels[i][k].dtype, expected[i][k].dtype, k)
+                np.testing.assert_array_equal(levels[i][k], expected[i][k], k)
+
+    def test_choose_resolution(self):
+        dts = datetime.datetime(2023, 3, 1, 0, 0, 0, tzinfo=pytz.utc)
+        dte = dts + datetime.timedelta(days=1)
+        self.assertEqual(choose_resolution(dts, dte), 1)
+        self.assertEqual(choose_resolution(dts, dte, resolution=30), 1)
+        self.assertEqual(choose_resolution(dts, dte, resolution=60), 60)
+        self.assertEqual(choose_resolution(dts, dte, resolution=599), 60)
+        self.assertEqual(choose_resolution(dts, dte, resolution=7200), 3600)
+        self.assertEqual(choose_resolution(dts, dte, max_points=86400), 1)
+        self.assertEqual(choose_resolution(dts, dte, max_points=86399), 60)
+        self.assertEqual(choose_resolution(dts, dte, max_points=1440), 60)
+        self.assertEqual(choose_resolution(dts, dte, max_points=1439), 600)
+        self.assertEqual(choose_resolution(dts, dte, max_points=10), 3600) # As coarse as there is, even if still too many
+        self.assertEqual(choose_resolution(dts, dte, resolution=60, max_points=10), 60) # resolution takes precedence
+        self.assertEqual(choose_resolution(dts, dts, max_points=1), 1)
+
+    def test_not_built(self):
+        unbuilt = self.levels()
+        self.assertTrue(all([len(level['time']) > 0 for level in unbuilt]))
+        update_day_summaries(self.user, datetime.datetime(2023, 3, 2, 0, 0, 0, tzinfo=pytz.utc), datetime.datetime(2023, 3, 2, 12, 0, 0, tzinfo=pytz.utc))
+        partly = self.levels()
+        update_day_summaries(self.user, self.start, self.end)
+        built = self.levels()
+        self.assertSameLevels(unbuilt, built)
+        self.assertSameLevels(partly, built)
+
+    def test_views(self):
+        self.client.force_login(self.user)
+        pk = self.start.strftime('%Y%m%d%H%M%S') + self.end.strftime('%Y%m%d%H%M%S')
+        unbuilt = [self.client.get(reverse('route-detail', args=[pk]), {'max_points': 500}).json(), self.client.get(reverse('elevation-detail', args=[pk]), {'resolution': 600}).json()]
+        update_day_summaries(self.user, self.start, self.end)
+        built = [self.client.get(reverse('route-detail', args=[pk]), {'max_points': 500}).json(), self.client.get(reverse('elevation-detail', args=[pk]), {'resolution': 600}).json()]
+        self.assertAlmostEqual(unbuilt[0]['geo']['properties'].pop('distance'), built[0]['geo']['properties'].pop('distance'), places=9) # Added up a day at a time once built
+        self.assertEqual(unbuilt, built)
+        self.assertGreater(len(built[0]['geo']['geometry']['geometries'][0]['coordinates']), 0)
+        self.assertGreater(len(built[1]), 0)
+
+class ArchiveTestCase(TestCase):
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings = self.settings(MEDIA_ROOT=root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create(username='test')
+        self.start = datetime.datetime(2023, 3, 1, 0, 0, 0, tzinfo=pytz.utc)
+        rows = track(self.start, hours=120, step=300, stops=[(40000, 30000)])
+        rows = [row for row in rows if ((row[0] < datetime.datetime(2023, 3, 4, 2, 0, 0, tzinfo=pytz.utc)) or (row[0] > datetime.datetime(2023, 3, 4, 20, 0, 0, tzinfo=pytz.utc)))] # A gap in the data
+        import_data(self.user, rows, 'phone')
+        process(self.user, self.start, self.start + datetime.timedelta(hours=120))
+
+    def archive(self):
+        """ Archives the first five days, returning what load_positions read before they were archived. """
+        expected = load_positions(self.user, self.start, self.start + datetime.timedelta(days=6), source=True)
+        archive_positions(self.user, self.start + datetime.timedelta(days=5))
+        self.assertEqual(archived_dates(self.user), [datetime.date(2023, 3, day) for day in range(1, 6)])
+        self.assertEqual(Position.objects.filter(user=self.user.profile).count(), 0)
+        return expected
+
+    def assertSamePoints(self, points, expected):
+        self.assertEqual(points.keys(), expected.keys())
+        np.testing.assert_allclose(points['time'], expected['time'], rtol=0, atol=1e-6)
+        np.testing.assert_allclose(points['lat'], expected['lat'], rtol=0, atol=1e-6) # Stored as microdegrees
+        np.testing.assert_allclose(points['lon'], expected['lon'], rtol=0, atol=1e-6)
+        np.testing.assert_array_equal(points['speed'], expected['speed'])
+        np.testing.assert_allclose(points['elevation'], expected['elevation'], rtol=1e-6) # Stored as float32
+        np.testing.assert_array_equal(points['explicit'], expected['explicit'])
+        if 'source' in expected:
+            self.assertEqual(list(points['source']), list(expected['source']))
+
+    def test_round_trip(self):
+        date = datetime.date(2023, 3, 1)
+        columns = {}
+        columns['time'] = np.array([self.start.timestamp() + t for t in [0.0, 0.5, 1.000001, 60.0, 86399.999999]])
+        columns['lat'] = np.array([50.123456, -33.9, 0.0, 89.999999, -90.0])
+        columns['lon'] = np.array([-1.000001, 151.2, 0.0, 179.999999, -180.0])
+        columns['speed'] = np.array([0.0, np.nan, 3.0, 120.0, np.nan])
+        columns['elevation'] = np.array([np.nan, 12.5, -3.25, 8848.0, np.nan])
+        columns['explicit'] = np.array([True, False, True, True, False])
+        columns['source'] = np.array(['phone', 'cron', 'phone', 'fitness_tracker', 'cron'])
+        write_day(self.user, date, columns)
+        self.assertSamePoints(read_day(self.user, date), columns)
+        self.assertIsNone(read_day(self.user, datetime.date(2023, 3, 2)))
+
+    def test_load_positions(self):
+        expected = self.archive()
+        self.assertSamePoints(load_positions(self.user, self.start, self.start + datetime.timedelta(days=6), source=True), expected)
+        dts = datetime.datetime(2023, 3, 2, 7, 13, 0, tzinfo=pytz.utc)
+        dte = datetime.datetime(2023, 3, 3, 1, 0, 0, tzinfo=pytz.utc)
+        wanted = (expected['time'] >= dts.timestamp()) & (expected['time'] <= dte.timestamp())
+        self.assertSamePoints(load_positions(self.user, dts, dte, source=True), {k: v[wanted] for k, v in expected.items()})
+
+        # Positions in the database take precedence over those archived at the same time
+        dt = datetime.datetime.fromtimestamp(expected['time'][100], tz=pytz.utc)
+        Position.objects.create(user=self.user.profile, time=dt, lat=10.0, lon=20.0, explicit=True, source='other')
+        points = load_positions(self.user, self.start, self.start + datetime.timedelta(days=6), source=True)
+        self.assertEqual(len(points['time']), len(expected['time']))
+        self.assertEqual((points['lat'][100], points['lon'][100], points['source'][100]), (10.0, 20.0, 'other'))
+        points['lat'][100] = expected['lat'][100]
+        points['lon'][100] = expected['lon'][100]
+        points['speed'][100] = expected['speed'][100]
+        points['source'][100] = expected['source'][100]
+        self.assertSamePoints(points, expected)
+
+    def test_neighbour(self):
+        self.archive()
+        dt = datetime.datetime(2023, 3, 4, 12, 0, 0, tzinfo=pytz.utc) # In the gap
+        self.assertEqual(archived_neighbour(self.user, dt), datetime.datetime(2023, 3, 4, 1, 55, 0, tzinfo=pytz.utc))
+        self.assertEqual(archived_neighbour(self.user, dt, after=True), datetime.datetime(2023, 3, 4, 20, 5, 0, tzinfo=pytz.utc))
+        self.assertIsNone(archived_neighbour(self.user, self.start))
+        self.assertIsNone(archived_neighbour(self.user, self.start + datetime.timedelta(days=5), after=True))
+
+    def test_restore_on_import(self):
+        self.archive()
+        dt = datetime.datetime(2023, 3, 2, 13, 2, 30, tzinfo=pytz.utc)
+        with self.captureOnCommitCallbacks(execute=True):
+            import_data(self.user, [(dt, 50.5, -1.5, None)], 'other')
+        self.assertEqual(archived_dates(self.user), [datetime.date(2023, 3, day) for day in [1, 4, 5]]) # Only within INVALIDATE_EVENT_MARGIN
+        self.assertTrue(Position.objects.filter(user=self.user.profile, time=dt, source='other').exists())
+        self.assertEqual(Position.objects.filter(user=self.user.profile, time__lt=datetime.datetime(2023, 3, 2, 0, 0, 0, tzinfo=pytz.utc)).count(), 0)
+        self.assertEqual(Position.objects.filter(user=self.user.profile, explicit=True).count(), 288 * 2 + 1)
+
+        # Just before a gap in the data, so the calculated positions up to the next explicit position are thrown away
+        dt = datetime.datetime(2023, 3, 4, 1, 57, 30, tzinfo=pytz.utc)
+        with self.captureOnCommitCallbacks(execute=True):
+            import_data(self.user, [(dt, 50.5, -1.5, None)], 'other')
+        self.assertEqual(archived_dates(self.user), [datetime.date(2023, 3, day) for day in [1, 5]])
+
+        # After the end of the data, so everything from the last explicit position onwards is restored
+        dt = datetime.datetime(2023, 3, 6, 0, 30, 0, tzinfo=pytz.utc)
+        with self.captureOnCommitCallbacks(execute=True):
+            import_data(self.user, [(dt, 50.5, -1.5, None)], 'other')
+        self.assertEqual(archived_dates(self.user), [datetime.date(2023, 3, 1)])
+
+class LocationEventsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.start = datetime.datetime(2023, 3, 1, 0, 0, 0, tzinfo=pytz.utc)
+        rows = []
+        for day in range(0, 3):
+            t = self.start + datetime.timedelta(days=day, hours=9)
+            for i in range(0, 60): # Walking north towards 50,-1, which is the corner of four grid cells
+                rows.append((t + datetime.timedelta(seconds=i * 30), 49.98 + 0.02 * i / 60, -1.0 + 0.0001 * day, None))
+            t = t + datetime.timedelta(minutes=30)
+            for i in range(0, 40 + 20 * day): # Wandering around the corner, in each of the cells in turn
+                rows.append((t + datetime.timedelta(seconds=i * 30), 50.0 + 0.0003 * math.sin(i), -1.0 + 0.0003 * math.cos(i * 1.3), None))
+            t = t + datetime.timedelta(seconds=(40 + 20 * day) * 30)
+            for i in range(0, 60): # Walking east, out of the search box
+                rows.append((t + datetime.timedelta(seconds=i * 30), 50.0, -1.0 + 0.08 * i / 60, None))
+        rows.append((self.start + datetime.timedelta(days=1, hours=2), 49.95, -1.05, None)) # Exactly on the edge of the search box
+        rows.append((self.start + datetime.timedelta(days=1, hours=3), 50.0, -1.0, None)) # Exactly on the corner
+        import_data(self.user, rows, 'phone')
+        process(self.user, self.start, self.start + datetime.timedelta(days=3))
+        self.assertGreater(len(set(Position.objects.filter(user=self.user.profile).values_list('cell', flat=True))), 4)
+
+    def box_search(self, *args, **kwargs):
+        """ Runs get_location_events as it was before the grid cells, with every cell included so only the lat/lon box matters. """
+        cells = list(Position.objects.filter(user=self.user.profile).values_list('cell', flat=True).distinct())
+        with mock.patch('locman.functions.grid_cells_in_box', return_value=cells):
+            return get_location_events(self.user, *args, **kwargs)
+
+    def test_same_as_box_search(self):
+        dts = self.start
+        dte = self.start + datetime.timedelta(days=3)
+        found = get_location_events(self.user, dts, dte, 50.0, -1.0)
+        self.assertEqual(len(found), 4) # The three visits, and the positions filled in either side of the one exactly on the corner
+        self.assertEqual(found, self.box_search(dts, dte, 50.0, -1.0))
+        for lat, lon in [(50.0004, -0.9996), (49.9996, -1.0004), (50.0, -0.95), (49.999999, -1.000001), (50.001, -1.001)]:
+            for dist in [0.0005, 0.01, 0.05, 0.12]:
+                self.assertEqual(get_location_events(self.user, dts, dte, lat, lon, dist), self.box_search(dts, dte, lat, lon, dist), (lat, lon, dist))
+        dts = self.start + datetime.timedelta(days=1, hours=9, minutes=45)
+        self.assertEqual(get_location_events(self.user, dts, dte, 50.0, -1.0), self.box_search(dts, dte, 50.0, -1.0))
+
+    def test_cells(self):
+        Position.objects.create(user=self.user.profile, time=self.start + datetime.timedelta(days=5), lat=50.05, lon=-1.05, explicit=True, source='phone')
+        import_data(self.user, [(self.start + datetime.timedelta(days=1, hours=9), 49.9, -1.1, None)], 'phone', method='upsert')
+        import_data(self.user, [(self.start + datetime.timedelta(days=2, hours=9), 49.8, -1.2, None)], 'phone', method='row')
+        for time, lat, lon, cell in Position.objects.filter(user=self.user.profile).values_list('time', 'lat', 'lon', 'cell'):
+            self.assertEqual(cell, grid_cell(lat, lon), time)
+
+class PositionBatchTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.start = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        rows = track(self.start, hours=4, step=45, stops=[(3600, 1800)])
+        rows = [row for row in rows if ((row[0] < self.start + datetime.timedelta(hours=2)) or (row[0] > self.start + datetime.timedelta(hours=3)))] # A gap of an hour to interpolate across
+        import_data(self.user, rows, 'phone')
+        self.client.force_login(self.user)
+        self.times = [self.start + datetime.timedelta(seconds=t) for t in [7200 + 1234, 45, 60, 3600 * 5, 0, 7200 + 1234, 13, 14355, -60, 3000]]
+
+    def timestamps(self, times):
+        return [dt.strftime('%Y%m%d%H%M%S') for dt in times]
+
+    def expected(self, times):
+        ret = []
+        for dt in times:
+            pos = get_position(self.user, dt)
+            if pos is None:
+                ret.append(None)
+            else:
+                ret.append(json.loads(json.dumps(PositionSerializer(pos).data)))
+        return ret
+
+    def test_get(self):
+        response = self.client.get(reverse('position-batch'), {'times': ','.join(self.timestamps(self.times))})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data, self.expected(self.times))
+        self.assertEqual([item is None for item in data], [False, False, False, True, False, False, False, False, True, False]) # Before and after all the data
+        self.assertEqual(data[0], data[5])
+        self.assertEqual(self.client.get(reverse('position-batch')).json(), [])
+
+    def test_post(self):
+        expected = self.expected(self.times)
+        response = self.client.post(reverse('position-batch'), self.timestamps(self.times), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), expected)
+        response = self.client.post(reverse('position-batch'), {'times': self.timestamps(self.times)}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), expected)
+
+    def test_save(self):
+        count = Position.objects.filter(user=self.user.profile).count()
+        self.client.get(reverse('position-batch'), {'times': ','.join(self.timestamps(self.times))})
+        self.client.post(reverse('position-batch'), self.timestamps(self.times), content_type='application/json')
+        self.assertEqual(Position.objects.filter(user=self.user.profile).count(), count)
+        self.client.post(reverse('position-batch'), {'times': self.timestamps(self.times), 'save': True}, content_type='application/json')
+        self.assertEqual(Position.objects.filter(user=self.user.profile).count(), count + 4) # Each distinct time between positions, not already in the database
+        self.assertEqual(Position.objects.filter(user=self.user.profile, source='realtime', time=self.times[0]).count(), 1)
+
+    def test_limit(self):
+        times = [self.start + datetime.timedelta(seconds=t) for t in range(0, POSITION_BATCH_LIMIT)]
+        response = self.client.post(reverse('position-batch'), self.timestamps(times), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), POSITION_BATCH_LIMIT)
+        times.append(self.start + datetime.timedelta(seconds=POSITION_BATCH_LIMIT))
+        response = self.client.post(reverse('position-batch'), self.timestamps(times), content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(reverse('position-batch'), {'times': ','.join(self.timestamps(times))})
+        self.assertEqual(response.status_code, 400)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get(reverse('position-batch'), {'times': '20230301080000,2023-03-01'}).status_code, 400)
+        self.assertEqual(self.client.post(reverse('position-batch'), {'times': '20230301080000'}, content_type='application/json').status_code, 400)
+        self.assertEqual(self.client.post(reverse('position-batch'), '"20230301080000"', content_type='application/json').status_code, 400)
+
+class PositionCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create(username='test')
+        self.before = datetime.datetime(2023, 3, 1, 23, 50, 0, tzinfo=pytz.utc)
+        self.after = datetime.datetime(2023, 3, 2, 0, 4, 0, tzinfo=pytz.utc)
+        import_data(self.user, [(self.before, 50.0, -1.0, None), (self.after, 50.014, -1.0, None)], 'phone')
+
+    def test_get_writes_nothing(self):
+        count = Position.objects.count()
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('position-detail', args=['20230301235700']))
+        self.assertEqual(response.status_code, 200)
+        self.assertAlmostEqual(response.json()['lat'], 50.007)
+        self.assertEqual(self.client.get(reverse('position-detail', args=['20230301235700'])).json(), response.json())
+        self.assertEqual(self.client.get(reverse('position-detail', args=['20230301000000'])).status_code, 404)
+        self.assertEqual(Position.objects.count(), count)
+
+    def test_invalidated_across_midnight(self):
+        dt = datetime.datetime(2023, 3, 1, 23, 57, 0, tzinfo=pytz.utc)
+        self.assertAlmostEqual(get_position(self.user, dt).lat, 50.007)
+
+        # A change the day after, within the padding read around dt's bucket
+        Position.objects.filter(user=self.user.profile, time=self.after).update(lat=50.028)
+        invalidate_positions(self.user, self.after, self.after)
+        self.assertAlmostEqual(get_position(self.user, dt).lat, 50.014)
+
+        # and one further away, which doesn't need the bucket to be read again
+        invalidate_positions(self.user, self.after + datetime.timedelta(days=1), self.after + datetime.timedelta(days=1))
+        with self.assertNumQueries(0):
+            self.assertAlmostEqual(get_position(self.user, dt).lat, 50.014)
+
+class StopDetectorsTestCase(SimpleTestCase):
+
+    def series(self, seed, n=3000):
+        """ Makes a random set of points like those returned by load_positions, with some long gaps and some unknown speeds. """
+        rand = random.Random(seed)
+        times = []
+        t = 1677657600.0
+        for i in range(0, n):
+            t = t + rand.choice([1, 5, 15, 30, 45, 59, 60, 61, 90, 299, 300, 301, 900, 2000])
+            times.append(t)
+        points = {}
+        points['time'] = np.array(times)
+        points['lat'] = np.cumsum([rand.uniform(-0.0003, 0.0003) for i in range(0, n)]) + 50.0
+        points['lon'] = np.cumsum([rand.uniform(-0.0003, 0.0003) for i in range(0, n)]) - 1.0
+        points['speed'] = np.array([(np.nan if rand.random() < 0.05 else float(rand.randint(0, 6))) for i in range(0, n)])
+        points['elevation'] = np.full(n, np.nan)
+        points['explicit'] = np.ones(n, dtype=bool)
+        return points
+
+    def loop(self, points, max_speed=2, min_length=300, windows=4):
+        """ The stop detection loop from generate_events before it was vectorised, a window of four moving positions at a time, then merging. """
+        moving = [i for i in range(0, len(points['time'])) if ((not(np.isnan(points['speed'][i]))) and (points['speed'][i] > max_speed))]
+        pp = points['time'][moving]
+        stops = []
+        for i in range(0, len(pp) - windows):
+            buffer_before = pp[i + 1] - pp[i]
+            event_length = pp[i + 2] - pp[i + 1]
+            buffer_after = pp[i + 3] - pp[i + 2]
+            if event_length >= min_length:
+                if ((buffer_before < 60) & (buffer_after < 60)):
+                    stops.append([pp[i + 1], pp[i + 2]])
+        refined = []
+        for stop in stops:
+            if ((len(refined) > 0) and (stop[0] - refined[-1][1] < min_length)):
+                refined[-1][1] = stop[1]
+            else:
+                refined.append(stop)
+        ret = []
+        for start, end in refined:
+            wanted = (points['time'] >= start) & (points['time'] <= end)
+            ret.append((start, end, np.mean(points['lat'][wanted]), np.mean(points['lon'][wanted])))
+        return ret
+
+    def dwell_loop(self, points, radius=100, min_length=300, resample=30):
+        """ dwell() as described, one anchor at a time, with no shortcuts. """
+        times = []
+        lats = []
+        lons = []
+        for i in range(0, len(points['time'])):
+            if ((points['lat'][i] == 0.0) and (points['lon'][i] == 0.0)):
+                continue
+            if ((len(times) > 0) and (math.floor(points['time'][i] / resample) == math.floor(times[-1] / resample))):
+                continue
+            times.append(points['time'][i])
+            lats.append(points['lat'][i])
+            lons.append(points['lon'][i])
+        ret = []
+        resume = None
+        i = 0
+        while i < len(times):
+            j = i + 1
+            while ((j < len(times)) and (distance(lats[i], lons[i], lats[j], lons[j]) <= radius)):
+                j = j + 1
+            if j >= len(times):
+                resume = times[i]
+                break
+            if times[j - 1] - times[i] >= min_length:
+                ret.append((times[i], times[j - 1], np.mean(lats[i:j]), np.mean(lons[i:j])))
+                i = j
+            else:
+                i = i + 1
+        return ret, resume
+
+    def stops(self, found):
+        return list(zip(found['start'], found['end'], found['lat'], found['lon']))
+
+    def assertSameStops(self, found, expected):
+        self.assertEqual([(start, end) for start, end, lat, lon in self.stops(found)], [(start, end) for start, end, lat, lon in expected])
+        for (start, end, lat, lon), (expected_start, expected_end, expected_lat, expected_lon) in zip(self.stops(found), expected):
+            self.assertAlmostEqual(lat, expected_lat, places=9)
+            self.assertAlmostEqual(lon, expected_lon, places=9)
+
+    def test_speed_gap_regression(self):
+        for seed in range(0, 5):
+            points = self.series(seed)
+            expected = self.loop(points)
+            self.assertGreater(len(expected), 5)
+            self.assertSameStops(speed_gap(points, regression=True), expected)
+            self.assertSameStops(speed_gap(points, max_speed=4, min_length=600, regression=True), self.loop(points, max_speed=4, min_length=600))
+
+    def test_speed_gap(self):
+        for seed in range(0, 5):
+            points = self.series(seed)
+            self.assertSameStops(speed_gap(points), self.loop(points, windows=3)) # The last window is checked too
+        points = self.series(0, n=3)
+        self.assertEqual(len(speed_gap(points)['start']), 0)
+        self.assertIsNone(speed_gap(points)['resume'])
+
+    def test_dwell(self):
+        for seed in range(0, 5):
+            points = self.series(seed)
+            expected, resume = self.dwell_loop(points)
+            self.assertGreater(len(expected), 5)
+            found = dwell(points)
+            self.assertSameStops(found, expected)
+            self.assertEqual(found['resume'], resume)
+            expected, resume = self.dwell_loop(points, radius=30, min_length=120, resample=1)
+            found = dwell(points, radius=30, min_length=120, resample=1)
+            self.assertSameStops(found, expected)
+            self.assertEqual(found['resume'], resume)
+
+    def test_dwell_end(self):
+        points = {'time': np.arange(0.0, 3600.0, 10.0) + 1677657600.0}
+        n = len(points['time'])
+        points['lat'] = np.where(np.arange(0, n) < 100, 50.0 + 0.0005 * np.arange(0, n), 50.05) # Moving, then staying put until the end of the data
+        points['lon'] = np.full(n, -1.0)
+        points['lat'][200] = 0.0 # No fix, ignored
+        points['lon'][200] = 0.0
+        found = dwell(points)
+        self.assertEqual(len(found['start']), 0) # The stop may still be going on
+        self.assertEqual(found['resume'], points['time'][99])
+        self.assertIsNone(dwell({k: v[0:0] for k, v in points.items()})['resume'])
+
+    def test_detect_stops(self):
+        points = self.series(1)
+        self.assertSameStops(detect_stops(points), self.stops(speed_gap(points)))
+        self.assertSameStops(detect_stops(points, 'speed_gap', max_speed=3, min_length=400, radius=50, regression=True), self.stops(speed_gap(points, max_speed=3, min_length=400, regression=True)))
+        self.assertSameStops(detect_stops(points, 'dwell', max_speed=3, min_length=400, radius=50), self.stops(dwell(points, min_length=400, radius=50)))
+        self.assertEqual(detect_stops(points, 'dwell', radius=50)['resume'], dwell(points, radius=50)['resume'])
+        with self.assertRaises(ValueError):
+            detect_stops(points, 'unknown')
+
+OSM_FIXTURE = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="test">
+ <bounds minlat="50.0000000" minlon="-1.0100000" maxlat="50.0100000" maxlon="-1.0000000"/>
+ <node id="1" lat="50.0010000" lon="-1.0050000"><tag k="amenity" v="cafe"/><tag k="name" v="Cafe One"/></node>
+ <node id="2" lat="50.0012000" lon="-1.0052000"><tag k="amenity" v="bench"/></node>
+ <node id="3" lat="50.0015000" lon="-1.0049000"><tag k="leisure" v="park"/><tag k="name" v="Small Park"/></node>
+ <node id="4" lat="50.0011000" lon="-1.0051000"><tag k="shop" v="bakery"/><tag k="name" v="Not An Amenity"/></node>
+ <node id="5" lat="50.0090000" lon="-1.0090000"><tag k="amenity" v="pub"/><tag k="name" v="Far Pub"/></node>
+ <node id="10" lat="50.0005000" lon="-1.0055000"/>
+ <node id="11" lat="50.0005000" lon="-1.0045000"/>
+ <node id="12" lat="50.0009000" lon="-1.0045000"/>
+ <node id="13" lat="50.0009000" lon="-1.0055000"/>
+ <way id="100"><nd ref="10"/><nd ref="11"/><nd ref="12"/><nd ref="13"/><nd ref="10"/><tag k="amenity" v="school"/><tag k="name" v="School"/></way>
+ <way id="101"><nd ref="998"/><nd ref="999"/><tag k="amenity" v="parking"/><tag k="name" v="Outside The Extract"/></way>
+ <way id="102"><nd ref="10"/><nd ref="11"/><tag k="highway" v="footway"/></way>
+</osm>
+"""
+
+OVERPASS_ELEMENTS = [ # The named amenities and leisure facilities in OSM_FIXTURE, as Overpass would return them with 'out center'
+    {'type': 'node', 'id': 1, 'lat': 50.001, 'lon': -1.005, 'tags': {'amenity': 'cafe', 'name': 'Cafe One'}},
+    {'type': 'node', 'id': 2, 'lat': 50.0012, 'lon': -1.0052, 'tags': {'amenity': 'bench'}},
+    {'type': 'node', 'id': 3, 'lat': 50.0015, 'lon': -1.0049, 'tags': {'leisure': 'park', 'name': 'Small Park'}},
+    {'type': 'node', 'id': 5, 'lat': 50.009, 'lon': -1.009, 'tags': {'amenity': 'pub', 'name': 'Far Pub'}},
+    {'type': 'way', 'id': 100, 'center': {'lat': (50.0005 + 50.0009) / 2, 'lon': (-1.0055 + -1.0045) / 2}, 'nodes': [10, 11, 12, 13, 10], 'tags': {'amenity': 'school', 'name': 'School'}},
+]
+
+class OverpassStub(http.server.BaseHTTPRequestHandler):
+    """ A stand-in for an Overpass server, answering the queries made by query_overpass and query_overpass_box from OVERPASS_ELEMENTS. """
+
+    def do_POST(self):
+        query = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.server.queries.append(query)
+        if self.server.fail:
+            self.send_response(504)
+            self.end_headers()
+            return
+        keys = re.findall(r'nwr\[(\w+)\]', query)
+        around = re.search(r'around:([-\d.]+),([-\d.]+),([-\d.]+)', query)
+        box = re.search(r'nwr\[\w+\]\(([-\d.e]+),([-\d.e]+),([-\d.e]+),([-\d.e]+)\)', query)
+        elements = []
+        for element in OVERPASS_ELEMENTS:
+            lat, lon = (element['lat'], element['lon']) if element['type'] == 'node' else (element['center']['lat'], element['center']['lon'])
+            if not(any([key in element['tags'] for key in keys])):
+                continue
+            if ((not(around is None)) and (distance(float(around.group(2)), float(around.group(3)), lat, lon) > float(around.group(1)))):
+                continue
+            if ((not(box is None)) and (not((float(box.group(1)) <= lat <= float(box.group(3))) and (float(box.group(2)) <= lon <= float(box.group(4)))))):
+                continue
+            elements.append(element)
+        body = json.dumps({'version': 0.6, 'generator': 'test', 'elements': elements}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def overpass_stub(testcase):
+    """ Starts an OverpassStub for the duration of a test, and points LOCMAN_OVERPASS_URL at it. Its queries are recorded in the returned server's `queries`. """
+    server = http.server.HTTPServer(('127.0.0.1', 0), OverpassStub)
+    server.queries = []
+    server.fail = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    testcase.addCleanup(server.server_close)
+    testcase.addCleanup(server.shutdown)
+    settings = testcase.settings(LOCMAN_OVERPASS_URL='http://127.0.0.1:' + str(server.server_address[1]) + '/api/interpreter')
+    settings.enable()
+    testcase.addCleanup(settings.disable)
+    cache.clear()
+    testcase.addCleanup(cache.clear)
+    return server
+
+class AmenitiesTestCase(TestCase):
+
+    def setUp(self):
+        self.server = overpass_stub(self)
+
+    def write(self, content, suffix='.osm'):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        if suffix.endswith('.gz'):
+            with gzip.open(path, 'wt') as fp:
+                fp.write(content)
+        else:
+            with open(path, 'w') as fp:
+                fp.write(content)
+        return path
+
+    def names(self, amenities):
+        return [item['name'] for item in amenities]
+
+    def test_overpass(self):
+        found = query_overpass(50.001, -1.005)
+        self.assertEqual(self.names(found), ['Cafe One', 'School', 'Small Park']) # Amenities before leisure, nodes before ways
+        self.assertEqual(found[1]['lat'], 50.0007)
+        self.assertEqual(found[1]['amenity'], 'school')
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertIn('around:100,50.001,-1.005', self.server.queries[0])
+        self.assertEqual(self.names(query_overpass(50.001, -1.005, 2000)), ['Cafe One', 'Far Pub', 'School', 'Small Park'])
+
+    def test_cache(self):
+        self.assertIsNone(known_amenities(50.00101, -1.00501)) # Nothing cached yet
+        found = nearest_amenities(50.00101, -1.00501)
+        self.assertEqual(self.names(found), ['Cafe One', 'School', 'Small Park'])
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertIn('around:100,50.001,-1.005', self.server.queries[0]) # Rounded to AMENITY_CACHE_PRECISION
+        self.assertEqual(list(AmenityCache.objects.values_list('lat', 'lon', 'dist')), [(50.001, -1.005, 100)])
+
+        self.assertEqual(nearest_amenities(50.00099, -1.00498), found) # Rounds to the same point
+        self.assertEqual(known_amenities(50.001, -1.005), found)
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertIsNone(known_amenities(50.001, -1.005, 200)) # A different distance is a different answer
+        self.assertIsNone(known_amenities(50.0012, -1.005))
+        self.assertEqual(known_amenities(None, None), [])
+
+    def test_import_extract(self):
+        self.assertEqual(import_extract(self.write(OSM_FIXTURE)), 4)
+        self.assertEqual(sorted(Amenity.objects.values_list('osm_type', 'osm_id', 'name')), [('node', 1, 'Cafe One'), ('node', 3, 'Small Park'), ('node', 5, 'Far Pub'), ('way', 100, 'School')])
+        school = Amenity.objects.get(osm_type='way', osm_id=100)
+        self.assertEqual((school.lat, school.lon), (50.0007, -1.005))
+        self.assertEqual(school.cell, grid_cell(50.0007, -1.005))
+        self.assertEqual(school.tags, {'amenity': 'school', 'name': 'School'})
+        self.assertEqual(list(AmenityExtract.objects.values_list('minlat', 'minlon', 'maxlat', 'maxlon', 'amenities')), [(50.0, -1.01, 50.01, -1.0, 4)])
+
+        # Loading a newer extract of the same area replaces what was there
+        path = self.write(OSM_FIXTURE.replace('<tag k="name" v="Cafe One"/>', ''), '.osm.gz')
+        self.assertEqual(import_extract(path), 3)
+        self.assertFalse(Amenity.objects.filter(name='Cafe One').exists())
+        self.assertEqual(Amenity.objects.count(), 3)
+        self.assertEqual(AmenityExtract.objects.count(), 2)
+
+    def test_local(self):
+        expected = query_overpass(50.001, -1.005)
+        import_extract(self.write(OSM_FIXTURE))
+        self.assertEqual(local_amenities(50.001, -1.005), expected)
+        self.assertEqual(local_amenities(50.001, -1.005, 2000), query_overpass(50.001, -1.005, 2000))
+        queries = len(self.server.queries)
+        self.assertEqual(known_amenities(50.001, -1.005), expected) # Inside the extract, so never sent to Overpass
+        self.assertEqual(nearest_amenities(50.001, -1.005), expected)
+        self.assertEqual(len(self.server.queries), queries)
+        self.assertEqual(AmenityCache.objects.count(), 0)
+        self.assertEqual(local_amenities(50.5, -1.5), [])
+
+class EnrichTestCase(TestCase):
+
+    def setUp(self):
+        self.server = overpass_stub(self)
+        self.user = User.objects.create(username='test')
+        dt = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        self.events = []
+        for i, (lat, lon) in enumerate([(50.001, -1.005), (50.0015, -1.0049), (50.009, -1.009), (51.5, -0.1)]): # The first three share an Overpass query
+            self.events.append(Event.objects.create(user=self.user.profile, timestart=dt + datetime.timedelta(hours=i), timeend=dt + datetime.timedelta(hours=i, minutes=30), lat=lat, lon=lon, amenities_status='pending'))
+
+    def statuses(self):
+        return list(Event.objects.filter(user=self.user.profile).order_by('timestart').values_list('amenities_status', 'amenities_attempts'))
+
+    def test_done(self):
+        nearest_amenities(51.5, -0.1) # Already known
+        queries = len(self.server.queries)
+        self.assertIsNone(enrich_pending_events(self.user))
+        self.assertEqual(len(self.server.queries), queries + 1) # One query for the group of three
+        self.assertEqual(self.statuses(), [('done', 0)] * 4)
+        for e in self.events:
+            e.refresh_from_db()
+            self.assertEqual(e.amenities, nearest_amenities(e.lat, e.lon)) # The same answer as looking each up separately
+        self.assertEqual([item['name'] for item in self.events[0].amenities], ['Cafe One', 'School', 'Small Park'])
+        self.assertEqual(len(self.server.queries), queries + 1) # and those answers were cached
+
+    def test_limit(self):
+        self.assertEqual(enrich_pending_events(self.user, limit=2), 0) # More waiting
+        self.assertEqual(self.statuses(), [('done', 0)] * 2 + [('pending', 0)] * 2)
+        self.assertIsNone(enrich_pending_events(self.user, limit=2))
+        self.assertEqual(self.statuses(), [('done', 0)] * 4)
+
+    def test_failed(self):
+        Event.objects.filter(pk=self.events[3].pk).update(amenities_status='done')
+        self.server.fail = True
+        for attempt in range(1, AMENITY_MAX_ATTEMPTS + 1):
+            start = datetime.datetime.now(tz=pytz.utc)
+            delay = enrich_pending_events(self.user)
+            end = datetime.datetime.now(tz=pytz.utc)
+            self.assertEqual(len(self.server.queries), attempt)
+            e = Event.objects.get(pk=self.events[0].pk)
+            self.assertEqual(e.amenities_attempts, attempt)
+            backoff = datetime.timedelta(seconds=AMENITY_RETRY_DELAY * (2 ** (attempt - 1)))
+            self.assertTrue(start + backoff <= e.amenities_retry <= end + backoff)
+            if attempt < AMENITY_MAX_ATTEMPTS:
+                self.assertEqual(self.statuses(), [('pending', attempt)] * 3 + [('done', 0)])
+                self.assertTrue(backoff.total_seconds() - (end - start).total_seconds() - 1 <= delay <= backoff.total_seconds())
+                self.assertTrue(0 < enrich_pending_events(self.user) <= delay) # Not due yet
+                self.assertEqual(len(self.server.queries), attempt)
+                Event.objects.filter(user=self.user.profile).update(amenities_retry=start - datetime.timedelta(seconds=1))
+            else:
+                self.assertIsNone(delay)
+        self.assertEqual(self.statuses(), [('failed', AMENITY_MAX_ATTEMPTS)] * 3 + [('done', 0)])
+        self.events[0].refresh_from_db()
+        self.assertEqual(self.events[0].amenities, [])
+
+    def test_recovers(self):
+        self.server.fail = True
+        enrich_pending_events(self.user)
+        self.assertEqual(self.statuses(), [('pending', 1)] * 4)
+        self.server.fail = False
+        Event.objects.filter(user=self.user.profile).update(amenities_retry=datetime.datetime.now(tz=pytz.utc))
+        self.assertIsNone(enrich_pending_events(self.user))
+        self.assertEqual(self.statuses(), [('done', 1)] * 4)
+
+    def test_reschedule(self):
+        self.server.fail = True
+        request_job(self.user, 'enrich')
+        start = datetime.datetime.now(tz=pytz.utc)
+        enrich_event_amenities.now(self.user.pk)
+        tasks = list(Task.objects.filter(task_name='locman.tasks.enrich_event_amenities'))
+        self.assertEqual(len(tasks), 1)
+        self.assertTrue(start + datetime.timedelta(seconds=AMENITY_RETRY_DELAY - 1) <= tasks[0].run_at <= datetime.datetime.now(tz=pytz.utc) + datetime.timedelta(seconds=AMENITY_RETRY_DELAY))
+
+        # Nothing left waiting, so nothing more is queued
+        Task.objects.all().delete()
+        self.server.fail = False
+        Event.objects.filter(user=self.user.profile).update(amenities_retry=None)
+        request_job(self.user, 'enrich')
+        enrich_event_amenities.now(self.user.pk)
+        self.assertEqual(self.statuses(), [('done', 1)] * 4)
+        self.assertEqual(Task.objects.count(), 0)
+
+class JobsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+
+    def job(self, stage):
+        return Job.objects.get(user=self.user.profile, stage=stage)
+
+    def test_counted(self):
+        self.assertTrue(request_job(self.user, 'import'))
+        self.assertTrue(request_job(self.user, 'import')) # Every import is queued
+        self.assertTrue(start_job(self.user, 'import'))
+        self.assertTrue(start_job(self.user, 'import'))
+        self.assertFalse(request_job(self.user, 'fill')) # Waits for both imports
+        self.assertEqual(finish_job(self.user, 'import'), [])
+        self.assertTrue(self.job('import').running)
+        self.assertFalse(start_job(self.user, 'fill'))
+        self.assertEqual(finish_job(self.user, 'import'), ['fill'])
+        self.assertFalse(self.job('import').running)
+        self.assertIsNone(self.job('import').lease)
+        self.assertTrue(start_job(self.user, 'fill'))
+
+    def test_coalesced(self):
+        self.assertFalse(start_job(self.user, 'events')) # Never asked for
+        self.assertTrue(request_job(self.user, 'events'))
+        self.assertFalse(request_job(self.user, 'events')) # Already queued
+        self.assertTrue(start_job(self.user, 'events'))
+        self.assertFalse(start_job(self.user, 'events')) # A second copy of the task does nothing
+        self.assertEqual(self.job('events').pending, 0)
+        self.assertFalse(request_job(self.user, 'events')) # Asked for again while running, so queued when it finishes
+        self.assertFalse(request_job(self.user, 'events'))
+        self.assertEqual(finish_job(self.user, 'events'), ['events'])
+        self.assertTrue(start_job(self.user, 'events'))
+        self.assertEqual(finish_job(self.user, 'events'), [])
+        self.assertFalse(start_job(self.user, 'events'))
+
+    def test_dependencies(self):
+        self.assertTrue(request_job(self.user, 'import'))
+        self.assertTrue(start_job(self.user, 'import'))
+        self.assertFalse(request_job(self.user, 'fill'))
+        self.assertFalse(request_job(self.user, 'events'))
+        self.assertTrue(request_job(self.user, 'enrich')) # Depends on nothing
+        self.assertEqual(finish_job(self.user, 'import'), ['fill']) # Events still waits for fill
+        self.assertFalse(start_job(self.user, 'events'))
+        self.assertTrue(start_job(self.user, 'fill'))
+        self.assertTrue(request_job(self.user, 'refill'))
+        self.assertTrue(start_job(self.user, 'refill'))
+        self.assertEqual(finish_job(self.user, 'fill'), []) # Events still waits for refill
+        self.assertEqual(finish_job(self.user, 'refill'), ['events'])
+        self.assertTrue(start_job(self.user, 'events'))
+
+    def test_lease(self):
+        self.assertTrue(request_job(self.user, 'import'))
+        self.assertTrue(start_job(self.user, 'import'))
+        self.assertFalse(request_job(self.user, 'fill'))
+        self.assertFalse(start_job(self.user, 'fill'))
+
+        # The import crashed without finishing, and once its lease has run out it no longer blocks anything
+        past = datetime.datetime.now(tz=pytz.utc) - JOB_LEASE - datetime.timedelta(seconds=1)
+        Job.objects.filter(user=self.user.profile, stage='import').update(lease=past, updated=past)
+        self.assertTrue(start_job(self.user, 'fill'))
+        self.assertEqual(finish_job(self.user, 'fill'), [])
+
+        # The same goes for a stage asked for long ago whose task never ran
+        self.assertTrue(request_job(self.user, 'events'))
+        Job.objects.filter(user=self.user.profile, stage='events').update(updated=past)
+        self.assertFalse(start_job(self.user, 'events'))
+        self.assertTrue(request_job(self.user, 'events')) # So it can be asked for again
+        self.assertTrue(start_job(self.user, 'events'))
+        Job.objects.filter(user=self.user.profile, stage='events').update(lease=past)
+        self.assertTrue(request_job(self.user, 'events')) # Running, but only until the lease ran out
+
+class WorkersTestCase(TestCase):
+
+    def waiting(self, *shards):
+        """ Returns a list of waiting (task, shard, span) tuples, one for each shard or (shard, span) given. """
+        ret = []
+        for i, shard in enumerate(shards):
+            span = None
+            if isinstance(shard, tuple):
+                shard, span = shard
+            ret.append((SimpleNamespace(pk=i), shard, span))
+        return ret
+
+    def run_turns(self, waiting, turns, per_user=1):
+        """ Starts one task at a time, each finishing before the next starts, and returns the shards in the order they ran. """
+        served = {}
+        ret = []
+        for i in range(turns):
+            chosen = choose_tasks(waiting, [], 1, per_user, served)
+            if len(chosen) == 0:
+                break
+            waiting.remove(chosen[0])
+            served[chosen[0][1]] = i
+            ret.append(chosen[0][1])
+        return ret
+
+    def test_turns(self):
+        # Whoever queued first goes first, then users take it in turns, however many tasks each has waiting
+        self.assertEqual(self.run_turns(self.waiting(1, 1, 1, 1, 2, 3, 2), 10), [1, 2, 3, 1, 2, 1, 1])
+        self.assertEqual(self.run_turns(self.waiting(*([1] * 100 + [2])), 2), [1, 2])
+
+    def test_slots(self):
+        waiting = self.waiting(1, 1, 1, 2, 3)
+        self.assertEqual([item[1] for item in choose_tasks(waiting, [], 2, 1, {1: 5, 2: 3})], [3, 2]) # Served longest ago first
+        self.assertEqual([item[1] for item in choose_tasks(waiting, [], 10, 1, {1: 5, 2: 3})], [3, 2, 1]) # One each, however many slots
+        self.assertEqual([item[1] for item in choose_tasks(waiting, [(2, None)], 10, 1, {1: 5, 2: 3})], [3, 1]) # 2 is already running
+        self.assertEqual(choose_tasks(waiting, [], 0), [])
+
+    def test_spans(self):
+        waiting = self.waiting((1, (0, 100)), (1, (50, 150)), (1, (200, 300)), (1, None), (1, (400, 500)))
+        self.assertEqual([item[2] for item in choose_tasks(waiting, [], 10, 3)], [(0, 100), (200, 300), (400, 500)]) # Separate spans run alongside each other
+        self.assertEqual([item[2] for item in choose_tasks(waiting, [], 10, 2)], [(0, 100), (200, 300)])
+        self.assertEqual([item[2] for item in choose_tasks(waiting, [(1, (120, 250))], 10, 3)], [(0, 100), (400, 500)])
+        self.assertEqual(choose_tasks(waiting, [(1, None)], 10, 3), []) # Nothing runs alongside a task that may touch anything
+        self.assertEqual([item[2] for item in choose_tasks(waiting[3:], [], 10, 3)], [None])
+
+        # Other users still get their turn while one user's spans are being filled
+        waiting = self.waiting((1, (0, 100)), (1, (200, 300)), (1, (400, 500)), 2)
+        self.assertEqual([item[1] for item in choose_tasks(waiting, [], 2, 3)], [1, 2])
+
+    def test_waiting_tasks(self):
+        user = User.objects.create(username='test')
+        enrich_event_amenities(user.pk)
+        refill_span(user.pk, 1000, 2000)
+        tasks = {task.task_name: task for task in Task.objects.all()}
+        self.assertEqual(task_shard(tasks['locman.tasks.refill_span']), (user.pk, (1000, 2000)))
+        self.assertEqual(task_shard(tasks['locman.tasks.enrich_event_amenities']), (user.pk, None))
+        self.assertEqual(sorted([item[1:] for item in waiting_tasks()], key=str), [(user.pk, (1000, 2000)), (user.pk, None)])
+
+        # A task still running after MAX_RUN_TIME is offered again by background_task, but not if it's excluded
+        running = tasks['locman.tasks.refill_span']
+        Task.objects.filter(pk=running.pk).update(locked_by=str(os.getpid()), locked_at=datetime.datetime.now(tz=pytz.utc) - datetime.timedelta(days=1))
+        self.assertEqual(len(waiting_tasks()), 2)
+        self.assertEqual([item[0].pk for item in waiting_tasks(exclude=[running.pk])], [tasks['locman.tasks.enrich_event_amenities'].pk])
+        self.assertEqual(len(waiting_tasks(['imports'])), 0)
+
+class QueuedTasksTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.other = User.objects.create(username='other')
+        for user in [self.user, self.other]:
+            import_uploaded_file(user.pk, '/tmp/' + user.username + '.gpx', 'phone_gps')
+            refill_span(user.pk, 1000, 2000)
+        self.client.force_login(self.user)
+
+    def test_import(self):
+        tasks = Task.objects.count()
+        jobs = list(Job.objects.values_list('user', 'stage', 'pending', 'running'))
+        data = self.client.get(reverse('import-list')).json()
+        self.assertEqual(data['user'], 'test')
+        self.assertEqual([(item['user_id'], item['parameters'][0]) for item in data['tasks']], [(self.user.pk, ['/tmp/test.gpx', 'phone_gps'])])
+        self.assertEqual(Task.objects.count(), tasks) # Looking doesn't queue anything
+        self.assertEqual(list(Job.objects.values_list('user', 'stage', 'pending', 'running')), jobs)
+
+    def test_process(self):
+        data = self.client.get(reverse('process-list')).json()
+        self.assertEqual([(item['user_id'], item['label']) for item in data['tasks']], [(self.user.pk, 'locman.tasks.refill_span')])
+
+class StatsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='test')
+        self.day1 = datetime.datetime(2023, 3, 1, 8, 0, 0, tzinfo=pytz.utc)
+        self.day5 = datetime.datetime(2023, 3, 5, 8, 0, 0, tzinfo=pytz.utc)
+        Watermark.objects.update_or_create(user=self.user.profile, name='events', defaults={'time': self.day1, 'state': '{}'})
+
+    def assertStats(self):
+        """ Checks the user's UserStats against the latest rows in the position and event tables. """
+        positions = Position.objects.filter(user=self.user.profile)
+        expected = (positions.filter(explicit=True).aggregate(Max('time'))['time__max'], positions.filter(explicit=False, source='cron').aggregate(Max('time'))['time__max'], Event.objects.filter(user=self.user.profile).aggregate(Max('timestart'))['timestart__max'])
+        stats = UserStats.objects.get(pk=self.user.profile.pk)
+        self.assertEqual((stats.last_explicit, stats.last_calculated, stats.last_event), expected)
+        return expected
+
+    def test_import(self):
+        stats = user_stats(self.user) # Worked out from scratch the first time
+        self.assertEqual((stats.last_explicit, stats.last_calculated, stats.last_event), (None, None, None))
+        import_data(self.user, track(self.day5, stops=[(3600, 1800)]), 'phone')
+        self.assertEqual(self.assertStats()[0], self.day5 + datetime.timedelta(seconds=14370))
+        import_data(self.user, track(self.day1, stops=[(7200, 1800)]), 'phone') # Earlier data doesn't move anything back
+        self.assertEqual(self.assertStats()[0], self.day5 + datetime.timedelta(seconds=14370))
+        process(self.user, self.day1, self.day5 + datetime.timedelta(hours=4))
+        generate_events(self.user)
+        last_explicit, last_calculated, last_event = self.assertStats()
+        self.assertEqual(Event.objects.filter(user=self.user.profile).count(), 3)
+        self.assertEqual(get_process_stats(self.user), {'last_calculated_position': int(last_calculated.timestamp()), 'last_generated_event': int(last_event.timestamp()), 'last_explicit_position': int(last_explicit.timestamp())})
+
+    def test_invalidate(self):
+        import_data(self.user, track(self.day1, stops=[(7200, 1800)]), 'phone')
+        import_data(self.user, track(self.day5, stops=[(3600, 1800)]), 'phone')
+        process(self.user, self.day1, self.day5 + datetime.timedelta(hours=4))
+        generate_events(self.user)
+        before = self.assertStats()
+
+        # Changing the last day throws away the calculated positions and events that depend on it
+        with self.captureOnCommitCallbacks(execute=True):
+            ret = import_data(self.user, track(self.day5, stops=[(3600, 1800)], offset=0.0001), 'phone')
+        after = self.assertStats()
+        self.assertEqual(after[0], before[0])
+        self.assertIsNone(after[1]) # The only calculated positions were in the gap before the changed day
+        self.assertTrue(after[2] < before[2])
+
+        # and filling them in again, as the refill task does, brings everything back
+        for span in ret['invalidated']:
+            process(self.user, span['fill_start'], self.day5 + datetime.timedelta(hours=4) if span['fill_end'] is None else span['fill_end'])
+            if not(span['events_start'] is None):
+                regenerate_events(self.user, span['events_start'], span['events_end'])
+        generate_events(self.user)
+        after = self.assertStats()
+        self.assertEqual((after[0], after[2]), (before[0], before[2]))
+        self.assertTrue(abs((after[1] - before[1]).total_seconds()) < 60) # The gap is filled on a grid starting from its own start
+
+    def test_delete_events(self):
+        import_data(self.user, track(self.day1, stops=[(3600, 1800), (9000, 1800)]), 'phone')
+        process(self.user, self.day1, self.day1 + datetime.timedelta(hours=4))
+        generate_events(self.user)
+        last_event = self.assertStats()[2]
+        Event.objects.filter(user=self.user.profile, timestart=last_event).delete()
+        refresh_stats(self.user, ['last_event'])
+        self.assertTrue(self.assertStats()[2] < last_event)
+        Event.objects.filter(user=self.user.profile).delete()
+        refresh_stats(self.user, ['last_event'])
+        self.assertIsNone(self.assertStats()[2])
+
+    def test_advance(self):
+        import_data(self.user, track(self.day1), 'phone')
+        last_explicit = self.assertStats()[0]
+        advance_stats(self.user, last_explicit=self.day1, last_event=None) # Neither moves anything
+        self.assertEqual(self.assertStats()[0], last_explicit)
+        advance_stats(self.user, last_event=self.day5)
+        self.assertEqual(UserStats.objects.get(pk=self.user.profile.pk).last_event, self.day5)
+
+        # Without a UserStats row, everything is worked out from scratch, which includes what has just been written
+        UserStats.objects.all().delete()
+        advance_stats(self.user, last_explicit=self.day1)
+        self.assertEqual(self.assertStats()[0], last_explicit)
@@ -1,25 +1,32 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.conf import settings
 from django.db import OperationalError
 from django.db.models import Min, Max
-from django.core.cache import cache
-from rest_framework.decorators import api_view, renderer_classes
+from rest_framework.decorators import api_view, renderer_classes, action
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.response import Response
 from rest_framework.renderers import JSONRenderer
-from rest_framework.exceptions import MethodNotAllowed, AuthenticationFailed
+from rest_framework.exceptions import MethodNotAllowed, AuthenticationFailed, ParseError, NotFound
 from rest_framework.parsers import JSONParser
 from rest_framework import status, viewsets
 
-from .models import UserProfile, Position, Event
+from .models import UserProfile, Position, Event, PositionSource
 from .serializers import EventSerializer, PositionSerializer, RouteSerializer
-from .functions import extrapolate_position, calculate_speed, get_last_position, get_source_ids, distance, get_location_events, get_process_stats
-from .tasks import generate_location_events, import_uploaded_file
+from .functions import get_position, get_location_events, get_process_stats, load_positions, interpolate_positions
+from .geodesy import cumulative_distance, zoom_tolerance
+from .summaries import bounding_box
+from .routes import route_geojson, route_size, iter_json, ROUTE_STREAM_THRESHOLD
+from .pyramid import choose_resolution, load_level
+from .tasks import queue_import
+from .workers import task_shard
 from background_task.models import Task
 
+import numpy as np
 import datetime, pytz, json, os, sys
 
+POSITION_BATCH_LIMIT = 1000 # The maximum number of timestamps that may be requested from position/batch at once
+
 class EventViewSet(viewsets.ViewSet):
     """
     The Event namespace is for querying location events.
@@ -75,9 +82,14 @@ class PositionViewSet(viewsets.ViewSet):
     The Position namespace is for querying raw location data.
 
         position - Get a list of the last ten explicit positions logged
-        position/[timestamp] - Get the location for a specific timestamp
+        position/[timestamp] - Get the location for a specific timestamp, interpolated if necessary (but never saved)
+        position/batch?times=[timestamp],[timestamp],... - Get the locations for a list of timestamps
 
     Format of timestamp should be YYYYMMDDHHMMSS, always UTC
+
+    The list of timestamps for position/batch may also be POSTed, as a JSON list or as the 'times' property of a JSON
+    object. The results are returned in the same order, with null in place of any position that can't be calculated.
+    Interpolated positions are not saved unless the 'save' parameter is given.
     """
     def list(self, request):
         user = request.user
@@ -99,16 +111,41 @@ class PositionViewSet(viewsets.ViewSet):
         dsmin = int(ds[10:12])
         dssec = int(ds[12:])
         dt = datetime.datetime(dsyear, dsmonth, dsday, dshour, dsmin, dssec, tzinfo=pytz.UTC)
-        try:
-            pos = Position.objects.get(user, time=dt)
-        except:
-            pos = extrapolate_position(user, dt)
-        if pos.speed is None:
-            pos.speed = calculate_speed(pos)
-            pos.save()
+        pos = get_position(user, dt)
+        if pos is None:
+            raise NotFound("No position can be calculated for this time.")
         serializer = PositionSerializer(pos)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['get', 'post'])
+    def batch(self, request):
+        user = request.user
+        if not user.__class__.__name__ == 'User':
+            return Response([])
+        if request.method == 'POST':
+            times = request.data
+            if isinstance(times, dict):
+                times = times.get('times', [])
+            save = ('save' in request.query_params) or ((isinstance(request.data, dict)) and (bool(request.data.get('save', False))))
+        else:
+            times = [ds for ds in request.query_params.get('times', '').split(',') if ds != '']
+            save = 'save' in request.query_params
+        if not(isinstance(times, list)):
+            raise ParseError("A list of timestamps is required.")
+        if len(times) > POSITION_BATCH_LIMIT:
+            raise ParseError("No more than " + str(POSITION_BATCH_LIMIT) + " timestamps may be requested at once.")
+        try:
+            dts = [pytz.UTC.localize(datetime.datetime.strptime(str(ds), '%Y%m%d%H%M%S')) for ds in times]
+        except ValueError:
+            raise ParseError("Timestamps should be in the format YYYYMMDDHHMMSS.")
+        data = []
+        for pos in interpolate_positions(user, dts, save=save):
+            if pos is None:
+                data.append(None)
+            else:
+                data.append(PositionSerializer(pos).data)
+        return Response(data)
+
 class RouteViewSet(viewsets.ViewSet):
     """
     The Route namespace is for querying positions in batch, as a route.
@@ -116,6 +153,15 @@ class RouteViewSet(viewsets.ViewSet):
         route/[time_from][time_to] - Generate a GeoJSON object describing the location data within a particular timespan.
 
     Format of time_from and time_to should be YYYYMMDDHHMMSS, always UTC
+
+    The route may be simplified for display by adding one of the following query parameters:
+
+        zoom - The zoom level of the map the route is to be drawn on
+        tolerance - The distance, in degrees, by which the simplified route may differ from the full route
+        max_points - The maximum number of points in the route
+        resolution - The coarsest acceptable time resolution of the route, in seconds
+
+    Long routes are drawn from pre-calculated rollups (1 minute, 10 minutes or 1 hour) when max_points or resolution allow it.
     """
     def list(self, request):
         queryset = []
@@ -141,8 +187,23 @@ class RouteViewSet(viewsets.ViewSet):
         dsesec = int(ds[26:])
         dts = datetime.datetime(dssyear, dssmonth, dssday, dsshour, dssmin, dsssec, tzinfo=pytz.UTC)
         dte = datetime.datetime(dseyear, dsemonth, dseday, dsehour, dsemin, dsesec, tzinfo=pytz.UTC)
-        event = Event(timestart=dts, timeend=dte, user=user.profile)
-        data = {"timestart": event.timestart, "timeend": event.timeend, "geo": event.geojson()}
+        tolerance = None
+        max_points = None
+        resolution = None
+        try:
+            if 'zoom' in request.query_params:
+                tolerance = zoom_tolerance(int(request.query_params['zoom']))
+            if 'tolerance' in request.query_params:
+                tolerance = float(request.query_params['tolerance'])
+            if 'max_points' in request.query_params:
+                max_points = int(request.query_params['max_points'])
+            if 'resolution' in request.query_params:
+                resolution = int(request.query_params['resolution'])
+        except ValueError:
+            raise ParseError("The zoom, tolerance, max_points and resolution parameters must be numeric.")
+        data = {"timestart": dts, "timeend": dte, "geo": route_geojson(user, dts, dte, tolerance, max_points, resolution)}
+        if route_size(data['geo']) > ROUTE_STREAM_THRESHOLD:
+            return StreamingHttpResponse(iter_json(data), content_type='application/json')
         return Response(data)
 
 class BoundingBoxViewSet(viewsets.ViewSet):
@@ -152,6 +213,9 @@ class BoundingBoxViewSet(viewsets.ViewSet):
         bbox/[time_from][time_to] - Return extreme points within a particular timespan.
 
     Format of time_from and time_to should be YYYYMMDDHHMMSS, always UTC
+
+    Whole days are read from the daily summaries and whole hours and minutes from the rollups, so only the odd seconds at
+    either end of the timespan need to be read from the raw position data.
     """
     def list(self, request):
         queryset = []
@@ -177,8 +241,8 @@ class BoundingBoxViewSet(viewsets.ViewSet):
         dsesec = int(ds[26:])
         dts = datetime.datetime(dssyear, dssmonth, dssday, dsshour, dssmin, dsssec, tzinfo=pytz.UTC)
         dte = datetime.datetime(dseyear, dsemonth, dseday, dsehour, dsemin, dsesec, tzinfo=pytz.UTC)
-        ret = Position.objects.filter(user=user.profile, time__gte=dts, time__lte=dte).aggregate(max_lat=Max('lat'), min_lat=Min('lat'), max_lon=Max('lon'), min_lon=Min('lon'))
-        data = [ret['min_lon'], ret['min_lat'], ret['max_lon'], ret['max_lat']]
+        ret = bounding_box(user, dts, dte)
+        data = [ret['minlon'], ret['minlat'], ret['maxlon'], ret['maxlat']]
         return Response(data)
 
 class ElevationViewSet(viewsets.ViewSet):
@@ -188,6 +252,9 @@ class ElevationViewSet(viewsets.ViewSet):
         elevation/[time_from][time_to] - Generate a list of distance and elevation data within a particular timespan.
 
     Format of time_from and time_to should be YYYYMMDDHHMMSS, always UTC
+
+    For long timespans, add max_points (the maximum number of values wanted) or resolution (the coarsest acceptable time
+    resolution, in seconds) and the values will be read from pre-calculated rollups, averaged over 1 minute, 10 minutes or 1 hour.
     """
     def list(self, request):
         queryset = []
@@ -213,21 +280,50 @@ class ElevationViewSet(viewsets.ViewSet):
         dsesec = int(ds[26:])
         dts = datetime.datetime(dssyear, dssmonth, dssday, dsshour, dssmin, dsssec, tzinfo=pytz.UTC)
         dte = datetime.datetime(dseyear, dsemonth, dseday, dsehour, dsemin, dsesec, tzinfo=pytz.UTC)
+        max_points = None
+        resolution = None
+        try:
+            if 'max_points' in request.query_params:
+                max_points = int(request.query_params['max_points'])
+            if 'resolution' in request.query_params:
+                resolution = int(request.query_params['resolution'])
+        except ValueError:
+            raise ParseError("The max_points and resolution parameters must be numeric.")
+        level = choose_resolution(dts, dte, resolution, max_points)
+        if level == 1:
+            points = load_positions(user, dts, dte, explicit=True)
+        else:
+            points = load_level(user, dts, dte, level)
+        wanted = ~np.isnan(points['elevation'])
+        times = [datetime.datetime.fromtimestamp(t, tz=pytz.UTC) for t in points['time'][wanted]]
+        positions = list(zip(times, points['lat'][wanted], points['lon'][wanted], points['elevation'][wanted]))
+        dist = cumulative_distance([pos[1] for pos in positions], [pos[2] for pos in positions]).tolist()
+        elevation = np.maximum([pos[3] for pos in positions], 0).tolist()
         data = []
-        lat = None
-        lon = None
-        dist = 0
-        for pos in Position.objects.filter(user=user.profile, time__gte=dts, time__lte=dte, explicit=True).exclude(elevation=None):
-            if not(lat is None):
-                dist = dist + distance(lat, lon, pos.lat, pos.lon)
-            e = pos.elevation
-            if e < 0:
-                e = 0
-            data.append((pos.time, dist, e))
-            lat = pos.lat
-            lon = pos.lon
+        for i in range(0, len(positions)):
+            data.append((positions[i][0], dist[i], elevation[i]))
         return Response(data)
 
+def queued_tasks(queue, user):
+    """ Returns a list of dictionaries describing a user's background tasks waiting in, or being run from, a queue. Only the columns needed are read. """
+    ret = []
+    for task in Task.objects.filter(queue=queue).only('task_hash', 'task_name', 'task_params', 'run_at', 'locked_by', 'last_error').order_by('run_at'):
+        if task_shard(task)[0] != user.pk:
+            continue # Someone else's
+        item = {}
+        item['id'] = task.task_hash
+        item['time'] = int(task.run_at.timestamp())
+        item['label'] = task.task_name
+        item['running'] = task.locked_by_pid_running()
+        if item['running'] is None:
+            item['running'] = False
+        item['has_error'] = task.has_error()
+        task_params = json.loads(task.task_params)
+        item['user_id'] = task_params[0].pop(0)
+        item['parameters'] = task_params
+        ret.append(item)
+    return ret
+
 class ProcessViewSet(viewsets.ViewSet):
     """
     The process namespace queries the running of the Location Manager.
@@ -241,21 +337,7 @@ class ProcessViewSet(viewsets.ViewSet):
         user = request.user
         if not user.__class__.__name__ == 'User':
             return Response(data)
-        for task in Task.objects.all():
-            if task.queue != 'process':
-                continue
-            item = {}
-            item['id'] = task.task_hash
-            item['time'] = int(task.run_at.timestamp())
-            item['label'] = task.task_name
-            item['running'] = task.locked_by_pid_running()
-            if item['running'] is None:
-                item['running'] = False
-            item['has_error'] = task.has_error()
-            task_params = json.loads(task.task_params)
-            item['user_id'] = task_params[0].pop(0)
-            item['parameters'] = task_params
-            data['tasks'].append(item)
+        data['tasks'] = queued_tasks('process', user)
         data['stats'] = get_process_stats(user)
         return Response(data)
 
@@ -275,36 +357,9 @@ def upload(request):
         data = {'tasks':[], 'sources':{}}
         if user.__class__.__name__ == 'User':
             data['user'] = user.username
-        sources = get_source_ids()
-        for source in sources:
-            cache_key = 'last_' + source
-            value = cache.get(cache_key)
-            if value is None:
-                try:
-                    value = str(Position.objects.filter(user=user.profile, source=source).order_by('-time')[0].time.strftime("%Y-%m-%d"))
-                except:
-                    value = None
-            if value is None:
-                continue
-            cache.set(cache_key, value, 86400)
-            data['sources'][source] = value
-        if user.__class__.__name__ == 'User':
-            for task in Task.objects.all():
-                if task.queue != 'imports':
-                    continue
-                item = {}
-                item['id'] = task.task_hash
-                item['time'] = int(task.run_at.timestamp())
-                item['label'] = task.task_name
-                item['running'] = task.locked_by_pid_running()
-                if item['running'] is None:
-                    item['running'] = False
-                item['has_error'] = task.has_error()
-                task_params = json.loads(task.task_params)
-                item['user_id'] = task_params[0].pop(0)
-                item['parameters'] = task_params
-                data['tasks'].append(item)
-            generate_location_events(user.pk)
+            for source, last in PositionSource.objects.filter(user=user.profile).values_list('source', 'last'):
+                data['sources'][source] = last.strftime("%Y-%m-%d")
+            data['tasks'] = queued_tasks('imports', user)
         response = HttpResponse(json.dumps(data), content_type='application/json')
         return response
 
@@ -330,7 +385,7 @@ def upload(request):
     writer.close()
 
     data = {'file':uploaded_file.name, 'size':uploaded_file.size, 'type':uploaded_file.content_type, 'source':file_source}
-    import_uploaded_file(user.pk, temp_file, file_source, file_format)
+    queue_import(user.pk, temp_file, file_source, file_format)
     response = HttpResponse(json.dumps(data), content_type='application/json')
     return response
 
@@ -0,0 +1,142 @@
+from django.conf import settings
+import os
+
+# This module is imported by the worker processes before Django has been set up, so the models and background_task
+# are only imported within the functions that need them.
+
+WORKER_QUEUES = ['imports', 'process']
+WORKER_SCAN = 1000 # The most waiting tasks looked at each time a worker becomes free
+WORKER_SPAN_TASKS = {'locman.tasks.refill_span': [1, 2, 3, 4]} # Tasks that only touch a span of a user's history, and which of their arguments are the times bounding it
+
+def worker_count():
+    """ Returns the number of worker processes to run, from LOCMAN_WORKERS, defaulting to the number of CPUs. """
+    count = getattr(settings, 'LOCMAN_WORKERS', None)
+    if count is None:
+        count = os.cpu_count()
+    return max(int(count or 1), 1)
+
+def worker_user_limit():
+    """ Returns the most tasks that may run at once for any one user, from LOCMAN_WORKERS_PER_USER, defaulting to 1. """
+    return max(int(getattr(settings, 'LOCMAN_WORKERS_PER_USER', 1) or 1), 1)
+
+def task_shard(task):
+    """
+    Works out who a waiting task belongs to, and which part of their history it touches. All the location manager's
+    tasks take the user's id as their first argument.
+
+    :param task: A background_task Task.
+    :return: A tuple of the shard (the user's id, or the task's own id if it doesn't belong to a user) and the span of history it touches, as a tuple of seconds since the epoch, or None if it may touch anything.
+    :rtype: tuple
+    """
+    try:
+        args, kwargs = task.params()
+    except ValueError:
+        args = []
+    if ((len(args) == 0) or (not(isinstance(args[0], int)))):
+        return ('task', task.pk), None
+    indices = WORKER_SPAN_TASKS.get(task.task_name, [])
+    times = [args[i] for i in indices if ((i < len(args)) and (not(args[i] is None)))]
+    if len(times) == 0:
+        return args[0], None
+    return args[0], (min(times), max(times))
+
+def _can_run(span, running):
+    """ Returns True if a task touching `span` can run alongside tasks of the same user touching each of the spans in `running`. """
+    if len(running) == 0:
+        return True
+    if span is None:
+        return False
+    for other in running:
+        if ((other is None) or ((span[0] <= other[1]) and (other[0] <= span[1]))):
+            return False
+    return True
+
+def choose_tasks(waiting, running, slots, per_user=1, served=None):
+    """
+    Chooses which waiting tasks to start. Users take it in turns, starting with whoever was served longest ago, so
+    one user with a lot of work can't hold up everybody else. A user's tasks run one at a time, except for those
+    touching separate spans of their history, which may run alongside each other up to `per_user` at once.
+
+    :param waiting: A list of (task, shard, span) tuples, in the order the tasks were queued. See task_shard.
+    :param running: A list of (shard, span) tuples for the tasks already running.
+    :param slots: The number of tasks that may be started.
+    :param per_user: The most tasks that may be running at once for each shard.
+    :param served: A dictionary of shard to a number that increases each time the shard has a task started, used to decide whose turn it is.
+    :return: A list of the (task, shard, span) tuples to start.
+    :rtype: list
+    """
+    if served is None:
+        served = {}
+    queues = {}
+    order = []
+    for item in waiting:
+        if not(item[1] in queues):
+            queues[item[1]] = []
+            order.append(item[1])
+        queues[item[1]].append(item)
+    order = sorted(order, key=lambda shard: served.get(shard, -1))
+    active = {}
+    for shard, span in running:
+        active[shard] = active.get(shard, []) + [span]
+    ret = []
+    found = True
+    while ((slots > 0) and (found)):
+        found = False
+        for shard in order:
+            if slots <= 0:
+                break
+            spans = active.get(shard, [])
+            if len(spans) >= per_user:
+                continue
+            for item in queues[shard]:
+                if _can_run(item[2], spans):
+                    queues[shard].remove(item)
+                    active[shard] = spans + [item[2]]
+                    ret.append(item)
+                    slots = slots - 1
+                    found = True
+                    break
+    return ret
+
+def waiting_tasks(queues=WORKER_QUEUES, exclude=None):
+    """
+    Returns the tasks ready to run in any of `queues`, as a list of (task, shard, span) tuples in the order they should
+    run. background_task treats a task locked for longer than BACKGROUND_TASK_MAX_RUN_TIME as abandoned and offers it
+    again, so the caller should exclude the tasks it is still running, or a long one would be started alongside itself.
+
+    :param exclude: Optional, a list of the ids of tasks already running.
+    """
+    from background_task.models import Task
+    from background_task.tasks import tasks
+    available = Task.objects.find_available().filter(queue__in=queues)
+    if ((not(exclude is None)) and (len(exclude) > 0)):
+        available = available.exclude(pk__in=exclude)
+    ret = []
+    for task in available[0:WORKER_SCAN]:
+        if not(task.task_name in tasks._tasks):
+            continue
+        shard, span = task_shard(task)
+        ret.append((task, shard, span))
+    return ret
+
+def start_worker():
+    """ Sets up Django within a newly started worker process. """
+    import django
+    django.setup()
+    from background_task.tasks import autodiscover
+    autodiscover()
+    import locman.tasks # Not found by autodiscover, as the app is installed by its AppConfig
+
+def run_task(task_id):
+    """ Runs a task, which must already have been locked, within a worker process. The task is removed, or rescheduled if it fails, exactly as by process_tasks. """
+    from background_task.models import Task
+    from background_task.tasks import tasks
+    from django.db import close_old_connections
+    task = Task.objects.filter(pk=task_id).first()
+    if task is None:
+        return False
+    try:
+        tasks.run_task(task)
+    finally:
+        close_old_connections()
+    return True